@@ -0,0 +1,64 @@
+"""Compare merging cuts through dense masks with the interval routines
+in todloop.utils.intervals, on cut densities typical of glitch cuts.
+
+Usage: PYTHONPATH=. python benchmarks/bench_cuts.py
+"""
+import timeit
+
+import numpy as np
+
+from todloop.utils.intervals import union, intersection
+
+
+def get_mask(cuts, nsamps):
+    """Same as CutsVector.get_mask"""
+    mask = np.zeros(nsamps, dtype=bool)
+    for start, end in cuts:
+        mask[start:end] = True
+    return mask
+
+
+def from_mask(mask):
+    """Same as CutsVector.from_mask"""
+    d = np.diff(np.hstack([0, mask.astype(np.int8), 0]))
+    return np.vstack([np.flatnonzero(d == 1), np.flatnonzero(d == -1)]).T
+
+
+def mask_union(cut1, cut2):
+    nsamps = max(cut1[-1][1], cut2[-1][1])
+    return from_mask(get_mask(cut1, nsamps) | get_mask(cut2, nsamps))
+
+
+def mask_intersection(cut1, cut2):
+    nsamps = max(cut1[-1][1], cut2[-1][1])
+    return from_mask(get_mask(cut1, nsamps) & get_mask(cut2, nsamps))
+
+
+def random_cuts(n, nsamps, max_len, rng):
+    starts = np.sort(rng.choice(nsamps - max_len, n, replace=False))
+    cuts = np.vstack([starts, starts + rng.randint(1, max_len, n)]).T
+    return from_mask(get_mask(cuts, nsamps))
+
+
+def main():
+    rng = np.random.RandomState(0)
+    nsamps = 250000  # ~10 minutes at 400 Hz
+    print("%8s %14s %14s %8s" % ("n_cuts", "mask (us)", "interval (us)", "speedup"))
+    for n in [2, 10, 50, 200]:
+        pairs = [(random_cuts(n, nsamps, 50, rng), random_cuts(n, nsamps, 50, rng))
+                 for _ in range(20)]
+        for a, b in pairs:
+            assert np.array_equal(mask_union(a, b), union(a, b))
+            assert np.array_equal(mask_intersection(a, b), intersection(a, b))
+        n_iter = 10
+        t_mask = timeit.timeit(lambda: [(mask_union(a, b), mask_intersection(a, b))
+                                        for a, b in pairs], number=n_iter)
+        t_new = timeit.timeit(lambda: [(union(a, b), intersection(a, b))
+                                       for a, b in pairs], number=n_iter)
+        scale = 1e6 / (n_iter * len(pairs) * 2)
+        print("%8d %14.1f %14.1f %8.1f" % (n, t_mask * scale, t_new * scale,
+                                           t_mask / t_new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Compare the per-sample histogram and peak finding loops used by
+FindEvents with the vectorized versions in todloop.utils.events.
+
+Usage: PYTHONPATH=. python benchmarks/bench_events.py
+"""
+import timeit
+
+import numpy as np
+
+from todloop.utils.events import find_peaks, endpoint_histogram
+
+
+def from_mask(mask):
+    d = np.diff(np.hstack([0, mask.astype(np.int8), 0]))
+    return np.vstack([np.flatnonzero(d == 1), np.flatnonzero(d == -1)]).T
+
+
+def histogram_loop(cosig, nsamps):
+    cosig_hist = np.zeros(nsamps)
+    for pixel in cosig:
+        cuts = cosig[pixel].copy()
+        cuts[:, 1] = cuts[:, 1] - 1
+        cosig_hist[cuts] += 1
+    return cosig_hist
+
+
+def find_peaks_loop(hist):
+    last = 0
+    peaks = []
+    for i in range(len(hist)):
+        if hist[i] > 0 and last == 0:
+            peak_start = i
+        if hist[i] == 0 and last > 0:
+            peak_end = i
+            peak_amp = max(hist[peak_start:peak_end])
+            duration = peak_end - peak_start
+            peaks.append([peak_start, peak_end, duration, peak_amp])
+        last = hist[i]
+    return peaks
+
+
+def main():
+    rng = np.random.RandomState(0)
+    nsamps = 250000  # ~10 minutes at 400 Hz
+    n_pixels = 250
+    print("%8s %14s %14s %8s" % ("density", "loop (ms)", "vector (ms)", "speedup"))
+    for density in [1e-4, 1e-3, 1e-2]:
+        cosig = dict((str(p), from_mask(rng.rand(nsamps) < density))
+                     for p in range(n_pixels))
+        hist = endpoint_histogram(cosig, nsamps)
+        assert np.array_equal(hist, histogram_loop(cosig, nsamps))
+        assert find_peaks(hist) == find_peaks_loop(hist)
+        n_iter = 3
+        t_loop = timeit.timeit(lambda: find_peaks_loop(histogram_loop(cosig, nsamps)),
+                               number=n_iter) / n_iter
+        t_vec = timeit.timeit(lambda: find_peaks(endpoint_histogram(cosig, nsamps)),
+                              number=n_iter) / n_iter
+        print("%8g %14.1f %14.1f %8.1f" % (density, t_loop * 1e3, t_vec * 1e3,
+                                           t_loop / t_vec))
+
+
+if __name__ == "__main__":
+    main()
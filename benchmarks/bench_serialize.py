@@ -0,0 +1,68 @@
+"""Compare the size and speed of routine outputs saved as pickles with
+todloop.utils.serialize, without and with compression.
+
+Usage: PYTHONPATH=. python benchmarks/bench_serialize.py
+"""
+import os
+import pickle
+import tempfile
+import timeit
+
+import numpy as np
+
+from todloop.utils import serialize
+
+
+def from_mask(mask):
+    d = np.diff(np.hstack([0, mask.astype(np.int8), 0]))
+    return np.vstack([np.flatnonzero(d == 1), np.flatnonzero(d == -1)]).T.astype(np.int32)
+
+
+def make_outputs(rng):
+    """Outputs shaped like the ones of CompileCuts, FindCosigs and a
+    per-event analysis"""
+    nsamps = 250000
+    cuts = [from_mask(rng.rand(nsamps) < 1e-3) for _ in range(1056)]
+    cosig = dict((str(p), from_mask(rng.rand(nsamps) < 2e-4)) for p in range(250))
+    events = [{'start': int(s), 'end': int(s) + 20, 'pixels': list(range(10)),
+               'amplitudes': rng.randn(10, 20)} for s in rng.randint(0, nsamps, 200)]
+    tod = {'data': rng.randn(64, 20000).astype(np.float32),
+           'mask': (rng.rand(64, 20000) < 0.01)}
+    return [("cuts", {'cuts': cuts, 'nsamps': nsamps}),
+            ("cosig", {'cosig': cosig, 'nsamps': nsamps}),
+            ("events", events),
+            ("tod", tod)]
+
+
+def main():
+    rng = np.random.RandomState(0)
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, "out")
+    print("%-8s %-12s %10s %10s %10s" % ("output", "format", "size (kB)",
+                                         "save (ms)", "load (ms)"))
+    for name, obj in make_outputs(rng):
+        def save_pickle():
+            with open(filename, "wb") as f:
+                pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+
+        def load_pickle():
+            with open(filename, "rb") as f:
+                return pickle.load(f)
+        formats = [("pickle", save_pickle, load_pickle)]
+        for compression in [None, "zlib", "lzma"]:
+            formats.append(("npk/%s" % compression,
+                            lambda c=compression: serialize.dump(obj, filename, compression=c),
+                            lambda: serialize.load(filename)))
+        for fmt, save, load in formats:
+            n_iter = 3
+            t_save = timeit.timeit(save, number=n_iter) / n_iter
+            size = os.path.getsize(filename)
+            t_load = timeit.timeit(load, number=n_iter) / n_iter
+            print("%-8s %-12s %10.1f %10.1f %10.1f" % (name, fmt, size / 1e3,
+                                                       t_save * 1e3, t_load * 1e3))
+    os.remove(filename)
+    os.rmdir(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Compare the per-detector distance scan formerly used to find the
+adjacent detectors in PixelReader with the GridIndex radius query.
+
+Usage: PYTHONPATH=. python benchmarks/bench_spatial.py
+"""
+import timeit
+
+import numpy as np
+
+from todloop.utils.spatial import GridIndex
+
+
+def adjacency_loop(ar, dist2):
+    adj_dets = []
+    for i in range(len(ar)):
+        dis = np.sum((ar - ar[i, :])**2, axis=1)
+        adj_dets.append(np.flatnonzero((dis < dist2) & (dis > 0)).tolist())
+    return adj_dets
+
+
+def adjacency_grid(ar, dist2):
+    index = GridIndex(ar, np.sqrt(dist2))
+    indices, offsets, dist = index.query_radius(ar, np.sqrt(dist2), return_distance=True)
+    keep = dist > 0
+    return indices[keep], np.concatenate([[0], np.cumsum(keep)])[offsets]
+
+
+def main():
+    rng = np.random.RandomState(0)
+    print("%8s %14s %14s %8s" % ("ndet", "loop (ms)", "grid (ms)", "speedup"))
+    for ndet in [1056, 4096, 16384]:
+        # 4 detectors per position on a jittered hexagonal-ish grid
+        side = int(np.ceil(np.sqrt(ndet / 4.)))
+        x, y = np.meshgrid(np.arange(side), np.arange(side))
+        pos = np.vstack([x.ravel() + 0.5 * (y.ravel() % 2), y.ravel() * 0.87]).T
+        pos = np.repeat(pos[:ndet // 4] * 0.5, 4, axis=0)
+        pos += rng.rand(*pos.shape) * 1e-3
+        indices, offsets = adjacency_grid(pos, 0.6)
+        expected = adjacency_loop(pos, 0.6)
+        assert all(indices[offsets[i]:offsets[i+1]].tolist() == expected[i]
+                   for i in range(len(pos)))
+        n_iter = 3
+        t_loop = timeit.timeit(lambda: adjacency_loop(pos, 0.6), number=n_iter) / n_iter
+        t_grid = timeit.timeit(lambda: adjacency_grid(pos, 0.6), number=n_iter) / n_iter
+        print("%8d %14.1f %14.1f %8.1f" % (ndet, t_loop * 1e3, t_grid * 1e3,
+                                           t_loop / t_grid))
+
+
+if __name__ == "__main__":
+    main()
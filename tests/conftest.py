@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""A stand-in for moby2 so that routines depending on it can be tested
+without the ACT software stack. It is installed in sys.modules by the
+fake_moby2 fixture."""
+
+import sys
+import types
+
+import numpy as np
+import pytest
+
+
+class CutsVector(np.ndarray):
+    def __new__(cls, cuts_in=None, nsamps=None):
+        if cuts_in is None:
+            cuts_in = np.zeros((0, 2))
+        cv = np.asarray(cuts_in, dtype='int32').reshape(-1, 2).view(cls)
+        cv.nsamps = nsamps
+        return cv
+
+    def __array_finalize__(self, obj):
+        self.nsamps = getattr(obj, 'nsamps', None)
+
+    def get_mask(self, nsamps=None):
+        mask = np.zeros(nsamps or self.nsamps, dtype=bool)
+        for start, end in self:
+            mask[start:end] = True
+        return mask
+
+    @classmethod
+    def from_mask(cls, mask):
+        d = np.diff(np.hstack([0, np.asarray(mask).astype(np.int8), 0]))
+        return cls(np.vstack([np.flatnonzero(d == 1), np.flatnonzero(d == -1)]).T,
+                   len(mask))
+
+
+class TODCuts(object):
+    def __init__(self, nsamps=None, det_uid=None, sample_offset=0):
+        self.nsamps = nsamps
+        self.det_uid = np.asarray(det_uid)
+        self.sample_offset = sample_offset
+        self.cuts = [CutsVector(None, nsamps) for _ in self.det_uid]
+
+
+def make_array_data(n_pixels=12):
+    """A small array: 4 TES per position (2 freqs x 2 pols), some
+    missing, on a grid of spacing 0.5, plus dark detectors at (0, 0)"""
+    x, y, freq, det_type = [], [], [], []
+    for p in range(n_pixels):
+        n_tes = 4 - (p % 5 == 3) - (p % 7 == 2)
+        for i in range(n_tes):
+            x.append(p % 4)
+            y.append(p // 4)
+            freq.append([90, 90, 150, 150][i])
+            det_type.append('tes')
+        if p % 6 == 1:  # a dark detector sharing the position
+            x.append(p % 4)
+            y.append(p // 4)
+            freq.append(0)
+            det_type.append('dark_tes')
+    for i in range(5):
+        x.append(0)
+        y.append(0)
+        freq.append(0)
+        det_type.append('dark_squid')
+    # shift the TES away from (0, 0) and shuffle the detectors
+    order = np.random.RandomState(0).permutation(len(x))
+    n = len(x)
+    shift = (np.array(det_type) != 'dark_squid').astype(float)
+    return {
+        'det_uid': np.arange(n),
+        'array_x': (0.5 * np.array(x) + shift)[order],
+        'array_y': (0.5 * np.array(y) + shift)[order],
+        'nom_freq': np.array(freq)[order],
+        'det_type': np.array(det_type)[order],
+        'row': np.arange(n) // 8,
+        'col': np.arange(n) % 8,
+        'optical_sign': np.ones(n),
+    }
+
+
+class TOD(object):
+    """A TOD holding the rows of det_uid and the samples from start"""
+    def __init__(self, data, det_uid, start=0):
+        self.data = data
+        self.det_uid = np.asarray(det_uid)
+        self.nsamps = data.shape[1]
+        self.ctime = 1e9 + (start + np.arange(self.nsamps)) / 400.
+        self.info = types.SimpleNamespace(array_data=make_array_data(),
+                                          sample_index=start)
+
+
+def make_tod_data(n_dets, nsamps=1000):
+    """The data of a whole TOD: a step on all detectors between samples
+    180 and 195, plus a ramp that tells the detectors apart"""
+    data = np.zeros((n_dets, nsamps)) + np.arange(n_dets)[:, None] * 1e-3
+    data[:, 180:195] += 1
+    return data
+
+
+def get_tod(params):
+    """Load the part of a TOD given by the det_uid, start and end options"""
+    n_dets = len(make_array_data()['det_uid'])
+    data = make_tod_data(n_dets)
+    det_uid = params.get('det_uid')
+    if det_uid is None:
+        det_uid = np.arange(n_dets)
+    start = params.get('start') or 0
+    end = params.get('end') or data.shape[1]
+    return TOD(data[det_uid, start:end], det_uid, start)
+
+
+def _make_moby2():
+    moby2 = types.ModuleType("moby2")
+    moby2.tod = types.ModuleType("moby2.tod")
+    moby2.scripting = types.ModuleType("moby2.scripting")
+    moby2.tod.CutsVector = CutsVector
+    moby2.tod.TODCuts = TODCuts
+    moby2.scripting.get_array_data = lambda info: make_array_data()
+    moby2.scripting.get_tod = get_tod
+    return moby2
+
+
+FAKE_MOBY2 = _make_moby2()
+
+
+@pytest.fixture
+def fake_moby2(monkeypatch):
+    """Install the moby2 stand-in"""
+    for name in ["moby2", "moby2.tod", "moby2.scripting"]:
+        monkeypatch.setitem(sys.modules, name, FAKE_MOBY2 if name == "moby2"
+                            else getattr(FAKE_MOBY2, name.split('.')[1]))
+    return FAKE_MOBY2
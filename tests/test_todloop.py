@@ -3,6 +3,9 @@
 
 """Tests for `todloop` package."""
 
+import os
+
+import numpy as np
 import pytest
 
 from click.testing import CliRunner
@@ -36,3 +39,749 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help  Show this message and exit.' in help_result.output
+
+
+class Counter(base.Routine):
+    """A routine that records the TODs it has seen"""
+    def initialize(self):
+        self.seen = []
+
+    def execute(self, store):
+        self.seen.append(self.get_id())
+
+
+def make_loop(tmpdir, n_tods=10):
+    tod_list = tmpdir.join("tods.txt")
+    tod_list.write("\n".join(["tod%d.ar3" % i for i in range(n_tods)]))
+    loop = base.TODLoop()
+    loop.add_tod_list(str(tod_list))
+    loop.set_output_dir(str(tmpdir))
+    return loop
+
+
+def test_run_parallel_dynamic(tmpdir):
+    """Dynamic scheduling over local ranks processes every TOD once"""
+    from todloop.parallel import run_local
+    loop = make_loop(tmpdir)
+    loop.add_routine(Counter())
+    run_local(lambda comm: loop.run_parallel(dynamic=True, batch_size=2,
+                                             comm=comm), 3)
+    done = tmpdir.join("done_list.txt").read().split()
+    assert sorted(done) == sorted(["tod%d.ar3" % i for i in range(10)])
+
+
+class GatheringCounter(Counter):
+    """A counter that merges what each worker has seen at finalize"""
+    def finalize(self):
+        seen = self.gather(self.seen)
+        if seen is not None:
+            self.seen = sorted([i for l in seen for i in l])
+
+
+class Crash(base.Routine):
+    """Kill the process working on TOD 3, like the OOM killer would"""
+    def execute(self, store):
+        if self.get_id() == 3:
+            os._exit(1)
+
+
+def test_run_parallel_dead_worker(tmpdir, monkeypatch):
+    """The master drops a worker whose process died instead of waiting
+    for it forever, and the other workers process the remaining TODs"""
+    from todloop.parallel import run_local, LocalComm
+    from todloop.utils.journal import load_journal, DONE
+    monkeypatch.setattr(LocalComm, "POLL_INTERVAL", 0.1)
+    loop = make_loop(tmpdir)
+    loop.add_routine(Crash())
+    run_local(lambda comm: loop.run_parallel(dynamic=True, comm=comm), 3)
+    # the lists of the dead rank are lost, but its journal records remain
+    journal = load_journal(str(tmpdir))
+    assert sorted(journal) == [i for i in range(10) if i != 3]
+    assert all(status == DONE for status in journal.values())
+    assert "tod3.ar3" not in loop._done_list
+
+
+def test_run_n_procs(tmpdir):
+    """The process pool mode merges bookkeeping and outputs in the parent"""
+    loop = make_loop(tmpdir)
+    counter = GatheringCounter()
+    loop.add_routine(counter)
+    loop.run(n_procs=3)
+    assert counter.seen == list(range(10))
+    assert sorted(loop._done_list) == ["tod%d.ar3" % i for i in range(10)]
+    assert loop.comm is None
+
+
+class Failing(Counter):
+    """A counter that fails on the TODs given"""
+    def __init__(self, fail_on):
+        Counter.__init__(self)
+        self._fail_on = fail_on
+
+    def execute(self, store):
+        Counter.execute(self, store)
+        if self.get_id() in self._fail_on:
+            raise ValueError("failed on purpose")
+
+
+def test_resume(tmpdir):
+    """A resumed run only processes the TODs missing from the journal"""
+    loop = make_loop(tmpdir)
+    loop.add_routine(Failing([3, 7]))
+    loop.run(end=6)
+    assert tmpdir.join("journal_0.txt").read().count("\n") == 6
+
+    loop = make_loop(tmpdir)
+    counter = Failing([])
+    loop.add_routine(counter)
+    loop.run(resume=True)
+    assert counter.seen == [6, 7, 8, 9]
+
+    loop = make_loop(tmpdir)
+    counter = Failing([])
+    loop.add_routine(counter)
+    loop.run(resume=True, retry_errors=True)
+    assert counter.seen == [3]
+
+
+class Upcoming(base.Routine):
+    """A routine that records the upcoming TODs"""
+    def initialize(self):
+        self.upcoming = {}
+
+    def execute(self, store):
+        self.upcoming[self.get_id()] = self.get_context().get_upcoming(2)
+
+
+def test_get_upcoming(tmpdir):
+    """Upcoming TODs follow the schedule and respect the skip list"""
+    loop = make_loop(tmpdir, n_tods=5)
+    loop.add_skip([2])
+    routine = Upcoming()
+    loop.add_routine(routine)
+    loop.run()
+    assert routine.upcoming == {0: [1], 1: [3], 3: [4], 4: []}
+    assert loop.get_name(3) == "tod3.ar3"
+
+
+class UpcomingBefore(Upcoming):
+    def execute(self, store):
+        self.upcoming[self.get_id()] = self.get_context().get_upcoming(3, before=self)
+
+
+def test_get_upcoming_selector(fake_moby2, tmpdir):
+    """Upcoming TODs leave out the ones that a selector before the
+    asking routine will veto"""
+    from todloop.tod import TODSelector
+    loop = make_loop(tmpdir, n_tods=6)
+    loop.add_routine(TODSelector(["tod0.ar3", "tod2.ar3", "tod5.ar3"]))
+    routine = UpcomingBefore()
+    loop.add_routine(routine)
+    loop.add_routine(TODSelector(["tod0.ar3", "tod2.ar3"]))  # after, not asked
+    loop.run()
+    assert routine.upcoming == {0: [2], 2: [5], 5: []}
+
+
+class VetoOdd(base.Routine):
+    """A routine that vetoes odd TODs"""
+    def execute(self, store):
+        store.set("data", [0] * 100)
+        if self.get_id() % 2:
+            self.veto()
+
+
+class Allocator(base.Routine):
+    def execute(self, store):
+        store.set("big", np.ones(2**22))  # 32 MB
+
+
+class TransientAllocator(base.Routine):
+    def execute(self, store):
+        big = np.ones(2**22)  # 32 MB, freed before returning
+        del big
+
+
+def test_profiling(tmpdir):
+    """Profiling records each routine and the routine that vetoed"""
+    import json
+    loop = make_loop(tmpdir, n_tods=4)
+    loop.add_routine(VetoOdd())
+    loop.add_routine(Counter())
+    loop.enable_profiling()
+    loop.run()
+    records = json.loads(tmpdir.join("profile.json").read())
+    assert [r['vetoed_by'] for r in records] == [None, 'VetoOdd', None, 'VetoOdd']
+    assert [len(r['routines']) for r in records] == [2, 1, 2, 1]
+    assert records[0]['routines'][0]['store_nbytes'] > 0
+    assert all(set(e) == {'name', 'wall', 'cpu', 'rss_delta', 'rss_peak',
+                          'store_nbytes'}
+               for r in records for e in r['routines'])
+    summary = tmpdir.join("profile_summary.txt").read()
+    assert "VetoOdd" in summary and "Counter" in summary
+
+    # the memory of a routine is measured for every TOD, not only for
+    # the first one that raised the peak
+    loop = make_loop(tmpdir, n_tods=3)
+    loop.add_routine(Allocator())
+    loop.add_routine(TransientAllocator())
+    loop.enable_profiling()
+    loop.run()
+    records = json.loads(tmpdir.join("profile.json").read())
+    assert all(r['routines'][0]['rss_delta'] > 2**24 for r in records)
+    assert all(r['routines'][0]['rss_peak'] > 2**24 for r in records)
+    # memory freed within the routine shows in the peak only
+    assert all(r['routines'][1]['rss_delta'] < 2**24 for r in records)
+    assert all(r['routines'][1]['rss_peak'] > 2**24 for r in records)
+
+
+class Producer(base.Routine):
+    def __init__(self, output_key):
+        base.Routine.__init__(self)
+        self._output_key = output_key
+        self.declare_keys(outputs=[output_key])
+
+    def execute(self, store):
+        store.set(self._output_key, np.zeros(100))
+
+
+class Consumer(base.Routine):
+    def __init__(self, input_key, output_key=None):
+        base.Routine.__init__(self)
+        self._input_key = input_key
+        self._output_key = output_key
+        self.declare_keys(inputs=[input_key],
+                          outputs=[output_key] if output_key else [])
+
+    def initialize(self):
+        self.keys = []
+
+    def execute(self, store):
+        self.keys.append(sorted(store.keys()))
+        data = store.get(self._input_key)
+        if self._output_key:
+            store.set(self._output_key, data * 2)
+
+
+def test_release_keys(tmpdir):
+    """Keys are dropped from the store after their last user"""
+    loop = make_loop(tmpdir, n_tods=1)
+    loop.add_routine(Producer("raw"))
+    loop.add_routine(Consumer("raw", "clean"))
+    last = Consumer("clean")
+    loop.add_routine(last)
+    loop.run()
+    assert last.keys == [["clean"]]
+
+    # an undeclared routine keeps everything alive
+    loop = make_loop(tmpdir, n_tods=1)
+    loop.add_routine(Producer("raw"))
+    loop.add_routine(Consumer("raw", "clean"))
+    loop.add_routine(Counter())
+    last = Consumer("clean")
+    loop.add_routine(last)
+    loop.run()
+    assert last.keys == [["clean", "raw"]]
+
+
+def test_data_store():
+    store = base.DataStore()
+    store.set("a", np.zeros(10))
+    store.set("b", 1)
+    assert store.nbytes("a") == 80
+    assert store.nbytes() >= 80
+    assert store.pop("b") == 1
+    store.release("a")
+    store.release("c")
+    assert store.keys() == []
+
+
+class Handshake(Consumer):
+    """Two of these only finish if they run at the same time"""
+    def __init__(self, input_key, mine, theirs):
+        Consumer.__init__(self, input_key)
+        self._mine = mine
+        self._theirs = theirs
+
+    def execute(self, store):
+        Consumer.execute(self, store)
+        self._mine.set()
+        assert self._theirs.wait(5)
+
+
+def test_concurrent_routines(tmpdir):
+    """Routines that only read the same key run concurrently, and a
+    veto stops the routines added after the vetoing one"""
+    import threading
+    from todloop.dag import build_dependencies
+    a, b = threading.Event(), threading.Event()
+    loop = make_loop(tmpdir, n_tods=2)
+    loop.add_routine(Producer("raw"))
+    loop.add_routine(Handshake("raw", a, b))
+    loop.add_routine(Handshake("raw", b, a))
+    loop.add_routine(VetoOdd())
+    last = Consumer("raw")
+    loop.add_routine(last)
+    loop.set_n_threads(2)
+    assert build_dependencies(loop._routines) == \
+        [set(), {0}, {0}, {0, 1, 2}, {0, 3}]
+    loop.run()
+    assert len(loop._done_list) == 2
+    assert len(last.keys) == 1
+
+
+def test_in_place_routines(fake_moby2):
+    """Routines that modify the TOD in place are ordered before the
+    other readers of the TOD"""
+    from todloop.dag import build_dependencies
+    from todloop.tod import TODLoader, FixOpticalSign
+    from todloop.cuts import CleanTOD, CompileCuts
+    from todloop.routines import SaveData
+    routines = [TODLoader(), FixOpticalSign(), CleanTOD("tod_data", "tod_clean"),
+                CompileCuts("tod_clean", {}, "cuts"), SaveData("tod_data", "tods")]
+    deps = build_dependencies(routines)
+    assert deps[2] == {0, 1}
+    assert deps[3] == {2} and deps[4] == {0, 1, 2}
+
+
+class CountingProducer(Producer):
+    def initialize(self):
+        self.n_calls = 0
+
+    def execute(self, store):
+        self.n_calls += 1
+        Producer.execute(self, store)
+
+
+def test_cached_routine(tmpdir):
+    """Outputs are restored from the cache on a rerun"""
+    from todloop.routines import CachedRoutine
+    cache_dir = str(tmpdir.join("cache"))
+
+    def run(max_bytes=None):
+        loop = make_loop(tmpdir, n_tods=3)
+        producer = CountingProducer("raw")
+        cached = CachedRoutine(producer, cache_dir=cache_dir, max_bytes=max_bytes)
+        loop.add_routine(cached)
+        last = Consumer("raw")
+        loop.add_routine(last)
+        loop.run()
+        assert last.keys == [["raw"]] * 3
+        return producer, cached
+
+    producer, _ = run()
+    assert producer.n_calls == 3
+    producer, cached = run()
+    assert producer.n_calls == 0
+    cached.invalidate("tod1.ar3")
+    producer, cached = run()
+    assert producer.n_calls == 1
+    cached.invalidate()
+    producer, cached = run(max_bytes=1000)
+    assert producer.n_calls == 3
+    assert len(tmpdir.join("cache").listdir()[0].listdir()) == 1
+    with pytest.raises(ValueError):
+        CachedRoutine(Counter())
+
+
+def test_memory_budget(tmpdir, monkeypatch):
+    """TODs that don't fit in the budget are postponed"""
+    from todloop.utils import memory
+    monkeypatch.setattr(memory, "node_memory_used", lambda: 1000)
+    sizes = [500, 100, 100, 100]
+    loop = make_loop(tmpdir, n_tods=4)
+    counter = Counter()
+    loop.add_routine(counter)
+    loop.set_memory_budget(1200, estimator=lambda i: sizes[i], max_wait=0,
+                           ledger=str(tmpdir.join("ledger")))
+    loop.run()
+    assert counter.seen == [1, 2, 3, 0]
+
+
+class Misbehaving(base.Routine):
+    """A routine that hangs, crashes or fails depending on the TOD"""
+    def execute(self, store):
+        import os, signal, time
+        tod_id = self.get_id()
+        if tod_id == 1:
+            time.sleep(30)
+        elif tod_id == 2:
+            os.kill(os.getpid(), signal.SIGSEGV)
+        elif tod_id == 3:
+            raise ValueError("failed on purpose")
+
+
+def test_isolation(tmpdir):
+    """Hanging, crashing and failing TODs are recorded as errors, the
+    profiling records of the children are kept, and nothing is
+    prefetched"""
+    import json
+    from todloop.routines import DataLoader
+    loop = make_loop(tmpdir, n_tods=5)
+    loop.add_routine(Misbehaving())
+    loop.add_routine(VetoOdd())
+    loop.set_isolation(timeout=2)
+    loop.enable_profiling()
+    loop.run()
+    assert loop._done_list == ["tod0.ar3", "tod4.ar3"]
+    assert loop._error_list == ["tod1.ar3", "tod2.ar3", "tod3.ar3"]
+    records = json.loads(tmpdir.join("profile.json").read())
+    assert [[e['name'] for e in r['routines']] for r in records] == \
+        [["Misbehaving", "VetoOdd"], [], [], ["Misbehaving"], ["Misbehaving", "VetoOdd"]]
+    loader = DataLoader(str(tmpdir), prefetch=2)
+    loop.add_routine(loader)
+    loader.initialize()
+    assert loader._prefetcher is None
+
+
+class IdProducer(base.Routine):
+    """A routine that stores data depending on the TOD"""
+    def execute(self, store):
+        store.set("data", {"id": self.get_id(), "x": np.arange(self.get_id() + 1)})
+
+
+class Collector(base.Routine):
+    def initialize(self):
+        self.data = {}
+
+    def execute(self, store):
+        self.data[self.get_id()] = store.get("data")
+
+
+def test_output_container(tmpdir):
+    """Outputs are appended to one shard per rank, read back by tod_id
+    and merged by the compaction"""
+    from todloop.parallel import run_local
+    from todloop.routines import SaveData, DataLoader
+    out_dir = str(tmpdir.join("out"))
+
+    loop = make_loop(tmpdir, n_tods=6)
+    loop.add_routine(IdProducer())
+    loop.add_routine(SaveData("data", out_dir, container=True))
+    run_local(lambda comm: loop.run_parallel(dynamic=True, comm=comm), 3)
+    shards = sorted(f.basename for f in tmpdir.join("out").listdir())
+    assert not [f for f in shards if f.endswith(".pickle")]
+    assert "shard_1.dat" in shards and "shard_0.dat" not in shards
+
+    def load():
+        loop = make_loop(tmpdir, n_tods=7)
+        loop.add_routine(DataLoader(out_dir, container=True))
+        collector = Collector()
+        loop.add_routine(collector)
+        loop.run()
+        return collector.data
+    data = load()
+    assert sorted(data) == list(range(6))
+    assert all(np.array_equal(data[i]["x"], np.arange(i + 1)) for i in data)
+
+    loop = make_loop(tmpdir, n_tods=7)
+    loop.add_routine(IdProducer())
+    loop.add_routine(SaveData("data", out_dir, container=True, compact=True))
+    loop.run(start=6)
+    shards = sorted(f.basename for f in tmpdir.join("out").listdir())
+    assert shards == [".metadata", "shard_merged.dat", "shard_merged.idx"]
+    data = load()
+    assert sorted(data) == list(range(7))
+    assert np.array_equal(data[6]["x"], np.arange(7))
+
+
+class Unpicklable(base.Routine):
+    """A routine that stores data that cannot be saved for some TODs"""
+    def execute(self, store):
+        tod_id = self.get_id()
+        store.set("data", {"id": tod_id, "f": (lambda: 0) if tod_id == 2 else None})
+
+
+def test_async_output(tmpdir):
+    """Outputs written in the background match synchronous writes, and
+    failed writes are recorded as errors"""
+    from todloop.routines import SaveData
+    from todloop.utils.journal import Journal, load_journal, DONE, ERROR, WRITE_ERROR
+    import pickle
+    out_dir = tmpdir.join("out")
+    loop = make_loop(tmpdir, n_tods=5)
+    loop.add_routine(Unpicklable())
+    loop.add_routine(SaveData("data", str(out_dir)))
+    loop.set_async_output(max_queue=1)
+    loop.run()
+    assert loop.get_writer() is None
+    assert loop._error_list == ["tod2.ar3"]
+    assert "tod2.ar3" not in loop._done_list
+    assert load_journal(str(tmpdir)) == {0: DONE, 1: DONE, 2: ERROR, 3: DONE, 4: DONE}
+    for i in [0, 1, 3, 4]:
+        with open(str(out_dir.join("%d.pickle" % i)), "rb") as f:
+            assert pickle.load(f) == {"id": i, "f": None}
+    assert out_dir.join(".metadata").check()
+
+    # a retry that writes the outputs is done, even on another rank
+    loop = make_loop(tmpdir, n_tods=5)
+    loop.add_routine(IdProducer())
+    loop.add_routine(SaveData("data", str(out_dir)))
+    loop.set_async_output()
+    loop.run(resume=True, retry_errors=True)
+    assert loop._done_list == ["tod2.ar3"]
+    assert load_journal(str(tmpdir))[2] == DONE
+    journal = Journal(str(tmpdir), rank=1)
+    journal.record(4, "tod4.ar3", DONE)
+    journal.record(4, "tod4.ar3", WRITE_ERROR)
+    journal.close()
+    assert load_journal(str(tmpdir))[4] == DONE
+    journal = Journal(str(tmpdir), rank=1)
+    journal.record(5, "tod5.ar3", DONE)
+    journal.record(5, "tod5.ar3", WRITE_ERROR)
+    journal.close()
+    assert load_journal(str(tmpdir))[5] == ERROR
+
+
+def test_npk_outputs(tmpdir):
+    """Outputs saved with the numpy-aware serializer are read back by
+    DataLoader, as files or in a container"""
+    from todloop.routines import SaveData, DataLoader
+    for container in [False, True]:
+        out_dir = str(tmpdir.join("npk%d" % container))
+        loop = make_loop(tmpdir, n_tods=3)
+        loop.add_routine(IdProducer())
+        saver = SaveData("data", out_dir, container=container)
+        saver.set_serializer("npk", compression="zlib")
+        loop.add_routine(saver)
+        loop.run()
+        assert tmpdir.join("npk%d" % container, "0.npk").check() != container
+
+        loop = make_loop(tmpdir, n_tods=3)
+        loop.add_routine(DataLoader(out_dir, postfix="npk", container=container))
+        collector = Collector()
+        loop.add_routine(collector)
+        loop.run()
+        assert sorted(collector.data) == [0, 1, 2]
+        assert np.array_equal(collector.data[2]["x"], np.arange(3))
+    with pytest.raises(ValueError):
+        saver.set_serializer("json")
+
+
+def test_data_loader_prefetch(tmpdir):
+    """DataLoader indexes the input directory once and loads the next
+    files on a background thread"""
+    import threading
+    from todloop.routines import SaveData, DataLoader
+    out_dir = str(tmpdir.join("out"))
+    loop = make_loop(tmpdir, n_tods=5)
+    loop.add_routine(IdProducer())
+    saver = SaveData("data", out_dir)
+    saver.set_serializer("npk")
+    loop.add_routine(saver)
+    loop.run(end=4)
+    tmpdir.join("out", "2.npk").remove()
+
+    class ThreadLoader(DataLoader):
+        def initialize(self):
+            DataLoader.initialize(self)
+            self.threads = []
+
+        def load(self, i):
+            self.threads.append(threading.current_thread().name)
+            return DataLoader.load(self, i)
+
+    loop = make_loop(tmpdir, n_tods=5)
+    loader = ThreadLoader(out_dir, postfix="npk", prefetch=2, lazy=True)
+    loop.add_routine(loader)
+    collector = Collector()
+    loop.add_routine(collector)
+    loop.run()
+    assert sorted(loader._files) == [0, 1, 3]
+    assert sorted(collector.data) == [0, 1, 3]
+    assert collector.data[3].loaded() == []
+    assert collector.data[3]["id"] == 3
+    main = threading.current_thread().name
+    assert loader.threads[0] == main and main not in loader.threads[1:]
+
+    np.save(str(tmpdir.join("out", "0.npy")), np.arange(10))
+    loop = make_loop(tmpdir, n_tods=1)
+    loop.add_routine(DataLoader(out_dir, postfix="npy", mmap_mode="r"))
+    collector = Collector()
+    loop.add_routine(collector)
+    loop.run()
+    assert isinstance(collector.data[0], np.memmap)
+
+
+def get_glitch_cuts(tod, params=None):
+    """Cut the samples above a threshold"""
+    import moby2
+    cuts = moby2.tod.TODCuts(nsamps=tod.nsamps, det_uid=tod.det_uid,
+                             sample_offset=tod.info.sample_index)
+    cuts.cuts = [moby2.tod.CutsVector.from_mask(row > 0.5) for row in tod.data]
+    return cuts
+
+
+class GlitchCuts(base.Routine):
+    """Cut the samples above a threshold, like CompileCuts"""
+    def __init__(self):
+        base.Routine.__init__(self)
+        self.declare_requirements(dets=[], samples=[])
+
+    def execute(self, store):
+        tod = store.get("tod_data")
+        store.set("cuts", {'cuts': get_glitch_cuts(tod), 'nsamps': tod.nsamps})
+
+
+class Snapshot(Collector):
+    def __init__(self):
+        Collector.__init__(self)
+        self.declare_requirements(dets=[], samples=[])
+
+    def execute(self, store):
+        self.data[self.get_id()] = [store.get(k) for k in ["tod_data", "cosig", "events"]]
+
+
+def test_partial_loading(fake_moby2, monkeypatch, tmpdir):
+    """TODLoader only loads the detectors and samples declared by the
+    routines after it, and the cosigs and events are the same as with
+    the whole TOD. A routine that declares nothing gets the whole TOD"""
+    from todloop.tod import TODLoader, FixOpticalSign
+    from todloop.cosig import FindCosigs, FindEvents
+    requests = []
+    get_tod = fake_moby2.scripting.get_tod
+
+    def record_get_tod(params):
+        requests.append(params)
+        return get_tod(params)
+    monkeypatch.setattr(fake_moby2.scripting, "get_tod", record_get_tod)
+    tod_list = tmpdir.join("tods.txt")
+    tod_list.write("\n".join([str(tmpdir.join("tod%d.ar3.zip" % i))
+                              for i in range(3)]))
+
+    def run(partial, extra=None):
+        loop = base.TODLoop()
+        loop.add_tod_list(str(tod_list), abspath=True)
+        loop.set_output_dir(str(tmpdir))
+        loop.add_routine(TODLoader(partial=partial, prefetch=1))
+        loop.add_routine(FixOpticalSign())
+        window = base.Routine()
+        window.declare_requirements(dets=[], samples=[(150, 300)])
+        loop.add_routine(window)
+        loop.add_routine(GlitchCuts())
+        # cosigs are looked for in a window of the TOD
+        cosigs = FindCosigs(save=False, output_dir=str(tmpdir.join("cosigs")))
+        cosigs.declare_requirements(samples=[(100, 200)])
+        loop.add_routine(cosigs)
+        loop.add_routine(FindEvents())
+        if extra:
+            loop.add_routine(extra)
+        snapshot = Snapshot()
+        loop.add_routine(snapshot)
+        loop.run()
+        return loop, snapshot.data
+
+    _, full = run(partial=False)
+    assert all('det_uid' not in r and 'start' not in r for r in requests)
+    del requests[:]
+    loop, partial = run(partial=True)
+    assert len(requests) == 3
+    dets, samples = loop.get_requirements(0, after=loop._routines[0])
+    assert samples == (100, 300)
+    for r in requests:
+        assert r['det_uid'].tolist() == dets.tolist()
+        assert (r['start'], r['end']) == (100, 300)
+    n_dets = len(full[0][0].det_uid)
+    assert 0 < len(dets) < n_dets
+
+    for i in range(3):
+        tod, cosig, events = partial[i]
+        full_tod, full_cosig, full_events = full[i]
+        assert tod.data.shape == (len(dets), 200)
+        assert np.array_equal(tod.data, full_tod.data[dets, 100:300])
+        assert cosig['sample_offset'] == 100
+        assert sorted(cosig['cosig']) == sorted(full_cosig['cosig'])
+        for p, cv in cosig['cosig'].items():
+            assert np.array_equal(cv + 100, full_cosig['cosig'][p])
+        assert events['events']
+        assert [(e['id'], e['start'], e['end'], e['pixels_affected'])
+                for e in events['events']] == \
+            [(e['id'], e['start'], e['end'], e['pixels_affected'])
+             for e in full_events['events']]
+
+    del requests[:]
+    loop, _ = run(partial=True, extra=Counter())
+    assert loop.get_requirements(0, after=loop._routines[0]) == (None, None)
+    assert all('det_uid' not in r and 'start' not in r for r in requests)
+
+
+def test_get_array(fake_moby2, monkeypatch, tmpdir):
+    """The array is found in TOD names with and without .zip, also by
+    the routines asking for their pixels"""
+    from todloop.cosig import FindCosigs
+    from todloop.utils import pixels
+    arrays = []
+    make_array_data = fake_moby2.scripting.get_array_data
+
+    def get_array_data(info):
+        arrays.append(info['array_name'])
+        return make_array_data(info)
+    monkeypatch.setattr(fake_moby2.scripting, "get_array_data", get_array_data)
+    monkeypatch.setattr(pixels, "_readers", {})
+    tod_list = tmpdir.join("tods.txt")
+    tod_list.write("1404202980.1404202998.ar1\n1404202980.1404202998.ar2.zip")
+    loop = base.TODLoop()
+    loop.add_tod_list(str(tod_list))
+    cosigs = FindCosigs(save=False)
+    loop.add_routine(cosigs)
+    assert [loop.get_array(i) for i in range(2)] == ["ar1", "ar2"]
+    assert [cosigs.get_array(i) for i in range(2)] == ["ar1", "ar2"]
+    for i in range(2):
+        assert len(cosigs.get_required_dets(i)) > 0
+    assert arrays == ["ar1", "ar2"]
+
+
+def test_cosig_pixel_selection(fake_moby2, monkeypatch):
+    """Pixels with more than two detectors in a frequency are not used"""
+    from todloop import cosig
+
+    class Reader(object):
+        def get_pixel_table(self):
+            return (np.array([10, 20, 30]),
+                    np.array([[1, 2, 3], [4, 5, -1], [11, -1, -1]]),
+                    np.array([[6, 7, -1], [8, 9, -1], [12, 13, -1]]))
+    monkeypatch.setattr(cosig, "get_pixel_reader", lambda **kwargs: Reader())
+    _, pixels, dets_f1, dets_f2 = cosig.FindCosigs()._get_pixel_groups("ar3")
+    assert pixels.tolist() == [20]
+    assert dets_f1.tolist() == [[4, 5]] and dets_f2.tolist() == [[8, 9]]
+    _, pixels, dets_f1, _ = cosig.FindCosigs(strict=False)._get_pixel_groups("ar3")
+    assert pixels.tolist() == [20, 30]
+    assert dets_f1.tolist() == [[4, 5], [11, -1]]
+
+
+class FakeTODProducer(base.Routine):
+    def execute(self, store):
+        import moby2
+        store.set("tod_data", moby2.scripting.get_tod({}))
+
+
+def test_csr_cuts_outputs(fake_moby2, monkeypatch, tmpdir):
+    """CSR cuts go through the output path: background writes and the
+    container"""
+    from todloop.cuts import CompileCuts
+    from todloop.routines import DataLoader
+    from todloop.utils.csrcuts import CSRCuts
+    monkeypatch.setattr(fake_moby2.tod, "get_glitch_cuts", get_glitch_cuts,
+                        raising=False)
+    expected = CSRCuts.from_todcuts(get_glitch_cuts(fake_moby2.scripting.get_tod({})))
+    for container in [False, True]:
+        out_dir = str(tmpdir.join("cuts%d" % container))
+        loop = make_loop(tmpdir, n_tods=3)
+        loop.add_routine(FakeTODProducer())
+        loop.add_routine(CompileCuts("tod_data", {}, out_dir, csr=True,
+                                     container=container))
+        loop.set_async_output()
+        loop.run()
+        assert len(loop._done_list) == 3
+        loop = make_loop(tmpdir, n_tods=3)
+        if container:
+            loop.add_routine(DataLoader(out_dir, output_key="data", container=True))
+        else:
+            loop.add_routine(DataLoader(out_dir, postfix="cuts.npy", output_key="data"))
+        collector = Collector()
+        loop.add_routine(collector)
+        loop.run()
+        assert sorted(collector.data) == [0, 1, 2]
+        for cuts in collector.data.values():
+            assert isinstance(cuts, CSRCuts)
+            assert np.array_equal(cuts.intervals, expected.intervals)
+            assert np.array_equal(cuts.offsets, expected.offsets)
@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `todloop.utils` package."""
+
+import threading
+
+import numpy as np
+import pytest
+
+from todloop.utils.prefetch import Prefetcher
+from todloop.utils.memory import nbytes
+
+
+def test_prefetcher():
+    """Items are loaded ahead on a background thread and stale ones dropped"""
+    loaded = []
+
+    def loader(i):
+        loaded.append((i, threading.current_thread().name))
+        return np.zeros(10)
+
+    prefetcher = Prefetcher(loader, depth=2)
+    assert prefetcher.get(0, 0).shape == (10,)
+    prefetcher.schedule([(1, (1,)), (2, (2,)), (3, (3,))])
+    assert prefetcher.get(1, 1).shape == (10,)
+    prefetcher.schedule([(3, (3,))])  # 2 is not needed anymore
+    assert prefetcher.get(3, 3).shape == (10,)
+    prefetcher.close()
+    assert loaded[0][1] == threading.current_thread().name
+    assert all(name != threading.current_thread().name for _, name in loaded[1:])
+    assert [i for i, _ in loaded if i == 3] == [3]
+
+
+def test_prefetcher_memory_cap():
+    """Nothing is loaded ahead beyond the memory cap"""
+    prefetcher = Prefetcher(lambda i: np.zeros(100), depth=3, max_bytes=1000)
+    prefetcher.get(0, 0)
+    prefetcher.schedule([(i, (i,)) for i in range(1, 4)])
+    assert len(prefetcher._futures) == 1
+    prefetcher.close()
+
+
+def test_nbytes():
+    class Obj(object):
+        pass
+    obj = Obj()
+    obj.data = np.zeros((4, 100))
+    obj.alias = obj.data
+    assert nbytes({'a': obj}) >= 3200
+    assert nbytes({'a': obj}) < 6400
+
+
+def to_mask(cuts, nsamps):
+    mask = np.zeros(nsamps, dtype=bool)
+    for start, end in cuts:
+        mask[start:end] = True
+    return mask
+
+
+def from_mask(mask):
+    d = np.diff(np.hstack([0, mask.astype(np.int8), 0]))
+    return np.vstack([np.flatnonzero(d == 1), np.flatnonzero(d == -1)]).T
+
+
+def random_cuts(rng, n, nsamps=1000):
+    starts = np.sort(rng.randint(0, nsamps - 20, n))
+    return np.vstack([starts, starts + rng.randint(0, 20, n)]).T
+
+
+def test_union_intersection():
+    """Interval union/intersection match the dense mask results"""
+    from todloop.utils.intervals import union, intersection
+    rng = np.random.RandomState(1)
+    for _ in range(200):
+        a = random_cuts(rng, rng.randint(0, 30))
+        b = random_cuts(rng, rng.randint(0, 30))
+        ma, mb = to_mask(a, 1000), to_mask(b, 1000)
+        assert np.array_equal(union(a, b), from_mask(ma | mb))
+        assert np.array_equal(intersection(a, b), from_mask(ma & mb))
+    # touching pieces are merged like in the mask
+    assert union([[0, 5]], [[5, 8]]).tolist() == [[0, 8]]
+    assert intersection([[0, 5], [5, 9]], [[2, 7]]).tolist() == [[2, 7]]
+
+
+def test_combine_groups():
+    """Batched group union/intersection match the pairwise results"""
+    from todloop.utils.intervals import (union, intersection, pack, unpack,
+                                         combine_groups)
+    rng = np.random.RandomState(2)
+    cuts = [from_mask(to_mask(random_cuts(rng, rng.randint(0, 20)), 1000))
+            for _ in range(50)]
+    groups = rng.randint(-1, 50, size=(100, 3))
+    intervals, offsets = pack(cuts)
+    for mode, op in [("union", union), ("intersection", intersection)]:
+        results = unpack(*combine_groups(intervals, offsets, groups, mode))
+        for group, result in zip(groups, results):
+            members = [cuts[i] for i in group if i >= 0]
+            if not members:
+                assert len(result) == 0
+                continue
+            expected = from_mask(to_mask(members[0], 1000))
+            for m in members[1:]:
+                expected = op(expected, m)
+            assert np.array_equal(result, expected)
+
+
+def test_csr_cuts(tmpdir):
+    """CSRCuts slices per detector and round-trips through .npy/.npz"""
+    from todloop.utils.csrcuts import CSRCuts
+    rng = np.random.RandomState(3)
+    cuts = [from_mask(to_mask(random_cuts(rng, rng.randint(0, 10)), 1000))
+            for _ in range(20)]
+    csr = CSRCuts.from_list(cuts, nsamps=1000, det_uid=np.arange(20) + 100)
+    assert csr.intervals.dtype == np.int32
+    for i in range(20):
+        assert np.array_equal(csr.cuts[i], cuts[i])
+    sub = csr.select([5, 2, 5])
+    assert sub.det_uid.tolist() == [105, 102, 105]
+    assert np.array_equal(sub[1], cuts[2])
+    assert np.array_equal(sub[2], cuts[5])
+    for name in ["cuts.npy", "cuts.npz"]:
+        filename = str(tmpdir.join(name))
+        csr.save(filename)
+        loaded = CSRCuts.load(filename)
+        assert loaded.nsamps == 1000
+        assert np.array_equal(loaded.det_uid, csr.det_uid)
+        assert all(np.array_equal(a, b) for a, b in zip(loaded, cuts))
+    # memory-mapped read-only
+    assert not CSRCuts.load(str(tmpdir.join("cuts.npy"))).intervals.flags.writeable
+
+
+def test_overlap_mask():
+    """The sweep drops the same intervals as comparing every pair"""
+    from todloop.utils.intervals import pack, overlap_mask
+
+    def remove_overlap_vector(original, to_remove, buff=0):
+        for row in to_remove:
+            original = original[(original[:, 1] < row[0]-buff) |
+                                (original[:, 0] > row[1]+buff)]
+        return original
+
+    rng = np.random.RandomState(4)
+    for buff in [0, 3]:
+        original = [random_cuts(rng, rng.randint(0, 30)) for _ in range(30)]
+        to_remove = [random_cuts(rng, rng.randint(0, 10)) for _ in range(30)]
+        intervals, offsets = pack(original)
+        overlap = overlap_mask(intervals, offsets, *pack(to_remove), buff=buff)
+        for i in range(30):
+            expected = remove_overlap_vector(original[i], to_remove[i], buff)
+            assert np.array_equal(original[i][~overlap[offsets[i]:offsets[i+1]]],
+                                  expected)
+
+
+def test_interval_index():
+    """The index finds the same pixels as scanning every sample"""
+    from todloop.utils.intervals import IntervalIndex
+
+    def pixels_affected_in_event(cs, event):
+        return sorted(set(int(p) for t in range(event[0], event[1]) for p in cs
+                          if any(c[0] <= t <= c[1] for c in cs[p])))
+
+    rng = np.random.RandomState(5)
+    cs = dict((str(p), random_cuts(rng, rng.randint(1, 10))) for p in range(40))
+    index = IntervalIndex.from_dict(cs)
+    edges = np.sort(rng.choice(1000, 40, replace=False))
+    starts, ends = edges[::2], edges[1::2]  # sorted, disjoint events
+    expected = [pixels_affected_in_event(cs, e) for e in zip(starts, ends)]
+    assert index.query_many(starts, ends) == expected
+    assert index.query_many(starts[::-1], ends[::-1]) == expected[::-1]
+    assert index.query(starts[0], ends[0]) == expected[0]
+
+
+def find_peaks_loop(hist):
+    """Reference implementation walking the histogram"""
+    last = 0
+    peaks = []
+    for i in range(len(hist)):
+        if hist[i] > 0 and last == 0:
+            peak_start = i
+        if hist[i] == 0 and last > 0:
+            peaks.append([peak_start, i, i - peak_start, max(hist[peak_start:i])])
+        last = hist[i]
+    return peaks
+
+
+def test_find_peaks():
+    from todloop.utils.events import find_peaks
+    rng = np.random.RandomState(6)
+    for _ in range(20):
+        hist = rng.randint(0, 4, 500) * (rng.rand(500) < 0.3)
+        assert find_peaks(hist) == find_peaks_loop(hist)
+    assert find_peaks([0, 1, 2, 0, 3]) == [[1, 3, 2, 2.]]
+    assert find_peaks([]) == []
+
+
+def test_cosig_histograms():
+    """The histograms match the previous fancy-indexing and a mask sum,
+    without modifying the cosig arrays"""
+    from todloop.utils.events import endpoint_histogram, coverage_histogram
+    rng = np.random.RandomState(7)
+    cosig = dict((str(p), from_mask(rng.rand(1000) < 0.05)) for p in range(30))
+    original = dict((p, cosig[p].copy()) for p in cosig)
+    expected = np.zeros(1000)
+    for p in cosig:
+        cuts = cosig[p].copy()
+        cuts[:, 1] = cuts[:, 1] - 1
+        expected[cuts] += 1
+    assert np.array_equal(endpoint_histogram(cosig, 1000), expected)
+    coverage = sum(to_mask(cosig[p], 1000).astype(int) for p in cosig)
+    assert np.array_equal(coverage_histogram(cosig, 1000), coverage)
+    assert all(np.array_equal(cosig[p], original[p]) for p in cosig)
+
+
+def pixel_dict_loop(ad):
+    """The pixel dict as built by PixelReader before it was vectorized"""
+    pos = np.vstack([ad['array_x'], ad['array_y']]).T
+    freqs = np.sort(np.unique(ad['nom_freq']))[1:]
+    pixel_dict = {}
+    for det_id in ad['det_uid']:
+        if np.all(pos[det_id, :] == [0, 0]) or ad['det_type'][det_id] != 'tes':
+            continue
+        dets = np.where(np.all(pos == pos[det_id, :], axis=1))[0]
+        pixel_dict[str(dets[0])] = {
+            'f1': [i for i in dets if ad['nom_freq'][i] == freqs[0]],
+            'f2': [i for i in dets if ad['nom_freq'][i] == freqs[1]]
+        }
+    return pixel_dict
+
+
+def test_pixel_reader(fake_moby2, monkeypatch):
+    """The pixel table matches the per-detector loop, and readers are
+    built once per season, array and mask"""
+    from todloop.utils import pixels
+    calls = []
+    make_array_data = fake_moby2.scripting.get_array_data
+
+    def get_array_data(info):
+        calls.append(info)
+        return make_array_data(info)
+    monkeypatch.setattr(fake_moby2.scripting, "get_array_data", get_array_data)
+    monkeypatch.setattr(pixels, "_readers", {})
+
+    pr = pixels.get_pixel_reader('2016', 'AR3')
+    expected = pixel_dict_loop(pr._array_data)
+    assert pr.generate_pixel_dict() == expected
+    assert pr.get_pixels() == [int(p) for p in expected]
+    for p in pr.get_pixels():
+        assert pr.get_f1(p) == expected[str(p)]['f1']
+        assert pr.get_f2(p) == expected[str(p)]['f2']
+    assert not pr.is_pixel(len(pr._array_data['det_uid']) + 1)
+    assert pixels.get_pixel_reader('2016', 'AR3') is pr
+    assert len(calls) == 1
+
+    mask = np.arange(len(pr._array_data['det_uid'])) % 3 != 0
+    masked = pixels.get_pixel_reader('2016', 'AR3', mask=mask.astype(int))
+    assert masked is not pr and len(calls) == 2
+    assert pixels.get_pixel_reader('2016', 'AR3', mask=mask.astype(int)) is masked
+    table, f1, f2 = masked.get_pixel_table()
+    for i, p in enumerate(table):
+        assert f1[i][f1[i] >= 0].tolist() == masked.get_f1(p)
+        assert f2[i][f2[i] >= 0].tolist() == masked.get_f2(p)
+        assert masked.get_f1(p) == [d for d in expected[str(p)]['f1'] if mask[d]]
+
+
+def test_grid_index():
+    """Radius and k-nearest queries match a brute force search"""
+    from todloop.utils.spatial import GridIndex, to_csr_matrix
+    rng = np.random.RandomState(3)
+    points = rng.rand(300, 2) * 10
+    # queries inside, around and far outside of the grid
+    queries = np.vstack([rng.rand(50, 2) * 14 - 2, points[:5],
+                         rng.rand(30, 2) * 60 - 25, [[-3, 5], [13, 5], [5, 40]]])
+    index = GridIndex(points, 0.7)
+    dist = np.sqrt(((queries[:, None, :] - points[None, :, :])**2).sum(axis=2))
+    for radius in [0.3, 1., 3.5, 8., 50.]:
+        indices, offsets = index.query_radius(queries, radius)
+        for i in range(len(queries)):
+            expected = np.flatnonzero(dist[i] < radius)
+            assert indices[offsets[i]:offsets[i+1]].tolist() == expected.tolist()
+    d, idx = index.query_knn(queries, 4)
+    assert np.array_equal(idx, np.argsort(dist, axis=1, kind='mergesort')[:, :4])
+    assert np.allclose(d, np.sort(dist, axis=1)[:, :4])
+    d, idx = GridIndex(points[:2], 1.).query_knn(queries[:3], 4)
+    assert np.all(idx[:, 2:] == -1) and np.all(np.isinf(d[:, 2:]))
+    small = GridIndex([[0, 0], [1, 0], [0, 1], [1, 1]], 0.5)
+    indices, offsets = small.query_radius([[-3, 0.5]], 5.)
+    assert indices.tolist() == [0, 1, 2, 3]
+    d, idx = small.query_knn([[-3, 0.5], [2, 9]], 2)
+    assert idx.tolist() == [[0, 2], [3, 2]]
+    pytest.importorskip("scipy")
+    indices, offsets = index.query_radius(queries, 1.)
+    matrix = to_csr_matrix(indices, offsets, len(points))
+    assert np.array_equal(matrix.toarray(), dist < 1.)
+
+
+def test_pixel_adjacency(fake_moby2):
+    """Adjacent detectors are the physical detectors closer than the
+    threshold, excluding the ones at the same position"""
+    from todloop.utils.pixels import PixelReader
+    pr = PixelReader()
+    ar = pr._array_pos
+    for det in range(len(ar)):
+        dis = np.sum((ar - ar[det])**2, axis=1)
+        expected = np.flatnonzero((dis < 0.6) & (dis > 0) & np.any(ar != 0, axis=1))
+        assert pr.get_adjacent_detectors(det) == expected.tolist()
+    pixel = pr.get_pixels()[0]
+    assert all(pr.is_pixel(p) for p in pr.get_adjacent_pixels(pixel))
+    assert pr.get_adjacent_pixels(pixel)
+    assert pixel in pr.get_pixels_within_radius(pixel, 1.5)
+    pytest.importorskip("scipy")
+    matrix = pr.get_adjacency_matrix()
+    assert matrix.shape == (len(ar), len(ar))
+    assert (matrix != matrix.T).nnz == 0
+
+
+def test_array_cache(tmpdir):
+    """Arrays are loaded memory-mapped, and a corrupted file is detected"""
+    from todloop.utils.arraycache import save_arrays, load_arrays
+    filename = str(tmpdir.join("cache", "arrays.npz"))
+    arrays = {'a': np.arange(1000) * 7, 'b': np.array(['tes', 'dark_tes']),
+              'c': np.zeros((0, 2)), 'd': np.array(0.6)}
+    save_arrays(filename, arrays, 1)
+    loaded = load_arrays(filename, 1)
+    assert sorted(loaded) == sorted(arrays)
+    assert all(np.array_equal(loaded[k], arrays[k]) for k in arrays)
+    assert not loaded['a'].flags.writeable
+    assert np.array_equal(load_arrays(filename, 1, mmap=False)['b'], arrays['b'])
+    with pytest.raises(ValueError):
+        load_arrays(filename, 2)
+
+    with open(filename, "rb") as f:
+        data = f.read()
+    i = data.index(arrays['a'].tobytes())
+    with open(filename, "r+b") as f:
+        f.seek(i + 8)
+        f.write(b'\x01')
+    with pytest.raises(ValueError):
+        load_arrays(filename, 1)
+
+
+def test_pixel_cache(fake_moby2, monkeypatch, tmpdir):
+    """A PixelReader loaded from the cache does not rebuild the pixels
+    and gives the same pixels and neighbors, and a cache built from other
+    array data is rebuilt"""
+    from todloop.utils.pixels import PixelReader
+    cache_dir = str(tmpdir.join("pixels"))
+    pr = PixelReader(cache_dir=cache_dir)
+    assert tmpdir.join("pixels", "pixels_2016_AR3.npz").check()
+
+    def build_pixels(self):
+        raise AssertionError("pixels built despite the cache")
+    with monkeypatch.context() as m:
+        m.setattr(PixelReader, "build_pixels", build_pixels)
+        cached = PixelReader(cache_dir=cache_dir)
+    assert cached.generate_pixel_dict() == pr.generate_pixel_dict()
+    assert all(cached.get_adjacent_detectors(d) == pr.get_adjacent_detectors(d)
+               for d in range(len(pr._array_pos)))
+    pixel = pr.get_pixels()[0]
+    assert cached.get_pixels_within_radius(pixel, 1.) == \
+        pr.get_pixels_within_radius(pixel, 1.)
+    assert np.array_equal(cached.get_x_y_array()[0], pr.get_x_y_array()[0])
+    assert not cached._f1.flags.writeable
+
+    # the array data changed since the cache was built
+    make_array_data = fake_moby2.scripting.get_array_data
+
+    def get_array_data(info):
+        array_data = make_array_data(info)
+        array_data['array_x'] = array_data['array_x'] * 2
+        return array_data
+    monkeypatch.setattr(fake_moby2.scripting, "get_array_data", get_array_data)
+    rebuilt = PixelReader(cache_dir=cache_dir)
+    assert np.array_equal(rebuilt.get_x_y_array()[0], pr.get_x_y_array()[0] * 2)
+    assert any(rebuilt.get_adjacent_detectors(d) != pr.get_adjacent_detectors(d)
+               for d in range(len(pr._array_pos)))
+    assert PixelReader(cache_dir=cache_dir).generate_pixel_dict() == \
+        rebuilt.generate_pixel_dict()
+
+
+def test_hist():
+    """Vectorized filling matches np.histogram, and histograms from
+    several ranks add up"""
+    from todloop.utils.hist import Hist1D, Hist2D
+    from todloop.parallel import run_local
+    rng = np.random.RandomState(1)
+    x = np.concatenate([rng.randn(1000), np.linspace(-2, 2, 41)])
+    y = rng.rand(len(x)) * 3
+    w = rng.rand(len(x))
+
+    h = Hist1D(-2, 2, 20)
+    h.fill_many(x)
+    expected, _ = np.histogram(x, bins=20, range=(-2, 2))
+    assert np.array_equal(h.hist, expected) and h.hist.dtype.kind == 'i'
+    h1 = Hist1D(-2, 2, 20)
+    for v in x:
+        h1.fill(v)
+    assert np.array_equal(h1.hist, expected)
+    hw = Hist1D(-2, 2, 20)
+    hw.fill_many(x, w)
+    assert np.allclose(hw.hist, np.histogram(x, bins=20, range=(-2, 2), weights=w)[0])
+
+    h2 = Hist2D(-2, 2, 8, 0, 3, 5)
+    h2.fill_many(x, y, w)
+    h2.fill(0.1, 0.1)
+    expected2 = np.histogram2d(x, y, bins=[8, 5], range=[[-2, 2], [0, 3]], weights=w)[0]
+    expected2[4, 0] += 1
+    assert np.allclose(h2.hist, expected2)
+    assert np.allclose((h2 + h2).hist, 2 * expected2)
+    with pytest.raises(ValueError):
+        h.add(Hist1D(-2, 2, 10))
+
+    def target(comm):
+        hist = Hist1D(-2, 2, 20)
+        hist.fill_many(x[comm.Get_rank()::3])
+        total = hist.reduce(comm)
+        return total.hist if total is not None else None
+    assert np.array_equal(run_local(target, 3), expected)
+
+
+def test_shards_newest_record(tmpdir):
+    """The newest record of a TOD wins, whichever shard it is in, also
+    after a compaction"""
+    from todloop.utils.shards import ShardWriter, ShardReader, compact_shards
+    directory = str(tmpdir)
+    for rank, value in [(2, "old"), (10, "new")]:
+        writer = ShardWriter(directory, rank)
+        writer.write(5, value)
+        writer.write(rank, value)
+        writer.close()
+    reader = ShardReader(directory)
+    assert reader.load(5) == "new"
+    reader.close()
+    assert compact_shards(directory) == 3
+    writer = ShardWriter(directory, 2)
+    writer.write(5, "rerun")
+    writer.close()
+    reader = ShardReader(directory)
+    assert [reader.load(i) for i in [2, 5, 10]] == ["old", "rerun", "new"]
+    reader.close()
+
+
+def test_serialize(tmpdir):
+    """Objects round trip with arrays stored out of band, compressed when
+    it pays off and memory-mapped when not compressed"""
+    import pickle
+    import struct
+    from todloop.utils import serialize
+    rng = np.random.RandomState(0)
+    obj = {
+        'cuts': np.arange(20000, dtype=np.int32).reshape(-1, 2),
+        'noise': rng.randn(10000),
+        'strided': np.arange(100)[::3],
+        'objects': np.array([None, 'a'], dtype=object),
+        'events': [{'start': 1, 'pixels': [1, 2]}],
+        'small': np.zeros(3),
+    }
+
+    def check(loaded):
+        assert sorted(loaded) == sorted(obj)
+        for key in ['cuts', 'noise', 'strided', 'small', 'objects']:
+            assert np.array_equal(loaded[key], obj[key])
+        assert loaded['events'] == obj['events']
+
+    def codecs(data):
+        n = struct.unpack_from("<5sBBQI", data)[4]
+        return [struct.unpack_from("<BQQQ", data, 19 + 25 * i)[0] for i in range(n)]
+
+    raw = serialize.dumps(obj)
+    check(serialize.loads(raw))
+    assert set(codecs(raw)) == {serialize.NONE}
+    packed = serialize.dumps(obj, compression="zlib")
+    assert len(packed) < len(raw) - 40000
+    check(serialize.loads(packed))
+    # the int cuts compress, the gaussian noise does not, the small
+    # array stays in the pickle stream
+    assert sorted(codecs(packed)) == [serialize.NONE, serialize.ZLIB]
+    check(serialize.loads(serialize.dumps(obj, compression="lzma")))
+    check(serialize.loads(pickle.dumps(obj)))
+
+    filename = str(tmpdir.join("obj.npk"))
+    serialize.dump(obj, filename, compression="zlib")
+    loaded = serialize.load(filename)
+    check(loaded)
+    assert not loaded['noise'].flags.writeable
+    assert loaded['cuts'].flags.writeable
+    assert serialize.load(filename, mmap=False)['noise'].flags.writeable
+
+
+def test_serialize_fields():
+    """Dicts saved by field can be loaded lazily"""
+    from todloop.utils import serialize
+    obj = {'cosig': {'1': np.arange(10)}, 'nsamps': 100, 'big': np.zeros(10000)}
+    data = serialize.dumps(obj, fields=True)
+    assert data.startswith(serialize.FIELDS_MAGIC)
+    loaded = serialize.loads(data)
+    assert isinstance(loaded, dict) and list(loaded) == list(obj)
+    assert np.array_equal(loaded['cosig']['1'], np.arange(10))
+    lazy = serialize.loads(data, lazy=True)
+    assert lazy['nsamps'] == 100 and len(lazy) == 3
+    assert lazy.loaded() == ['nsamps']
+    lazy['extra'] = 1
+    del lazy['big']
+    assert list(lazy) == ['cosig', 'nsamps', 'extra']
+    assert serialize.loads(serialize.dumps([1, 2], fields=True)) == [1, 2]
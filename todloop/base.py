@@ -1,8 +1,16 @@
-import gc, os, numpy as np
+import gc, os, time, resource, numpy as np
 from todloop.utils import append2file
+from todloop.utils.journal import Journal, load_journal, DONE, ERROR, WRITE_ERROR
+from todloop.utils.memory import nbytes, MemoryBudget
+from todloop.utils.writer import AsyncWriter
+from todloop.parallel import serve_tasks, request_tasks, run_local, TaskQueue, \
+    get_context
+from todloop.profiler import Profiler
+from todloop.dag import build_dependencies, execute_graph
 
 import logging
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s')
 
 class TODLoop:
@@ -15,6 +23,18 @@ class TODLoop:
         self._skip_list = []
         self._error_list = []
         self._done_list = []
+        self._journal = None
+        self._tasks = TaskQueue([])
+        self._profiler = None
+        self._release_plan = None
+        self._gc_collect = True
+        self._n_threads = 1
+        self._executor = None
+        self._deps = None
+        self._budget = None
+        self._isolation = None
+        self._async_output = None
+        self._writer = None
         self._tod_id = None
         self._tod_name = None
         self._fb = None
@@ -49,121 +69,517 @@ class TODLoop:
     def set_output_dir(self, output_dir):
         self._output_dir = output_dir
 
+    def set_gc_collect(self, gc_collect):
+        """Set whether gc.collect() runs after each TOD (default True).
+        With early release of keys, most memory is returned as soon as
+        the last reference is dropped, so it can often be turned off"""
+        self._gc_collect = gc_collect
+
+    def set_n_threads(self, n_threads):
+        """Run the routines of each TOD as a dependency graph on a pool
+        of n_threads threads, based on the keys declared by the routines.
+        Routines that only read the same keys run concurrently, while
+        routines that don't declare their keys or that may veto run
+        alone. This pays off when routines spend their time in numpy
+        code that releases the GIL"""
+        self._n_threads = n_threads
+
+    def set_memory_budget(self, max_bytes, estimator=None, lookahead=4,
+                          max_wait=600., poll=5., ledger=None):
+        """Limit the memory used on the node. Before starting a TOD, the
+        rank checks that the memory in use on the node plus the
+        estimated size of the TOD fits in the budget. If it doesn't,
+        it picks a smaller TOD among the next few, or waits
+        @par:
+            max_bytes: int - memory budget of the node
+            estimator: function - estimator(tod_id) returns the expected
+                       memory needed by a TOD in bytes. By default it's
+                       4 times the size of the TOD file
+            lookahead: int - number of upcoming TODs to choose from
+            max_wait: float - seconds to wait for memory before starting
+                      the next TOD anyway
+            poll: float - seconds between checks while waiting
+            ledger: string - node-local file used to share reservations
+                    between the ranks of a node"""
+        self._budget = MemoryBudget(max_bytes, ledger=ledger)
+        self._estimator = estimator or self._estimate_tod_size
+        self._lookahead = lookahead
+        self._max_wait = max_wait
+        self._poll = poll
+
+    def _estimate_tod_size(self, tod_id, expansion=4.):
+        """Estimate the memory needed by a TOD from its file size"""
+        try:
+            return os.path.getsize(self.get_filename(tod_id)) * expansion
+        except Exception:
+            return 0
+
+    def set_isolation(self, timeout=None, memory_limit=None):
+        """Run each TOD in a forked child process, so that a TOD that
+        hangs or crashes (e.g. segfaults in C code) is recorded as an
+        error and the rank moves on to the next one. Changes made by
+        the routines to their own state while executing a TOD are lost
+        with the child, outputs written to disk are kept. The profiling
+        records of the child are sent back. Prefetching is disabled,
+        since the TODs are loaded in the children
+        @par:
+            timeout: float - seconds after which the child is killed
+            memory_limit: int - limit of the address space of the child
+                          in bytes"""
+        self._isolation = {'timeout': timeout, 'memory_limit': memory_limit}
+
+    def is_isolated(self):
+        """Return whether TODs run in child processes (set_isolation)"""
+        return self._isolation is not None
+
+    def set_async_output(self, max_queue=8):
+        """Write the outputs of OutputRoutines (save_data, save_figure)
+        on a background thread instead of within execute. A failed
+        write marks its TOD as an error, and finalize waits for all
+        writes to be done
+        @par:
+            max_queue: int - maximum number of outputs waiting to be
+                       written, execute blocks beyond it"""
+        self._async_output = {'max_queue': max_queue}
+
+    def get_writer(self):
+        """Return the background writer, None if outputs are written
+        synchronously"""
+        return self._writer
+
+    def enable_profiling(self):
+        """Record the time and memory used by each routine on each TOD.
+        The records are written to profile.json and summarized in
+        profile_summary.txt in the output directory at finalize"""
+        self._profiler = Profiler()
+
     def initialize(self):
         """Initialize all routines"""
+        self._journal = Journal(self._output_dir, self.rank)
+        if self._async_output:
+            self._writer = AsyncWriter(**self._async_output)
         for routine in self._routines:
             routine.initialize()
+        self._release_plan = self._get_release_plan()
+        if self._n_threads > 1:
+            self._deps = build_dependencies(self._routines)
+            self._executor = ThreadPoolExecutor(max_workers=self._n_threads)
+
+    def _get_release_plan(self):
+        """Work out after which routine each key of the data store is
+        not needed anymore, based on the keys declared by the routines.
+        If any routine has not declared its keys, nothing is released
+        early since we cannot tell what it reads
+        @ret:
+            list of keys to release after each routine, or None"""
+        last_use = {}
+        for i, routine in enumerate(self._routines):
+            inputs = routine.get_input_keys()
+            outputs = routine.get_output_keys()
+            if inputs is None or outputs is None:
+                return None
+            for key in inputs + outputs:
+                last_use[key] = i
+        plan = [[] for _ in self._routines]
+        for key, i in last_use.items():
+            plan[i].append(key)
+        return plan
 
     def execute(self, store):
         """Execute all routines"""
-        for routine in self._routines:
-            # check veto signal, if received, skip subsequent routines
-            if self._veto:
-                break
+        try:
+            if self._executor:
+                self._execute_graph(store)
             else:
+                for i, routine in enumerate(self._routines):
+                    # check veto signal, if received, skip subsequent routines
+                    if self._veto:
+                        break
+                    self._execute_routine(routine, store)
+                    # free the keys that no later routine needs
+                    if self._release_plan:
+                        for key in self._release_plan[i]:
+                            store.release(key)
+        finally:
+            self._veto = False
+
+    def _execute_isolated(self, store):
+        """Execute all routines in a supervised child process"""
+        ctx = get_context()
+        reader, writer = ctx.Pipe(duplex=False)
+        p = ctx.Process(target=self._execute_child, args=(store, writer))
+        p.start()
+        writer.close()
+        timeout = self._isolation['timeout']
+        try:
+            if not reader.poll(timeout):
+                p.kill()
+                raise RuntimeError("TOD timed out after %s seconds" % timeout)
+            try:
+                error, profile = reader.recv()
+            except EOFError:  # child died without reporting
+                p.join()
+                raise RuntimeError("TOD crashed with exit code %s" % p.exitcode)
+        finally:
+            reader.close()
+            p.join()
+        if self._profiler and profile:
+            self._profiler.update_current(profile)
+        if error:
+            raise RuntimeError("TOD failed in child process:\n%s" % error)
+
+    def _execute_child(self, store, writer):
+        """Entry point of the child process running a TOD"""
+        error = None
+        try:
+            if self._isolation['memory_limit']:
+                limit = int(self._isolation['memory_limit'])
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+            # threads of the parent don't exist in the child
+            self._executor = None
+            self.execute(store)
+        except BaseException:
+            error = traceback.format_exc()
+        # report the profiling record of the TOD to the parent too
+        profile = self._profiler.get_current() if self._profiler else None
+        writer.send((error, profile))
+        writer.close()
+        os._exit(0)
+
+    def _execute_graph(self, store):
+        """Execute the routines concurrently following their dependencies.
+        Once a routine vetoes, no further routine is started"""
+        # count the users of each key to know when it can be released
+        users = {}
+        if self._release_plan:
+            for routine in self._routines:
+                for key in set(routine.get_input_keys() + routine.get_output_keys()):
+                    users[key] = users.get(key, 0) + 1
+
+        def on_done(i):
+            if not users:
+                return
+            routine = self._routines[i]
+            for key in set(routine.get_input_keys() + routine.get_output_keys()):
+                if key in users:
+                    users[key] -= 1
+                    if users[key] == 0:
+                        store.release(key)
+
+        execute_graph(self._deps, self._executor,
+                      lambda i: self._execute_routine(self._routines[i], store),
+                      lambda: self._veto, on_done)
+
+    def _execute_routine(self, routine, store):
+        """Execute a routine, with profiling if enabled"""
+        if self._profiler:
+            name = routine.__class__.__name__
+            with self._profiler.profile(name, store):
                 routine.execute(store)
-
-        self._veto = False
+            if self._veto:
+                self._profiler.set_vetoed_by(name)
+        else:
+            routine.execute(store)
 
     def finalize(self):
         """Finalize all routines"""
         # finalize all routines
         for routine in self._routines:
             routine.finalize()
+        if self._writer:
+            self._writer.close()
+            self._check_writer()
+            self._writer = None
+        self._journal.close()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
         # finalize the pipeline by dump useful stats
         self._dump_stats()
+        if self._profiler:
+            self._profiler.dump(self._output_dir, self.comm, self.rank)
 
-    def run(self, start=0, end=None):
+    def run(self, start=0, end=None, n_procs=1, resume=False,
+            retry_errors=False):
         """Main driver function to run the loop
         @param:
             start: starting tod_id (default 0)
-            end:   ending tod_id (default None)"""
+            end:   ending tod_id (default None)
+            n_procs: number of local worker processes (default 1). If
+                     more than one, TODs are handed out dynamically to
+                     forked workers, each with its own copy of the
+                     routines, and the done/error lists are merged back
+                     into this process at finalize
+            resume: skip the TODs recorded in the journal of a previous
+                    run in the output directory (default False)
+            retry_errors: when resuming, run the TODs that failed
+                          previously again (default False)"""
+        if n_procs > 1:
+            self._run_local(start, end, n_procs, resume, retry_errors)
+            return
 
         self.initialize()
         # if end is not provided, run all
         if not end:
             end = len(self._tod_list)
-        for tod_id in range(start, end):
-            if tod_id in self._skip_list:
-                self.logger.info('TOD: %d in the skip_list, skipping ...' % tod_id)
-                continue  # skip if in skip list
-            self._tod_id = tod_id
-            self._tod_name = self._tod_list[tod_id]
-            self.logger.info("TOD %d: %s" % (tod_id, self._tod_name))
-
-            # initialize data store
-            store = DataStore()
-            try:
-                self.execute(store)
-                self._done_list.append(self._tod_name)
-            except Exception as e:
-                self.logger.error("%s occurred, skipping..." % type(e))
-                self._error_list.append(self._tod_name)
-                traceback.print_exc()
+        self._loop(self._get_tasks(range(start, end), resume, retry_errors))
+        self.finalize()
 
-            # clean memory
-            gc.collect()
+    def _get_tasks(self, tod_ids, resume=False, retry_errors=False):
+        """Return the tod_ids that still need to be processed"""
+        tod_ids = list(tod_ids)
+        if not resume:
+            return tod_ids
+        status = load_journal(self._output_dir)
+        skip = [DONE] if retry_errors else [DONE, ERROR]
+        tasks = [i for i in tod_ids if status.get(i) not in skip]
+        self.logger.info("Resuming: %d of %d tods left" % (len(tasks), len(tod_ids)))
+        return tasks
+
+    def _run_local(self, start, end, n_procs, resume=False, retry_errors=False):
+        """Run the loop on a pool of local processes. This process acts
+        as the master (rank 0) and n_procs workers are forked from it"""
+        self.logger.info("Running with %d local processes" % n_procs)
+        run_local(lambda comm: self.run_parallel(start=start, end=end,
+                                                 dynamic=True, comm=comm,
+                                                 resume=resume,
+                                                 retry_errors=retry_errors),
+                  n_procs + 1)
+        self.comm = None
+        self.rank = 0
 
-        self.finalize()
+    def _loop(self, tod_ids):
+        """Process a sequence of tod_ids one after another"""
+        self._tasks = TaskQueue(tod_ids)
+        while True:
+            tod_id = self._next_task()
+            if tod_id is None:
+                break
+            self._process(tod_id)
+
+    def _next_task(self):
+        """Return the next tod_id to process, None if there is none left.
+        With a memory budget, the first of the upcoming TODs that fits
+        in the budget is taken"""
+        if not self._budget:
+            return next(self._tasks, None)
+        waited = 0
+        while True:
+            candidates = self._tasks.peek(self._lookahead)
+            if not candidates:
+                return None
+            for tod_id in candidates:
+                if tod_id in self._skip_list or \
+                   self._budget.try_reserve(self._estimator(tod_id)):
+                    return self._tasks.take(tod_id)
+            if waited >= self._max_wait:
+                self.logger.warning("No TOD fits in the memory budget after %ds, "
+                                 "starting the next one anyway" % waited)
+                return self._tasks.take(candidates[0])
+            time.sleep(self._poll)
+            waited += self._poll
+
+    def _process(self, tod_id):
+        """Process a single TOD and keep track of the outcome"""
+        if tod_id in self._skip_list:
+            self.logger.info('TOD: %d in the skip_list, skipping ...' % tod_id)
+            return  # skip if in skip list
+        self._tod_id = tod_id
+        self._tod_name = self._tod_list[tod_id]
+        self.logger.info("TOD %d: %s" % (tod_id, self._tod_name))
+
+        # initialize data store
+        store = DataStore()
+        if self._profiler:
+            self._profiler.start_tod(tod_id, self._tod_name)
+        try:
+            if self._isolation:
+                self._execute_isolated(store)
+            else:
+                self.execute(store)
+            status = DONE
+            self._done_list.append(self._tod_name)
+        except Exception as e:
+            self.logger.error("%s occurred, skipping..." % type(e))
+            status = ERROR
+            self._error_list.append(self._tod_name)
+            traceback.print_exc()
+        self._journal.record(tod_id, self._tod_name, status)
+        if self._profiler:
+            self._profiler.end_tod(status)
+        if self._writer:
+            self._check_writer()
+
+        # clean memory
+        if self._gc_collect:
+            gc.collect()
 
-    def run_parallel(self, start=0, end=None, n_workers=1):
+    def _check_writer(self):
+        """Record the TODs whose outputs failed to be written in the
+        background as errors"""
+        for (tod_id, tod_name), error in self._writer.pop_errors():
+            self.logger.error("Writing the outputs of %s failed:\n%s" % (tod_name, error))
+            if tod_name in self._done_list:
+                self._done_list.remove(tod_name)
+            if tod_name not in self._error_list:
+                self._error_list.append(tod_name)
+            self._journal.record(tod_id, tod_name, WRITE_ERROR)
+
+    def run_parallel(self, start=0, end=None, n_workers=1, dynamic=False,
+                     batch_size=1, comm=None, resume=False, retry_errors=False):
+        """Run the loop over MPI
+        @param:
+            start: starting tod_id (default 0)
+            end:   ending tod_id (default None)
+            n_workers: number of workers for static splitting
+            dynamic: if True, rank 0 acts as a master that hands out
+                     batches of tod_ids to the other ranks as they
+                     become idle, instead of splitting the range into
+                     fixed chunks
+            batch_size: number of tod_ids handed out per request in
+                        dynamic mode
+            comm: communicator to use, defaults to MPI.COMM_WORLD. A
+                  todloop.parallel.LocalComm can be passed to run
+                  without MPI
+            resume: skip the TODs recorded in the journal of a previous
+                    run in the output directory (default False)
+            retry_errors: when resuming, run the TODs that failed
+                          previously again (default False)"""
         n_total = len(self._tod_list)
-        self.logger.info("Distributing %d tods to %d workers" % \
-                         (n_total, n_workers))
         # setup mpi
-        from mpi4py import MPI
-        comm = MPI.COMM_WORLD
+        if comm is None:
+            from mpi4py import MPI
+            comm = MPI.COMM_WORLD
         size = comm.Get_size()
         rank = comm.Get_rank()
         self.comm = comm
         self.rank = rank
         self.logger.info("Node @ rank=%d\t size=%d" % (rank, size))
-        # distribute tasks
         if not end:
             end = n_total
-        tasks = np.array_split(np.arange(start, end), n_workers)
-        start = tasks[rank][0]
-        end = tasks[rank][-1]+1
-        self.run(start=start, end=end)
+
+        if not dynamic:
+            # distribute tasks
+            self.logger.info("Distributing %d tods to %d workers" % \
+                             (n_total, n_workers))
+            tasks = np.array_split(np.arange(start, end), n_workers)
+            start = tasks[rank][0]
+            end = tasks[rank][-1]+1
+            self.run(start=start, end=end, resume=resume,
+                     retry_errors=retry_errors)
+            return
+
+        self.initialize()
+        if size == 1:  # no one to hand tasks to, run them here
+            self._loop(self._get_tasks(range(start, end), resume, retry_errors))
+        elif rank == 0:
+            tasks = self._get_tasks(range(start, end), resume, retry_errors)
+            self.logger.info("Serving %d tods to %d workers" % \
+                             (len(tasks), size - 1))
+            serve_tasks(comm, tasks, batch_size)
+        else:
+            self._loop(request_tasks(comm, batch_size))
+        self.finalize()
 
     def veto(self):
         """Veto a TOD from subsequent routines"""
         self._veto = True
 
+    def is_vetoed(self):
+        """Return whether the current TOD has been vetoed"""
+        return self._veto
+
     def get_id(self):
         """Return the index of current TOD in the list"""
         return self._tod_id
 
-    def get_name(self):
-        """Return name of the TOD"""
+    def get_upcoming(self, n=1, before=None):
+        """Return the tod_ids of the next n TODs to be processed by
+        this rank (fewer if the list is running out), excluding those
+        in the skip list and those that a routine rejects (see
+        Routine.accepts)
+        @par:
+            before: Routine - only ask the routines added before it,
+                    e.g. a loader asks the selectors that run before it"""
+        routines = self._routines
+        if before in routines:
+            routines = routines[:routines.index(before)]
+        return [i for i in self._tasks.peek(n) if i not in self._skip_list and
+                all(r.accepts(i) for r in routines)]
+
+    def get_name(self, tod_id=None):
+        """Return name of the TOD, the current one by default"""
+        if tod_id is None:
+            tod_name = self._tod_name
+        else:
+            tod_name = self._tod_list[tod_id]
         # get metadata
         if self._abspath:
-            return os.path.basename(self._tod_name)
+            return os.path.basename(tod_name)
         else:
-            return self._tod_name
+            return tod_name
 
-    def get_filename(self):
+    def get_filename(self, tod_id=None):
+        """Return the filename of the TOD, the current one by default"""
         # check if we are looking at abspath or not
         if self._abspath:
-            return self._tod_name
+            if tod_id is None:
+                return self._tod_name
+            return self._tod_list[tod_id]
         else:
             # check if filebase is setup
             if self._fb:
-                return self._fb.filename_from_name(self.get_name(), single=True)
+                return self._fb.filename_from_name(self.get_name(tod_id), single=True)
             else:
                 from moby2.scripting import get_filebase
                 self._fb = get_filebase()
-                return self._fb.filename_from_name(self.get_name(), single=True)
+                return self._fb.filename_from_name(self.get_name(tod_id), single=True)
 
-    def get_array(self):
-        """Return name of the TOD"""
+    def get_array(self, tod_id=None):
+        """Return the array of the TOD, the current one by default"""
         # get metadata
-        fields = self._tod_name.split('.')
+        fields = self.get_name(tod_id).split('.')
         if 'ar' in fields[-1].lower():
             return fields[-1]
         else:  # end with zip
             return fields[-2]
 
+    def get_requirements(self, tod_id, after=None):
+        """Collect the detectors and samples of a TOD needed by the
+        routines, see Routine.declare_requirements
+        @par:
+            tod_id: int
+            after: Routine - only ask the routines added after it
+        @ret:
+            det_uid: sorted int array, None for all detectors
+            samples: (start, end) covering all the ranges needed, None
+                     for all samples"""
+        routines = self._routines
+        if after in routines:
+            routines = routines[routines.index(after) + 1:]
+        # like the release plan, a routine that doesn't declare what
+        # it needs is assumed to need everything
+        dets, ranges = [], []
+        for routine in routines:
+            required = routine.get_required_dets(tod_id)
+            if required is None:
+                dets = None
+            elif dets is not None:
+                dets = np.union1d(dets, required)
+            required = routine.get_required_samples(tod_id)
+            if required is None:
+                ranges = None
+            elif ranges is not None:
+                ranges += list(required)
+        if dets is not None:
+            dets = np.unique(np.asarray(dets, dtype=int))
+            if len(dets) == 0:  # nobody asked for particular detectors
+                dets = None
+        samples = None
+        if ranges:
+            samples = (min(s for s, e in ranges), max(e for s, e in ranges))
+        return dets, samples
+
     def add_metadata(self, key, obj):
         """Add a metadata, which will be saved together with the output
         to be used as reference for the future, for example, the list
@@ -191,21 +607,33 @@ class TODLoop:
             error_lists = self.comm.gather(self._error_list, root=0)
             done_lists = self.comm.gather(self._done_list, root=0)
         else:
-            error_lists = self._error_list
-            done_lists = self._done_list
+            error_lists = [self._error_list]
+            done_lists = [self._done_list]
         if self.rank == 0:
-            error_list = [tod for l in error_lists for tod in l]
+            # the lists of ranks that died are None
+            error_list = [tod for l in error_lists if l for tod in l]
             append2file(error_list, os.path.join(self._output_dir, "error_list.txt"))
-            done_list = [tod for l in done_lists for tod in l]
+            done_list = [tod for l in done_lists if l for tod in l]
             append2file(done_list, os.path.join(self._output_dir, "done_list.txt"))
+            # keep the merged lists around on the root
+            self._error_list = error_list
+            self._done_list = done_list
 
 
 class Routine:
     """A routine is a reusable unit of a particular algorithm,
     for example, it can be filtering algorithms that can be used
     in various studies."""
+    # routines that may veto a TOD run alone when routines are executed
+    # concurrently, so that the veto stops everything added after them
+    can_veto = False
+
     def __init__(self):
         self._context = None
+        self._input_keys = None
+        self._output_keys = None
+        self._required_dets = None
+        self._required_samples = None
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.INFO)
 
@@ -230,6 +658,54 @@ class Routine:
         self.logger.info("TOD vetod, skipping subsequent routines...")
         self.get_context().veto()
 
+    def declare_keys(self, inputs=None, outputs=None):
+        """Declare the keys of the data store that the routine reads
+        and writes. When all routines of a pipeline have declared their
+        keys, the loop frees each key once its last user has run
+        @par:
+            inputs: [string] - keys read by the routine
+            outputs: [string] - keys written by the routine"""
+        self._input_keys = list(inputs or [])
+        self._output_keys = list(outputs or [])
+
+    def get_input_keys(self):
+        """Return the declared input keys, None if not declared"""
+        return self._input_keys
+
+    def get_output_keys(self):
+        """Return the declared output keys, None if not declared"""
+        return self._output_keys
+
+    def accepts(self, tod_id):
+        """Return False if the routine will veto a TOD, when that can be
+        told cheaply before running it (e.g. from the name), so that the
+        TOD is not loaded ahead. By default TODs are accepted"""
+        return True
+
+    def declare_requirements(self, dets=None, samples=None):
+        """Declare the part of the TOD that the routine needs, so that
+        a TODLoader with partial=True only loads that part. A routine
+        that declares nothing is assumed to need the whole TOD. Routines
+        whose needs depend on the TOD override get_required_dets and
+        get_required_samples instead
+        @par:
+            dets: [int] - det_uid of the detectors needed, [] if the
+                  routine works on any subset, None for all detectors
+            samples: [(start, end)] - sample ranges needed, [] if the
+                     routine works on any range, None for all samples"""
+        self._required_dets = dets
+        self._required_samples = samples
+
+    def get_required_dets(self, tod_id):
+        """Return the det_uid of the detectors the routine needs from
+        a TOD, None if it needs all of them"""
+        return self._required_dets
+
+    def get_required_samples(self, tod_id):
+        """Return the [(start, end)] sample ranges the routine needs
+        from a TOD, None if it needs all samples"""
+        return self._required_samples
+
     def add_context(self, context):
         """An internal function that's not to be called by users"""
         self._context = context
@@ -255,16 +731,24 @@ class Routine:
     def get_comm(self):
         return self.get_context().comm
 
+    def gather(self, obj, root=0):
+        """Gather an object from all ranks, typically called in finalize
+        to merge the outputs of a routine. Returns the list of objects
+        on the root and None elsewhere. Without a communicator it
+        returns [obj] so that routines work the same in serial runs"""
+        comm = self.get_comm()
+        if comm is None:
+            return [obj]
+        return comm.gather(obj, root=root)
+
     def get_rank(self):
         return self.get_context().rank
 
     def get_filename(self):
         return self.get_context().get_filename()
 
-    def get_array(self):
-        tod_name = self.get_context().get_name()
-        array_name = tod_name.split(".")[-2]
-        return array_name
+    def get_array(self, tod_id=None):
+        return self.get_context().get_array(tod_id)
 
 
 class DataStore:
@@ -291,3 +775,32 @@ class DataStore:
             obj: a object of arbitrary type
         @ret: nil"""
         self._store[key] = obj
+
+    def pop(self, key, default=None):
+        """Remove an object from the store and return it
+        @par:
+            key: str
+        @ret:
+            the object associated with the key or default"""
+        return self._store.pop(key, default)
+
+    def release(self, key):
+        """Drop the reference to an object so that its memory can be
+        freed, it's not an error if the key doesn't exist
+        @par:
+            key: str"""
+        self._store.pop(key, None)
+
+    def keys(self):
+        """Return the keys in the store"""
+        return list(self._store.keys())
+
+    def nbytes(self, key=None):
+        """Return the approximate memory held by the stored objects
+        @par:
+            key: str - only count the object with this key (optional)"""
+        if key is not None:
+            if key not in self._store:
+                return 0
+            return nbytes(self._store[key])
+        return nbytes(self._store)
@@ -1,10 +1,12 @@
+import moby2
 import numpy as np
 
 from .base import Routine
 from .routines import OutputRoutine
-from .utils.cuts import merge_cuts, common_cuts, pixels_affected_in_event
-from .utils.events import find_peaks
-from .utils.pixels import PixelReader
+from .utils.intervals import pack, unpack, combine_groups, IntervalIndex
+from .utils.csrcuts import CSRCuts
+from .utils.events import find_peaks, endpoint_histogram, coverage_histogram
+from .utils.pixels import get_pixel_reader
 
 
 class FindCosigs(OutputRoutine):
@@ -12,7 +14,8 @@ class FindCosigs(OutputRoutine):
 
     def __init__(self, season="2016", input_key="cuts",
                  output_key="cosig", output_dir="outputs/cosigs",
-                 strict=True, polarized=False, save=True):
+                 strict=True, polarized=False, save=True, cache_dir=None,
+                 container=False, compact=False):
         """
         :param input_key: string
         :param output_key: string
@@ -22,8 +25,11 @@ class FindCosigs(OutputRoutine):
         :param polarized: boolean - True means that we are looking for potentially
                         polarized signals. False means that we only look for
                         un-polarized signals.
+        :param cache_dir: string - directory of a local cache of the pixel
+                          layout (see PixelReader)
+        :param container, compact: bool - see OutputRoutine
         """
-        OutputRoutine.__init__(self, output_dir)
+        OutputRoutine.__init__(self, output_dir, container, compact)
         self._input_key = input_key
         self._output_key = output_key
         self._pr = None
@@ -31,107 +37,91 @@ class FindCosigs(OutputRoutine):
         self._polarized = polarized
         self._season = season
         self._save = save
+        self._cache_dir = cache_dir
+        self.declare_keys(inputs=[input_key], outputs=[output_key])
+
+    def _get_pixel_groups(self, array):
+        """Return the selected pixels and the det_uid of their two
+        detectors per frequency (-1 padded)"""
+        pr = get_pixel_reader(season=self._season, array=array,
+                              cache_dir=self._cache_dir)
+        # get all pixels with their detectors (-1 padded)
+        pixels, dets_f1, dets_f2 = pr.get_pixel_table()
+        # select before keeping two columns, so that pixels with more
+        # than two detectors in a frequency are left out
+        sel = self._select(dets_f1, dets_f2)
+        pad = np.full((np.count_nonzero(sel), 2), -1, dtype=int)
+        dets_f1 = np.hstack([dets_f1[sel], pad])[:, :2]
+        dets_f2 = np.hstack([dets_f2[sel], pad])[:, :2]
+        return pr, pixels[sel], dets_f1, dets_f2
+
+    def _select(self, dets_f1, dets_f2):
+        # strict mode: each pixel must have 4 TES (2 per freq)
+        # loose mode: at least one TES has to be present each freq
+        n_dets = [1, 2] if not self._strict else [2]
+        return np.isin((dets_f1 >= 0).sum(axis=1), n_dets) & \
+            np.isin((dets_f2 >= 0).sum(axis=1), n_dets)
+
+    def get_required_dets(self, tod_id):
+        """Only the TES of the selected pixels are needed"""
+        _, _, dets_f1, dets_f2 = self._get_pixel_groups(self.get_array(tod_id))
+        dets = np.concatenate([dets_f1.ravel(), dets_f2.ravel()])
+        return np.unique(dets[dets >= 0])
 
     def execute(self, store):
         # retrieve all cuts
-        self._pr = PixelReader(season=self._season, array=self.get_context().get_array())
+        self._pr, pixels, dets_f1, dets_f2 = self._get_pixel_groups(
+            self.get_array())
         cuts_data = store.get(self._input_key)  # get saved cut data
-        cuts = cuts_data['cuts']
-        nsamps = cuts_data['nsamps']
-
-        # get all pixels
-        pixels = self._pr.get_pixels()
-
-        # initialize dictionary to store coincident signals
-        cosig = {}
-
-        # loop through pixels and find cosig for each pixel
-        for p in pixels:
-            dets_f1 = self._pr.get_f1(p)
-            dets_f2 = self._pr.get_f2(p)
-
-            if self._strict:  # strict mode, 4 TES have to be present
-                if len(dets_f1) == 2 and len(dets_f2) == 2:
-                    cuts_f1_A = cuts.cuts[dets_f1[0]]  # low freq, polarization A
-                    cuts_f1_B = cuts.cuts[dets_f1[1]]  # low freq, polarization B
-
-                    cuts_f2_A = cuts.cuts[dets_f2[0]]  # high freq, polarization A
-                    cuts_f2_B = cuts.cuts[dets_f2[1]]  # high freq, polarization B
-
-                    if self._polarized:  # if looking for polarized, glitch may occur in either polarization
-                        cuts_f1 = merge_cuts(cuts_f1_A, cuts_f1_B)  # polarized spikes may appear at either pol
-                        cuts_f2 = merge_cuts(cuts_f2_A, cuts_f2_B)
-
-                    else:  # if looking for unpolarized, glitch must occur in both polarizations
-                        cuts_f1 = common_cuts(cuts_f1_A, cuts_f1_B)  # unpolarized spikes appear in both pols
-                        cuts_f2 = common_cuts(cuts_f2_A, cuts_f2_B)
-
-                    cosig[str(p)] = common_cuts(cuts_f1, cuts_f2)  # store coincident signals by pixel id
-
-            else:  # loose mode, at least one TES has to be present each freq
-                if len(dets_f1) == 2 and len(dets_f2) == 2:
-                    cuts_f1_A = cuts.cuts[dets_f1[0]]  # low freq, polarization A
-                    cuts_f1_B = cuts.cuts[dets_f1[1]]  # low freq, polarization B
-
-                    cuts_f2_A = cuts.cuts[dets_f2[0]]  # high freq, polarization A
-                    cuts_f2_B = cuts.cuts[dets_f2[1]]  # high freq, polarization B
-
-                    if self._polarized:  # if looking for polarized, glitch may occur in either polarization
-                        cuts_f1 = merge_cuts(cuts_f1_A, cuts_f1_B)  # polarized spikes may appear at either pol
-                        cuts_f2 = merge_cuts(cuts_f2_A, cuts_f2_B)
-
-                    else:  # if looking for unpolarized, glitch must occur in both polarizations
-                        cuts_f1 = common_cuts(cuts_f1_A, cuts_f1_B)  # unpolarized spikes appear in both pols
-                        cuts_f2 = common_cuts(cuts_f2_A, cuts_f2_B)
-
-                    cosig[str(p)] = common_cuts(cuts_f1, cuts_f2)  # store coincident signals by pixel id
-
-                elif len(dets_f1) == 1 and len(dets_f2) == 2:
-                    cuts_f1 = cuts.cuts[dets_f1[0]]  # low freq, polarization A
-
-                    cuts_f2_A = cuts.cuts[dets_f2[0]]  # high freq, polarization A
-                    cuts_f2_B = cuts.cuts[dets_f2[1]]  # high freq, polarization B
-
-                    if self._polarized:  # if looking for polarized, glitch may occur in either polarization
-                        cuts_f2 = merge_cuts(cuts_f2_A, cuts_f2_B)
-
-                    else:  # if looking for unpolarized, glitch must occur in both polarizations
-                        cuts_f2 = common_cuts(cuts_f2_A, cuts_f2_B)
-
-                    cosig[str(p)] = common_cuts(cuts_f1, cuts_f2)  # store coincident signals by pixel id
-
-                elif len(dets_f1) == 2 and len(dets_f2) == 1:
-                    cuts_f1_A = cuts.cuts[dets_f1[0]]  # low freq, polarization A
-                    cuts_f1_B = cuts.cuts[dets_f1[1]]  # low freq, polarization B
-
-                    cuts_f2 = cuts.cuts[dets_f2[0]]  # high freq, polarization A
-
-                    if self._polarized:  # if looking for polarized, glitch may occur in either polarization
-                        cuts_f1 = merge_cuts(cuts_f1_A, cuts_f1_B)
-
-                    else:  # if looking for unpolarized, glitch must occur in both polarizations
-                        cuts_f1 = common_cuts(cuts_f1_A, cuts_f1_B)
-
-                    cosig[str(p)] = common_cuts(cuts_f1, cuts_f2)  # store coincident signals by pixel id
-
-                elif len(dets_f1) == 1 and len(dets_f2) == 1:
-                    cuts_f1 = cuts.cuts[dets_f1[0]]  # low freq, polarization A
-                    cuts_f2 = cuts.cuts[dets_f2[0]]  # high freq, polarization A
-
-                    cosig[str(p)] = common_cuts(cuts_f1, cuts_f2)  # store coincident signals by pixel id
-
-        # cosig may contain empty cut vectors because we didn't
-        # enforce it, filter them out now
+        if isinstance(cuts_data, CSRCuts):  # compact cuts from DataLoader
+            cuts = cuts_data
+            nsamps = cuts_data.nsamps
+        else:
+            cuts = cuts_data['cuts']
+            nsamps = cuts_data['nsamps']
+
+        # the cuts may cover a subset of the detectors (partial loading),
+        # map the det_uid of the pixels to the rows of the cuts and drop
+        # the pixels that don't have enough detectors left
+        det_uid = np.asarray(cuts.det_uid, dtype=int)
+        rows = np.full(max(det_uid.max(initial=-1), dets_f1.max(initial=-1),
+                           dets_f2.max(initial=-1)) + 2, -1, dtype=int)
+        rows[det_uid] = np.arange(len(det_uid))
+        groups_f1, groups_f2 = rows[dets_f1], rows[dets_f2]  # -1 maps to -1
+        sel = self._select(groups_f1, groups_f2)
+        selected = pixels[sel].tolist()
+        groups_f1, groups_f2 = groups_f1[sel], groups_f2[sel]
+
+        # if looking for polarized, glitch may occur in either polarization,
+        # if looking for unpolarized, glitch must occur in both polarizations
+        mode = "union" if self._polarized else "intersection"
+        if isinstance(cuts, CSRCuts):
+            intervals, offsets = cuts.intervals, cuts.offsets
+        else:
+            intervals, offsets = pack(cuts.cuts)
+        cuts_f1 = combine_groups(intervals, offsets, groups_f1, mode)
+        cuts_f2 = combine_groups(intervals, offsets, groups_f2, mode)
+
+        # coincident signals must be seen in both frequencies
+        n = len(selected)
+        intervals = np.concatenate([cuts_f1[0], cuts_f2[0]])
+        offsets = np.concatenate([cuts_f1[1], cuts_f2[1][1:] + cuts_f1[1][-1]])
+        groups = np.vstack([np.arange(n), np.arange(n) + n]).T
+        common = unpack(*combine_groups(intervals, offsets, groups, "intersection"))
+
+        # store coincident signals by pixel id, leaving out the
+        # pixels without any coincident signals
         cosig_filtered = {}
-        for pixel in cosig:
-            cuts = cosig[pixel]
-            if len(cuts) != 0:
-                cosig_filtered[pixel] = cuts
+        for p, cv in zip(selected, common):
+            if len(cv) != 0:
+                cosig_filtered[str(p)] = moby2.tod.CutsVector(cv, nsamps)
 
         # form output object
         cosig_data = {
             'cosig': cosig_filtered,
-            'nsamps': nsamps
+            'nsamps': nsamps,
+            # index of the first sample of the cuts in the TOD
+            'sample_offset': getattr(cuts, 'sample_offset', 0)
         }
 
         # save cosig for further processing
@@ -143,32 +133,43 @@ class FindCosigs(OutputRoutine):
 
 
 class FindEvents(Routine):
-    def __init__(self, input_key="cosig", output_key="events"):
+    def __init__(self, input_key="cosig", output_key="events", coverage=False):
         """A routine to find events that cause multiple cosigs across multiple
         pixels
 
+        :param coverage: boolean - locate events with the number of pixels
+                         cut at each sample, instead of the histogram of
+                         the first and last sample of each cosig
         """
         Routine.__init__(self)
         self._input_key = input_key
         self._output_key = output_key
+        self._coverage = coverage
+        self.declare_keys(inputs=[input_key], outputs=[output_key])
+        # only reads the cosigs, not the TOD
+        self.declare_requirements(dets=[], samples=[])
 
     def execute(self, store):
         cosig_data = store.get(self._input_key)
 
         nsamps = cosig_data['nsamps']
         cosig = cosig_data['cosig']
+        # events are given in samples of the whole TOD
+        sample_offset = cosig_data.get('sample_offset', 0)
 
         # generate a histogram of cosigs
-        cosig_hist = np.zeros(nsamps)
-
-        # loop through pixels in cosig and update histogram
-        for pixel in cosig:  
-            cuts = cosig[pixel]
-            cuts[:,1] = cuts[:,1] - 1
-            cosig_hist[cuts] += 1
+        if self._coverage:
+            cosig_hist = coverage_histogram(cosig, nsamps)
+        else:
+            cosig_hist = endpoint_histogram(cosig, nsamps)
 
         peaks = find_peaks(cosig_hist)
 
+        # find the pixels affected by all peaks at once
+        index = IntervalIndex.from_dict(cosig, half_open=True)
+        pixels_affected = index.query_many([peak[0] for peak in peaks],
+                                           [peak[1] for peak in peaks])
+
         # temporarily obsolete codes
         # energy_calculator = self.get_store().get(self._energy_key)
         # tod_data = self.get_store().get(self._tod_key)
@@ -177,10 +178,9 @@ class FindEvents(Routine):
         # initialize a list to hold
         events = []
         
-        for peak in peaks:
-            all_pixels = pixels_affected_in_event(cosig, peak)
-            start = peak[0]
-            end = peak[1]
+        for peak, all_pixels in zip(peaks, pixels_affected):
+            start = peak[0] + sample_offset
+            end = peak[1] + sample_offset
             duration = peak[2]
             number_of_pixels = peak[3]
             ref_index = int((start + end)/2)
@@ -215,7 +215,8 @@ class FindEvents(Routine):
         # event data to save
         events_data = {
             'events': events,
-            'nsamps': nsamps
+            'nsamps': nsamps,
+            'sample_offset': sample_offset
         }
                 
         # output the events to our shared datastore
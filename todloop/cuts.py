@@ -1,14 +1,29 @@
+import os
 import moby2
 
 from .routines import OutputRoutine
 from .base import Routine
+from .utils.csrcuts import CSRCuts
 
 class CompileCuts(OutputRoutine):
     """A routine that compile cuts"""
-    def __init__(self, input_key, glitchp, output_dir):
-        OutputRoutine.__init__(self, output_dir)
+    def __init__(self, input_key, glitchp, output_dir, csr=False,
+                 container=False, compact=False):
+        """
+        :param input_key: string - key of the tod_data
+        :param glitchp: dict - parameters of the glitch finder
+        :param output_dir: string
+        :param csr: bool - save the cuts in the compact CSRCuts format
+                    instead of a pickle of the TODCuts: as <tod_id>.cuts.npy,
+                    which DataLoader can memory-map with postfix="cuts.npy",
+                    or as a record of the container
+        :param container, compact: bool - see OutputRoutine
+        """
+        OutputRoutine.__init__(self, output_dir, container, compact)
         self._input_key = input_key
         self._glitchp = glitchp
+        self._csr = csr
+        self.declare_keys(inputs=[input_key])
 
     def execute(self, store):
         self.logger.info('Finding glitches...')
@@ -16,6 +31,14 @@ class CompileCuts(OutputRoutine):
         glitch_cuts = moby2.tod.get_glitch_cuts(tod=tod_data, params=self._glitchp)
         self.logger.info('Finding glitches complete')
 
+        if self._csr:
+            cuts = CSRCuts.from_todcuts(glitch_cuts)
+            if self._container:
+                self.save_data(cuts)
+            else:
+                self._submit(self._write_cuts, self.get_id(), cuts)
+            return
+
         # Save into pickle file
         cut_data = {
             "TOD": self.get_context().get_name(),
@@ -25,6 +48,11 @@ class CompileCuts(OutputRoutine):
         }
         self.save_data(cut_data)
 
+    def _write_cuts(self, tod_id, cuts):
+        filename = os.path.join(self._output_dir, '%d.cuts.npy' % tod_id)
+        cuts.save(filename)
+        self.logger.info('Cuts saved: %s' % filename)
+
 
 class CleanTOD(Routine):
     def __init__(self, tod_key, output_key):
@@ -38,6 +66,10 @@ class CleanTOD(Routine):
         Routine.__init__(self)
         self._tod_key = tod_key 
         self._output_key = output_key
+        # the TOD is cleaned in place, so tod_key is written too
+        self.declare_keys(inputs=[tod_key], outputs=sorted(set([tod_key, output_key])))
+        # works on any subset of detectors and samples
+        self.declare_requirements(dets=[], samples=[])
 
     def execute(self, store):
         self.logger.info('Cleaning TOD ...')
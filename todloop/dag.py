@@ -0,0 +1,82 @@
+"""Run the routines of a pipeline as a dependency graph"""
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+def is_barrier(routine):
+    """A routine that hasn't declared its keys or that may veto the TOD
+    has to run alone: it waits for all routines added before it, and
+    all routines added after it wait for it"""
+    return routine.get_input_keys() is None or \
+        routine.get_output_keys() is None or routine.can_veto
+
+
+def build_dependencies(routines):
+    """Find the routines each routine has to wait for, from the keys
+    they read and write. A routine depends on an earlier one if it
+    reads a key the earlier one writes, or writes a key the earlier
+    one reads or writes.
+    @par:
+        routines: [Routine] in the order they were added
+    @ret:
+        [set(int)] - indices of the dependencies of each routine"""
+    deps = []
+    for j, routine in enumerate(routines):
+        dep = set()
+        for i in range(j):
+            earlier = routines[i]
+            if is_barrier(routine) or is_barrier(earlier):
+                dep.add(i)
+                continue
+            inputs = set(routine.get_input_keys())
+            outputs = set(routine.get_output_keys())
+            if inputs & set(earlier.get_output_keys()) or \
+               outputs & set(earlier.get_input_keys()) or \
+               outputs & set(earlier.get_output_keys()):
+                dep.add(i)
+        deps.append(dep)
+    return deps
+
+
+def execute_graph(deps, executor, run, stopped, on_done=None):
+    """Run the nodes of a graph on an executor as soon as their
+    dependencies are done.
+    @par:
+        deps: [set(int)] - dependencies of each node
+        executor: concurrent.futures executor
+        run: function - run(i) executes node i
+        stopped: function - returns True if no new node should be
+                 started (e.g. the TOD has been vetoed)
+        on_done: function - on_done(i) is called in the calling thread
+                 after node i finished (optional)
+    The first exception raised by a node is raised again once the
+    running nodes are finished"""
+    remaining = [set(d) for d in deps]
+    dependents = [[] for _ in deps]
+    for j, dep in enumerate(deps):
+        for i in dep:
+            dependents[i].append(j)
+
+    running = {}
+    error = None
+    ready = [i for i, dep in enumerate(remaining) if not dep]
+    while True:
+        if error is None and not stopped():
+            for i in ready:
+                running[executor.submit(run, i)] = i
+        ready = []
+        if not running:
+            break
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+            i = running.pop(future)
+            if future.exception() is not None:
+                error = error or future.exception()
+                continue
+            if on_done:
+                on_done(i)
+            for j in dependents[i]:
+                remaining[j].discard(i)
+                if not remaining[j]:
+                    ready.append(j)
+    if error is not None:
+        raise error
@@ -0,0 +1,255 @@
+"""Helpers for distributing TODs over MPI ranks (or local processes)"""
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import traceback
+
+# message tags used by the master / worker protocol
+TAG_REQUEST = 11
+TAG_TASK = 12
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _any_source(comm):
+    """Return the wildcard source understood by the given communicator"""
+    if hasattr(comm, 'ANY_SOURCE'):
+        return comm.ANY_SOURCE
+    from mpi4py import MPI
+    return MPI.ANY_SOURCE
+
+
+class RankFailure(RuntimeError):
+    """Raised by LocalComm when a message is expected from a rank
+    whose process has exited"""
+    def __init__(self, rank):
+        RuntimeError.__init__(self, "Rank %d has exited" % rank)
+        self.rank = rank
+
+
+def serve_tasks(comm, tasks, batch_size=1):
+    """Run the master side of a dynamic scheduler. Every other rank
+    asks for work when it becomes idle and gets the next batch of
+    tasks, until the task list is exhausted and all workers have been
+    told to stop (with an empty batch). With a LocalComm, workers whose
+    process died are dropped and the tasks handed to them are logged
+    (with MPI, the MPI runtime aborts the job when a rank dies).
+    @par:
+        comm: MPI communicator (or a LocalComm)
+        tasks: list of tasks (tod_ids)
+        batch_size: number of tasks handed out per request"""
+    tasks = list(tasks)
+    active = set(range(1, comm.Get_size()))
+    handed = dict((worker, []) for worker in active)
+    any_source = _any_source(comm)
+    i = 0
+    while active:
+        try:
+            worker = comm.recv(source=any_source, tag=TAG_REQUEST)
+        except RankFailure as e:
+            if e.rank in active:
+                active.discard(e.rank)
+                logger.error("Rank %d died, tasks handed to it (see the journal "
+                             "for the ones done): %s" % (e.rank, handed[e.rank]))
+            continue
+        batch = tasks[i:i+batch_size]
+        i += len(batch)
+        if not batch:  # nothing left, release the worker
+            active.discard(worker)
+        handed[worker].extend(batch)
+        comm.send(batch, dest=worker, tag=TAG_TASK)
+    logger.info("All %d tasks distributed" % len(tasks))
+
+
+def request_tasks(comm, batch_size=1, root=0):
+    """Run the worker side of a dynamic scheduler. This is a generator
+    that yields tasks obtained from the master as long as there are
+    any left.
+    @par:
+        comm: MPI communicator (or a LocalComm)
+        batch_size: unused on the worker side, the master decides
+        root: rank of the master"""
+    rank = comm.Get_rank()
+    while True:
+        comm.send(rank, dest=root, tag=TAG_REQUEST)
+        batch = comm.recv(source=root, tag=TAG_TASK)
+        if not batch:
+            break
+        for task in batch:
+            yield task
+
+
+class TaskQueue(object):
+    """An iterator over tasks that allows to look at the upcoming
+    ones without consuming them. Looking ahead pulls tasks from the
+    underlying iterator, so with a dynamic scheduler it claims them"""
+    def __init__(self, tasks):
+        self._tasks = iter(tasks)
+        self._buffer = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._buffer:
+            return self._buffer.popleft()
+        return next(self._tasks)
+
+    next = __next__
+
+    def peek(self, n):
+        """Return up to n upcoming tasks"""
+        while len(self._buffer) < n:
+            try:
+                self._buffer.append(next(self._tasks))
+            except StopIteration:
+                break
+        return list(self._buffer)[:n]
+
+    def take(self, task):
+        """Take a task that was looked at with peek out of turn"""
+        self._buffer.remove(task)
+        return task
+
+
+class LocalComm(object):
+    """A minimal stand-in for an mpi4py communicator backed by
+    multiprocessing queues. It supports the subset of the interface
+    used by TODLoop (rank/size, send/recv, gather, bcast, barrier) so
+    that parallel runs can be done on one machine without MPI.
+    Given the processes of the other ranks, receiving from ranks that
+    have exited raises RankFailure instead of waiting forever."""
+    ANY_SOURCE = -1
+    ANY_TAG = -1
+    _GATHER_TAG = 1001
+    _BCAST_TAG = 1002
+    POLL_INTERVAL = 1.
+
+    def __init__(self, rank, queues, procs=None):
+        """
+        :param rank: int
+        :param queues: list of the message queue of each rank
+        :param procs: dict of rank: process of the other ranks, to
+                      detect the ranks that died (optional)
+        """
+        self._rank = rank
+        self._queues = queues
+        self._procs = procs or {}
+        self._failed = set()  # dead ranks already reported to ANY_SOURCE
+        self._pending = []  # received but not yet matched messages
+
+    def Get_rank(self):
+        return self._rank
+
+    def Get_size(self):
+        return len(self._queues)
+
+    def send(self, obj, dest, tag=0):
+        self._queues[dest].put((self._rank, tag, obj))
+
+    def recv(self, source=ANY_SOURCE, tag=ANY_TAG):
+        def match(msg):
+            return (source in (self.ANY_SOURCE, msg[0])) and \
+                (tag in (self.ANY_TAG, msg[1]))
+        for i, msg in enumerate(self._pending):
+            if match(msg):
+                return self._pending.pop(i)[2]
+        while True:
+            try:
+                msg = self._queues[self._rank].get(
+                    timeout=self.POLL_INTERVAL if self._procs else None)
+            except queue.Empty:
+                dead = self._dead_source(source)
+                if dead is None:
+                    continue
+                try:  # a message sent right before exiting may still be on its way
+                    msg = self._queues[self._rank].get(timeout=self.POLL_INTERVAL)
+                except queue.Empty:
+                    if source == self.ANY_SOURCE:  # report each dead rank once
+                        self._failed.add(dead)
+                    raise RankFailure(dead)
+            if match(msg):
+                return msg[2]
+            self._pending.append(msg)
+
+    def _dead_source(self, source):
+        """Return a rank that a message is awaited from and whose
+        process has exited, None if there is none"""
+        if source != self.ANY_SOURCE:
+            proc = self._procs.get(source)
+            return source if proc is not None and not proc.is_alive() else None
+        for rank, proc in sorted(self._procs.items()):
+            if rank not in self._failed and not proc.is_alive():
+                return rank
+        return None
+
+    def gather(self, obj, root=0):
+        if self._rank != root:
+            self.send(obj, dest=root, tag=self._GATHER_TAG)
+            return None
+        result = [None] * self.Get_size()
+        result[root] = obj
+        for r in range(self.Get_size()):
+            if r != root:
+                try:
+                    result[r] = self.recv(source=r, tag=self._GATHER_TAG)
+                except RankFailure:  # nothing to gather from a dead rank
+                    logger.error("Rank %d has exited, gathering None from it" % r)
+        return result
+
+    def bcast(self, obj, root=0):
+        if self._rank == root:
+            for r in range(self.Get_size()):
+                if r != root:
+                    self.send(obj, dest=r, tag=self._BCAST_TAG)
+            return obj
+        return self.recv(source=root, tag=self._BCAST_TAG)
+
+    def barrier(self):
+        self.bcast(self.gather(None))
+
+
+def get_context():
+    """Prefer fork so that closures and loop objects need no pickling"""
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def _worker(target, comm):
+    try:
+        target(comm)
+    except Exception:
+        traceback.print_exc()
+        os._exit(1)
+
+
+def run_local(target, n_procs):
+    """Run target(comm) on n_procs local ranks connected by LocalComm.
+    Rank 0 runs in the calling process, the others in child processes.
+    @par:
+        target: function that takes a communicator
+        n_procs: total number of ranks
+    @ret:
+        return value of target on rank 0"""
+    ctx = get_context()
+    queues = [ctx.Queue() for _ in range(n_procs)]
+    procs = {}
+    for rank in range(1, n_procs):
+        p = ctx.Process(target=_worker, args=(target, LocalComm(rank, queues)))
+        p.start()
+        procs[rank] = p
+    try:
+        # rank 0 watches the other processes so that it doesn't wait
+        # for messages from a rank that died
+        result = target(LocalComm(0, queues, procs))
+    finally:
+        for p in procs.values():
+            p.join()
+    for rank, p in sorted(procs.items()):
+        if p.exitcode != 0:
+            logger.error("Local rank %d exited with code %s" % (rank, p.exitcode))
+    return result
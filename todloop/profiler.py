@@ -0,0 +1,122 @@
+"""Opt-in instrumentation of the event loop"""
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from .utils.memory import get_rss, reset_peak_rss, get_peak_rss
+
+
+class Profiler(object):
+    """Record wall time, cpu time, RSS change, peak RSS increase and
+    data store size of each routine for each TOD, together with the
+    routine that vetoed the TOD if any. The cpu time is the one of the
+    thread running the routine. The RSS is the one of the process, so
+    with concurrent routines (set_n_threads) it includes the other
+    routines running. The peak is measured with the high-water mark of
+    the process on linux, elsewhere it falls back to the RSS change"""
+    def __init__(self):
+        self._records = []
+        self._current = None
+
+    def start_tod(self, tod_id, tod_name):
+        self._current = {
+            'tod_id': tod_id,
+            'tod_name': tod_name,
+            'routines': [],
+            'vetoed_by': None,
+            'status': None
+        }
+        self._records.append(self._current)
+
+    def end_tod(self, status):
+        self._current['status'] = status
+        self._current = None
+
+    @contextmanager
+    def profile(self, name, store):
+        """Measure the block, typically the execution of a routine
+        @par:
+            name: string - name of the routine
+            store: DataStore - measured after the block"""
+        wall = time.time()
+        cpu = time.thread_time()
+        rss = get_rss()
+        peak_reset = reset_peak_rss()
+        try:
+            yield
+        finally:
+            rss_end = get_rss()
+            peak = get_peak_rss() if peak_reset else None
+            self._current['routines'].append({
+                'name': name,
+                'wall': time.time() - wall,
+                'cpu': time.thread_time() - cpu,
+                'rss_delta': rss_end - rss,
+                'rss_peak': max(peak or 0, rss_end) - rss,
+                'store_nbytes': store.nbytes()
+            })
+
+    def set_vetoed_by(self, name):
+        self._current['vetoed_by'] = name
+
+    def get_current(self):
+        """Return the record of the TOD being processed"""
+        return self._current
+
+    def update_current(self, record):
+        """Take the routines measured and the veto from the record of
+        the same TOD made elsewhere, e.g. in an isolated child process"""
+        self._current['routines'] = record['routines']
+        self._current['vetoed_by'] = record['vetoed_by']
+
+    def get_records(self):
+        return self._records
+
+    def dump(self, output_dir, comm=None, rank=0):
+        """Gather the records of all ranks and write them to the output
+        directory: profile.json with the per-TOD records and
+        profile_summary.txt with statistics per routine"""
+        if comm:
+            records = [r for l in comm.gather(self._records, root=0) or [] if l for r in l]
+        else:
+            records = self._records
+        if rank != 0:
+            return
+        with open(os.path.join(output_dir, "profile.json"), "w") as f:
+            json.dump(records, f, indent=1)
+        with open(os.path.join(output_dir, "profile_summary.txt"), "w") as f:
+            f.write(summarize(records))
+
+
+def summarize(records):
+    """Summarize the profiling records as a text table"""
+    names = []
+    stats = {}
+    vetoes = {}
+    for record in records:
+        for entry in record['routines']:
+            if entry['name'] not in stats:
+                names.append(entry['name'])
+                stats[entry['name']] = []
+            stats[entry['name']].append(
+                (entry['wall'], entry['cpu'], entry['rss_delta'],
+                 entry['rss_peak'], entry['store_nbytes']))
+        if record['vetoed_by']:
+            vetoes[record['vetoed_by']] = vetoes.get(record['vetoed_by'], 0) + 1
+
+    header = "%-24s %6s %10s %10s %10s %10s %12s %12s %12s %6s\n" % (
+        'routine', 'n', 'wall_mean', 'wall_p50', 'wall_p95', 'cpu_mean',
+        'rss_inc(MB)', 'rss_peak(MB)', 'store_max(MB)', 'veto')
+    lines = [header]
+    for name in names:
+        data = np.array(stats[name], dtype=float)
+        wall = data[:, 0]
+        lines.append("%-24s %6d %10.3f %10.3f %10.3f %10.3f %12.1f %12.1f %12.1f %6d\n" % (
+            name, len(data), np.mean(wall), np.percentile(wall, 50),
+            np.percentile(wall, 95), np.mean(data[:, 1]),
+            np.max(data[:, 2]) / 2.**20, np.max(data[:, 3]) / 2.**20,
+            np.max(data[:, 4]) / 2.**20, vetoes.get(name, 0)))
+    return "".join(lines)
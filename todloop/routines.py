@@ -1,50 +1,122 @@
 import os
+import glob
+import shutil
+import hashlib
 import pickle
 import numpy as np
 import pprint
 
 from .base import Routine
+from .utils.csrcuts import CSRCuts
+from .utils.shards import ShardWriter, ShardReader, compact_shards
+from .utils import serialize
+from .utils.prefetch import Prefetcher
 
 
 class OutputRoutine(Routine):
     """A base routine that has output functionality"""
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, container=False, compact=False):
+        """
+        :param output_dir: string
+        :param container: bool - append the data of all TODs to one shard
+                          file per rank (see utils.shards) instead of
+                          writing one file per TOD
+        :param compact: bool - merge the shards of all ranks into one in
+                        finalize (container mode only)
+        """
         Routine.__init__(self)
         self._output_dir = output_dir
+        self._container = container
+        self._compact = compact
+        self._shard_writer = None
+        self._serializer = "pickle"
+        self._compression = None
 
     def initialize(self):
         if not os.path.exists(self._output_dir):
             self.logger.info('Path %s does not exist, creating ...' % self._output_dir)
-            os.makedirs(self._output_dir)
+            os.makedirs(self._output_dir, exist_ok=True)
+        if self._container:
+            self._shard_writer = ShardWriter(self._output_dir, self.get_rank())
+
+    def set_serializer(self, serializer="pickle", compression=None):
+        """Choose how save_data serializes the data
+        @par:
+            serializer: "pickle" - <tod_id>.pickle files, or "npk" -
+                        utils.serialize, which stores arrays as raw
+                        buffers and dicts field by field, in
+                        <tod_id>.npk files
+            compression: None, "zlib" or "lzma" - compression of the
+                         arrays that compress well ("npk" only)"""
+        if serializer not in ["pickle", "npk"]:
+            raise ValueError("Unknown serializer: %s" % serializer)
+        self._serializer = serializer
+        self._compression = compression
 
     def save_data(self, data):
+        """Save the data of the current TOD. With asynchronous output
+        (see TODLoop.set_async_output) it is written later, so the data
+        must not be modified afterwards"""
         tod_id = self.get_context().get_id()
-        filename = os.path.join(self._output_dir, '%d.pickle' % tod_id)
-        with open(filename, "w") as f:
-            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        self._submit(self._write_data, tod_id, data)
+
+    def _write_data(self, tod_id, data):
+        if self._serializer == "npk":
+            payload = serialize.dumps(data, compression=self._compression, fields=True)
+        else:
+            payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        if self._container:
+            self._shard_writer.write_bytes(tod_id, payload)
+            self.logger.info('Data saved: %d in %s' % (tod_id, self._output_dir))
+            return
+        filename = os.path.join(self._output_dir, '%d.%s' % (tod_id, self._serializer))
+        with open(filename, "wb") as f:
+            f.write(payload)
             self.logger.info('Data saved: %s' % filename)
 
     def save_figure(self, fig):
         tod_id = self.get_context().get_id()
-        filename = os.path.join(self._output_dir, '$d.png' % tod_id)
+        self._submit(self._write_figure, tod_id, fig)
+
+    def _write_figure(self, tod_id, fig):
+        filename = os.path.join(self._output_dir, '%d.png' % tod_id)
         fig.savefig(filename)
         self.logger.info('Figure saved: %s' % filename)
 
+    def _submit(self, func, *args):
+        """Run an output task now or on the background writer"""
+        writer = self.get_context().get_writer()
+        if writer:
+            writer.submit((self.get_id(), self.get_name()), func, *args)
+        else:
+            func(*args)
+
     def finalize(self):
+        # wait for the pending outputs before closing and writing metadata
+        writer = self.get_context().get_writer()
+        if writer:
+            writer.flush()
+        if self._shard_writer:
+            self._shard_writer.close()
+            # merge on the root once all ranks have closed their shards
+            if self._compact and self.gather(None) is not None:
+                n = compact_shards(self._output_dir)
+                self.logger.info("Compacted %d records in %s" % (n, self._output_dir))
         # write metadata to the directory
         metadata = self.get_context().get_metadata()
         if metadata:  # if metadata exists
             filename = os.path.join(self._output_dir, '.metadata')
-            with open(filename, "w") as f:
+            with open(filename, "wb") as f:
                 pickle.dump(metadata, f, pickle.HIGHEST_PROTOCOL)
                 self.logger.info("Metadata is saved at: %s", filename)
 
 
 class SaveData(OutputRoutine):
     """A routine to save data from data store"""
-    def __init__(self, input_key, output_dir):
-        OutputRoutine.__init__(self, output_dir)
+    def __init__(self, input_key, output_dir, container=False, compact=False):
+        OutputRoutine.__init__(self, output_dir, container, compact)
         self._input_key = input_key
+        self.declare_keys(inputs=[input_key])
 
     def execute(self, store):
         data = store.get(self._input_key)
@@ -56,6 +128,7 @@ class Logger(Routine):
     def __init__(self, input_key):
         Routine.__init__(self)
         self._input_key = input_key
+        self.declare_keys(inputs=[input_key])
 
     def initialize(self):
         self._pp = pprint.PrettyPrinter(indent=1)
@@ -68,55 +141,256 @@ class Logger(Routine):
 
 class DataLoader(Routine):
     """A routine that load the saved coincident signals"""
-    def __init__(self, input_dir=None, postfix="pickle", output_key="data"):
+    can_veto = True
+    POSTFIXES = ["pickle", "npk", "npy", "cuts.npy", "cuts.npz"]
+
+    def __init__(self, input_dir=None, postfix="pickle", output_key="data",
+                 container=False, prefetch=0, mmap_mode=None, lazy=False):
         """
         :param input_dir:  string
-        :param postfix:    string - file extension
+        :param postfix:    string - file extension: pickle, npk (see
+                           OutputRoutine.set_serializer), npy, or
+                           cuts.npy/cuts.npz for cuts saved as CSRCuts
+                           (cuts.npy and uncompressed arrays of .npk
+                           files are memory-mapped)
         :param output_key: string - key used to store loaded data
+        :param container:  bool - read the shards written by an
+                           OutputRoutine in container mode
+        :param prefetch:   int - number of upcoming files to load on a
+                           background thread while the current one is
+                           processed (0 to disable)
+        :param mmap_mode:  string - mmap_mode of np.load for npy files,
+                           e.g. 'r' to read only the parts accessed
+        :param lazy:       bool - only deserialize the fields of the data
+                           that are accessed (npk dicts saved by field)
         """
         Routine.__init__(self)
         self._input_dir = input_dir
         self._postfix = postfix
         self._output_key = output_key
+        self._container = container
+        self._prefetch = prefetch
+        self._mmap_mode = mmap_mode
+        self._lazy = lazy
+        self._reader = None
+        self._files = None
+        self._prefetcher = None
         self._metadata = None
+        self.declare_keys(outputs=[output_key])
 
     def initialize(self):
         self.load_metadata()
+        if self._container:
+            self._reader = ShardReader(self._input_dir)
+            self.logger.info('Found %d records in %s' % (len(self._reader), self._input_dir))
+        else:
+            self._files = self.scan()
+            self.logger.info('Found %d files in %s' % (len(self._files), self._input_dir))
+        if self._prefetch > 0 and self.get_context().is_isolated():
+            # each TOD is loaded in its own child process
+            self.logger.warning('Prefetching is disabled with isolation')
+        elif self._prefetch > 0:
+            self._prefetcher = Prefetcher(self.load, depth=self._prefetch)
+
+    def scan(self):
+        """Index the input directory once instead of looking for the file
+        of each TOD
+        @ret:
+            dict of tod_id: filepath"""
+        files = {}
+        ext = "." + self._postfix
+        if not os.path.isdir(self._input_dir):
+            return files
+        for name in os.listdir(self._input_dir):
+            if name.endswith(ext) and name[:-len(ext)].isdigit():
+                files[int(name[:-len(ext)])] = os.path.join(self._input_dir, name)
+        return files
+
+    def has_data(self, i):
+        """Return whether there is saved data for a TOD"""
+        if self._container:
+            return i in self._reader
+        return i in self._files
 
     def execute(self, store):
         """A function that fetch a batch of files in order"""
         i = self.get_id()
-        filepath = os.path.join(self._input_dir, "%s.%s" % (i, self._postfix))
-        if os.path.isfile(filepath):
-            with open(filepath, "r") as f:
-                if self._postfix == "pickle":
-                    data = pickle.load(f)
-                elif self._postfix == "npy":
-                    data = np.load(f)
-                else:
-                    self.logger.error("Unrecognized mode!")
-                    self.veto()
-                    return
-
-                self.logger.info('Fetched: %s' % filepath)
-                if len(data)>0:  # check if data is None
-                    store.set(self._output_key, data)
-                else:  # data is None
-                    self.logger.warn('Data is None, skipping ...')
-                    self.veto()  # skipping
-        else:
-            self.logger.warn('Not found: %s, skipping ...' % filepath)
+        if self._postfix not in self.POSTFIXES:
+            self.logger.error("Unrecognized mode!")
             self.veto()
+            return
+        if not self.has_data(i):
+            self.logger.warning('Not found: %d.%s in %s, skipping ...' %
+                                (i, self._postfix, self._input_dir))
+            self.veto()
+            return
+        if self._prefetcher:
+            data = self._prefetcher.get(i, i)
+            upcoming = self.get_context().get_upcoming(self._prefetch, before=self)
+            self._prefetcher.schedule([(j, (j,)) for j in upcoming if self.has_data(j)])
+        else:
+            data = self.load(i)
+
+        self.logger.info('Fetched: %d.%s' % (i, self._postfix))
+        if len(data)>0:  # check if data is None
+            store.set(self._output_key, data)
+        else:  # data is None
+            self.logger.warning('Data is None, skipping ...')
+            self.veto()  # skipping
+
+    def load(self, i):
+        """Load the data of a TOD"""
+        if self._container:
+            return self._reader.load(i, self._lazy)
+        filepath = self._files[i]
+        if self._postfix == "pickle":
+            with open(filepath, "rb") as f:
+                return pickle.load(f)
+        elif self._postfix == "npk":
+            return serialize.load(filepath, lazy=self._lazy)
+        elif self._postfix in ["cuts.npy", "cuts.npz"]:
+            return CSRCuts.load(filepath)
+        else:
+            return np.load(filepath, mmap_mode=self._mmap_mode)
+
+    def finalize(self):
+        if self._prefetcher:
+            self._prefetcher.close()
+            self._prefetcher = None
+        if self._reader:
+            self._reader.close()
 
     def load_metadata(self):
         """Load metadata if there is one"""
-        metadata_path = self._input_dir + ".metadata"
-        if os.path.isfile(metadata_path):
+        filename = os.path.join(self._input_dir, '.metadata')
+        if os.path.isfile(filename):
             self.logger.info('Metadata found!')
-            filename = os.path.join(self._input_key, '.metadata')
-            with open(filename, "r") as meta:
+            with open(filename, "rb") as meta:
                 self._metadata = pickle.load(meta)
                 self.logger.info('Metadata loaded from: %s!' % filename)
 
     def get_metadata(self):
         return self._metadata
+
+
+class CachedRoutine(Routine):
+    """A wrapper that caches the outputs of a routine on disk. The cache
+    is keyed by the routine class, its parameters and the TOD name, so
+    on a rerun the outputs are restored into the data store without
+    executing the routine"""
+    def __init__(self, routine, cache_dir="cache", max_bytes=None):
+        """
+        :param routine: Routine - routine to cache, it has to declare its
+                        output keys
+        :param cache_dir: string - directory to store the cache
+        :param max_bytes: int - size limit of the cache directory, the
+                          least recently used entries are removed beyond
+                          it. None for no limit
+        """
+        Routine.__init__(self)
+        if routine.get_output_keys() is None:
+            raise ValueError("%s has to declare its output keys to be cached" %
+                             routine.__class__.__name__)
+        self._routine = routine
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._routine_dir = os.path.join(cache_dir, self._hash_routine(routine))
+        self._input_keys = routine.get_input_keys()
+        self._output_keys = routine.get_output_keys()
+        self.can_veto = routine.can_veto
+
+    @staticmethod
+    def _hash_routine(routine):
+        """Hash the class and the parameters of a routine"""
+        h = hashlib.sha1()
+        cls = routine.__class__
+        h.update(("%s.%s" % (cls.__module__, cls.__name__)).encode())
+        for key, value in sorted(vars(routine).items()):
+            if key in ('_context', 'logger'):
+                continue
+            try:
+                value = pickle.dumps(value, 2)
+            except Exception:
+                value = repr(value).encode()
+            h.update(key.encode())
+            h.update(value)
+        return h.hexdigest()[:16]
+
+    def _get_filename(self, tod_name):
+        tod_hash = hashlib.sha1(tod_name.encode()).hexdigest()[:16]
+        return os.path.join(self._routine_dir, "%s.pickle" % tod_hash)
+
+    def add_context(self, context):
+        Routine.add_context(self, context)
+        self._routine.add_context(context)
+
+    def get_required_dets(self, tod_id):
+        return self._routine.get_required_dets(tod_id)
+
+    def get_required_samples(self, tod_id):
+        return self._routine.get_required_samples(tod_id)
+
+    def initialize(self):
+        if not os.path.exists(self._routine_dir):
+            os.makedirs(self._routine_dir, exist_ok=True)
+        self._routine.initialize()
+
+    def execute(self, store):
+        filename = self._get_filename(self.get_name())
+        if os.path.isfile(filename):
+            try:
+                with open(filename, "rb") as f:
+                    outputs = pickle.load(f)
+            except Exception:
+                self.logger.warning('Corrupted cache: %s, recomputing ...' % filename)
+            else:
+                for key in self._output_keys:
+                    store.set(key, outputs[key])
+                os.utime(filename, None)  # mark as recently used
+                self.logger.info('Restored from cache: %s' % filename)
+                return
+
+        self._routine.execute(store)
+        if self.get_context().is_vetoed():  # nothing to cache
+            return
+        outputs = dict((key, store.get(key)) for key in self._output_keys)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            pickle.dump(outputs, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+        self.evict()
+
+    def finalize(self):
+        self._routine.finalize()
+
+    def evict(self):
+        """Remove the least recently used entries of the whole cache
+        directory until it fits in max_bytes"""
+        if self._max_bytes is None:
+            return
+        entries = []
+        for filename in glob.glob(os.path.join(self._cache_dir, "*", "*.pickle")):
+            try:
+                st = os.stat(filename)
+            except OSError:  # removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+        total = sum(e[1] for e in entries)
+        for mtime, size, filename in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def invalidate(self, tod_name=None):
+        """Remove the cached outputs of this routine
+        :param tod_name: string - only remove the entry of this TOD"""
+        if tod_name is not None:
+            filename = self._get_filename(tod_name)
+            if os.path.isfile(filename):
+                os.remove(filename)
+        elif os.path.exists(self._routine_dir):
+            shutil.rmtree(self._routine_dir)
@@ -2,38 +2,93 @@ import moby2
 import numpy as np
 
 from .base import Routine
+from .utils.prefetch import Prefetcher
 
 
 class TODLoader(Routine):
-    def __init__(self, output_key="tod_data", abspath=False, load_opts={}):
+    def __init__(self, output_key="tod_data", abspath=False, load_opts={},
+                 prefetch=0, max_prefetch_bytes=None, partial=False):
         """
         A routine that loads the TOD and save it to a key
         :param output_key: string - key used to save the tod_data
         :param abspath: bool - if the input name is absolute path or just name
         :param load_opts: dict - dictionary with load options
+        :param prefetch: int - number of upcoming TODs to load on a background
+                         thread while the current one is processed (0 to disable)
+        :param max_prefetch_bytes: int - cap on the memory held by prefetched
+                                   TODs, None for no limit
+        :param partial: bool - only load the detectors and samples that
+                        the routines after the loader declare they need
+                        (see Routine.declare_requirements), passed to
+                        moby2 as the det_uid, start and end load options
         """
         Routine.__init__(self)
         self._output_key = output_key
         self._fb = None
         self._abspath = abspath
         self._load_opts = load_opts
+        self._prefetch = prefetch
+        self._max_prefetch_bytes = max_prefetch_bytes
+        self._prefetcher = None
+        self._partial = partial
+        self.declare_keys(outputs=[output_key])
+
+    def initialize(self):
+        if self._prefetch > 0 and self.get_context().is_isolated():
+            # each TOD is loaded in its own child process
+            self.logger.warning('Prefetching is disabled with isolation')
+        elif self._prefetch > 0:
+            self._prefetcher = Prefetcher(self.load, depth=self._prefetch,
+                                          max_bytes=self._max_prefetch_bytes)
 
     def execute(self, store):
         tod_filename = self.get_filename()
         self.logger.info('Loading TOD: %s ...' % tod_filename)
+        if self._prefetcher:
+            tod_data = self._prefetcher.get(self.get_id(), tod_filename,
+                                            self.get_load_opts(self.get_id()))
+            # start loading the next TODs while this one is processed
+            context = self.get_context()
+            upcoming = context.get_upcoming(self._prefetch, before=self)
+            self._prefetcher.schedule([(i, (context.get_filename(i),
+                                            self.get_load_opts(i)))
+                                       for i in upcoming])
+        else:
+            tod_data = self.load(tod_filename, self.get_load_opts(self.get_id()))
+        self.logger.info('TOD loaded')
+        store.set(self._output_key, tod_data)  # save tod_data in memory for routines to process
 
+    def get_load_opts(self, tod_id):
+        """Return the load options of a TOD, restricted to the detectors
+        and samples needed downstream in partial mode"""
+        load_opts = dict(self._load_opts)
+        if self._partial:
+            dets, samples = self.get_context().get_requirements(tod_id, after=self)
+            if dets is not None:
+                load_opts['det_uid'] = dets
+            if samples is not None:
+                load_opts['start'], load_opts['end'] = samples
+        return load_opts
+
+    def load(self, tod_filename, load_opts=None):
+        """Load a TOD from file with the load options"""
         # define load options
-        load_opts = {
+        opts = {
             'filename': tod_filename,
             'repair_pointing': True
         }
-        load_opts.update(self._load_opts)
-        tod_data = moby2.scripting.get_tod(load_opts)
-        self.logger.info('TOD loaded')
-        store.set(self._output_key, tod_data)  # save tod_data in memory for routines to process
+        opts.update(self._load_opts if load_opts is None else load_opts)
+        return moby2.scripting.get_tod(opts)
+
+    def finalize(self):
+        if self._prefetcher:
+            self._prefetcher.close()
+            self._prefetcher = None
 
 
 class TODSelector(Routine):
+    can_veto = True
+
     def __init__(self, tod_list):
         """A routine that takes a list of TOD names and run the TODLoop on 
         the given TOD list based on a base list
@@ -41,11 +96,15 @@ class TODSelector(Routine):
             tod_list: a list of tods names to run over"""
         Routine.__init__(self)
         self._tod_list = tod_list 
+        self.declare_keys()
+        self.declare_requirements(dets=[], samples=[])
             
-    def execute(self):
+    def accepts(self, tod_id):
+        return self.get_context().get_name(tod_id) in self._tod_list
+
+    def execute(self, store):
         """Scripts that run for each TOD"""
-        tod_name = self.get_name()
-        if tod_name not in self._tod_list:
+        if not self.accepts(self.get_id()):
             self.veto()  # halt subsequent routines
 
 
@@ -55,10 +114,15 @@ class FixOpticalSign(Routine):
         Routine.__init__(self)
         self._input_key = input_key
         self._output_key = output_key
+        # the TOD is modified in place, so input_key is written too
+        self.declare_keys(inputs=[input_key], outputs=sorted(set([input_key, output_key])))
+        # works on any subset of detectors and samples
+        self.declare_requirements(dets=[], samples=[])
 
     def execute(self, store):
         tod_data = store.get(self._input_key)  # retrieve TOD
-        optical_signs = tod_data.info.array_data['optical_sign']
+        # the array data covers all detectors, the TOD may hold a subset
+        optical_signs = tod_data.info.array_data['optical_sign'][tod_data.det_uid]
         tod_data.data = tod_data.data*optical_signs[:, np.newaxis]
         store.set(self._output_key, tod_data)
 
@@ -69,6 +133,10 @@ class CalibrateTOD(Routine):
         Routine.__init__(self)
         self._input_key = input_key
         self._output_key = output_key
+        # the TOD is modified in place, so input_key is written too
+        self.declare_keys(inputs=[input_key], outputs=sorted(set([input_key, output_key])))
+        # works on any subset of detectors and samples
+        self.declare_requirements(dets=[], samples=[])
 
     def execute(self, store):
         tod = store.get(self._input_key)
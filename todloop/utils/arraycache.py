@@ -0,0 +1,93 @@
+"""Save named arrays to a versioned, checksummed .npz file that can be
+loaded memory-mapped. The archive is written uncompressed so that each
+member is a plain .npy file at a fixed offset of the zip file"""
+import hashlib
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+_VERSION_KEY = "__version__"
+_CHECKSUM_KEY = "__checksum__"
+
+
+def checksum(arrays):
+    """Return the sha1 of the names, types, shapes and content of a dict
+    of arrays"""
+    sha = hashlib.sha1()
+    for name in sorted(arrays):
+        arr = np.ascontiguousarray(arrays[name])
+        sha.update(("%s:%s:%s;" % (name, arr.dtype.str, arr.shape)).encode())
+        sha.update(arr.tobytes())
+    return sha.hexdigest()
+
+
+def save_arrays(filename, arrays, version):
+    """Save a dict of arrays atomically (through a temporary file, so that
+    concurrent readers never see a partial file)
+    @par:
+        filename: string - path of the .npz file
+        arrays: dict of name: array
+        version: int - layout version, checked by load_arrays"""
+    arrays = dict((name, np.asarray(arr)) for name, arr in arrays.items())
+    arrays[_CHECKSUM_KEY] = np.array(checksum(arrays))
+    arrays[_VERSION_KEY] = np.array(version)
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.rename(tmp, filename)
+
+
+def _read_member(zf, info):
+    with zf.open(info) as member:
+        return np.lib.format.read_array(member)
+
+
+def _load_member(f, zf, info, mmap):
+    """Memory-map a member of an uncompressed archive if possible"""
+    if not mmap or info.compress_type != zipfile.ZIP_STORED:
+        return _read_member(zf, info)
+    # skip the local file header to the start of the .npy file
+    f.seek(info.header_offset)
+    header = f.read(30)
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    f.seek(info.header_offset + 30 + name_len + extra_len)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    else:
+        return _read_member(zf, info)
+    if dtype.hasobject:
+        raise ValueError("Cannot load object array %s" % info.filename)
+    if not shape or 0 in shape:  # memmap does not handle empty arrays
+        return _read_member(zf, info)
+    return np.memmap(f.name, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def load_arrays(filename, version, mmap=True):
+    """Load arrays saved with save_arrays
+    @par:
+        filename: string
+        version: int - expected layout version
+        mmap: bool - memory-map the arrays instead of reading them
+    @ret:
+        dict of name: array, read-only when memory-mapped
+    @raise:
+        ValueError if the version or checksum does not match"""
+    arrays = {}
+    with open(filename, "rb") as f, zipfile.ZipFile(f) as zf:
+        for info in zf.infolist():
+            name = info.filename[:-len(".npy")]
+            arrays[name] = _load_member(f, zf, info, mmap)
+    if _VERSION_KEY not in arrays or int(arrays.pop(_VERSION_KEY)) != version:
+        raise ValueError("Unsupported version of %s" % filename)
+    if str(arrays.pop(_CHECKSUM_KEY, "")) != checksum(arrays):
+        raise ValueError("Checksum mismatch in %s" % filename)
+    return arrays
@@ -0,0 +1,128 @@
+import numpy as np
+
+from .intervals import pack
+
+# layout version of the packed .npy format
+VERSION = 1
+_HEADER = 5  # version, ndet, nsamps, sample_offset, n_intervals
+
+
+class CSRCuts(object):
+    """A compact container for the cuts of all detectors of a TOD: the
+    (start, end) pairs of all detectors in one flat int32 array, and
+    per-detector offsets into it, i.e. the cuts of detector i are
+    intervals[offsets[i]:offsets[i+1]]. It can be saved to a single
+    .npy file that is memory-mapped when loaded"""
+    def __init__(self, intervals, offsets, det_uid=None, nsamps=None,
+                 sample_offset=0):
+        """
+        :param intervals: (N, 2) int array of [start, end) intervals
+        :param offsets: (ndet+1,) int array
+        :param det_uid: (ndet,) int array, defaults to 0..ndet-1
+        :param nsamps: int - number of samples of the TOD
+        :param sample_offset: int - index of the first sample
+        """
+        self.intervals = np.asarray(intervals).reshape(-1, 2)
+        self.offsets = np.asarray(offsets)
+        if det_uid is None:
+            det_uid = np.arange(len(self.offsets) - 1)
+        self.det_uid = np.asarray(det_uid)
+        self.nsamps = nsamps
+        self.sample_offset = sample_offset
+
+    @classmethod
+    def from_list(cls, cuts_list, nsamps=None, det_uid=None, sample_offset=0):
+        """Build from a list of per-detector (n_i, 2) arrays"""
+        intervals, offsets = pack(cuts_list)
+        return cls(intervals.astype(np.int32), offsets.astype(np.int32),
+                   det_uid, nsamps, sample_offset)
+
+    @classmethod
+    def from_todcuts(cls, tod_cuts):
+        """Build from a moby2 TODCuts"""
+        return cls.from_list(tod_cuts.cuts, tod_cuts.nsamps,
+                             getattr(tod_cuts, 'det_uid', None),
+                             getattr(tod_cuts, 'sample_offset', 0))
+
+    def to_todcuts(self):
+        """Convert to a moby2 TODCuts"""
+        import moby2
+        tod_cuts = moby2.tod.TODCuts(nsamps=self.nsamps, det_uid=self.det_uid,
+                                     sample_offset=self.sample_offset)
+        for i in range(len(self)):
+            tod_cuts.cuts[i] = moby2.tod.CutsVector(np.array(self[i]), self.nsamps)
+        return tod_cuts
+
+    @property
+    def cuts(self):
+        """Per-detector access like TODCuts.cuts"""
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """Return the cuts of the detector at index i (a view)"""
+        return self.intervals[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get_counts(self):
+        """Return the number of cuts of each detector"""
+        return np.diff(self.offsets)
+
+    def select(self, dets):
+        """Return the cuts of a subset of detectors
+        @par:
+            dets: [int] - indices of the detectors
+        @ret:
+            CSRCuts"""
+        dets = np.asarray(dets, dtype=np.int64)
+        counts = (self.offsets[dets + 1] - self.offsets[dets]).astype(np.int64)
+        offsets = np.zeros(len(dets) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        index = np.repeat(self.offsets[dets] - offsets[:-1], counts) + \
+            np.arange(offsets[-1])
+        return CSRCuts(self.intervals[index], offsets.astype(self.offsets.dtype),
+                       self.det_uid[dets], self.nsamps, self.sample_offset)
+
+    def save(self, filename):
+        """Save the cuts. A .npz filename gives a compressed archive,
+        otherwise all fields are packed into one int32 .npy file that
+        can be memory-mapped when loading"""
+        if filename.endswith('.npz'):
+            np.savez_compressed(filename, intervals=self.intervals,
+                                offsets=self.offsets, det_uid=self.det_uid,
+                                info=np.array([VERSION, self.nsamps or -1,
+                                               self.sample_offset]))
+            return
+        ndet = len(self)
+        header = [VERSION, ndet, -1 if self.nsamps is None else self.nsamps,
+                  self.sample_offset, len(self.intervals)]
+        packed = np.concatenate([header, self.det_uid, self.offsets,
+                                 self.intervals.ravel()]).astype(np.int32)
+        np.save(filename, packed)
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """Load cuts saved with save
+        @par:
+            filename: string
+            mmap: bool - memory-map a .npy file instead of reading it"""
+        if filename.endswith('.npz'):
+            with np.load(filename) as f:
+                version, nsamps, sample_offset = f['info']
+                return cls(f['intervals'], f['offsets'], f['det_uid'],
+                           None if nsamps < 0 else int(nsamps), int(sample_offset))
+        packed = np.load(filename, mmap_mode='r' if mmap else None)
+        version, ndet, nsamps, sample_offset, n = [int(v) for v in packed[:_HEADER]]
+        if version != VERSION:
+            raise ValueError("Unsupported cuts format version %d in %s" % (version, filename))
+        i = _HEADER
+        det_uid = packed[i:i+ndet]
+        offsets = packed[i+ndet:i+2*ndet+1]
+        intervals = packed[i+2*ndet+1:i+2*ndet+1+2*n].reshape(-1, 2)
+        return cls(intervals, offsets, det_uid, None if nsamps < 0 else nsamps,
+                   sample_offset)
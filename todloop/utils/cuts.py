@@ -1,6 +1,8 @@
-import numpy as np
 import moby2
 
+from .intervals import union, intersection, pack, unpack, combine_groups, \
+    overlap_mask, IntervalIndex
+
 
 def merge_cuts(cut1, cut2):
     """Merge two cutvectors
@@ -11,10 +13,7 @@ def merge_cuts(cut1, cut2):
         return cut1
 
     nsamps = max(cut1[-1][1], cut2[-1][1])
-    c1m = cut1.get_mask(nsamps=nsamps)
-    c2m = cut2.get_mask(nsamps=nsamps)
-    cm = np.logical_or(c1m, c2m)
-    merged = moby2.tod.CutsVector.from_mask(mask=cm)
+    merged = moby2.tod.CutsVector(union(cut1, cut2), nsamps)
     return merged
 
 
@@ -26,26 +25,55 @@ def common_cuts(cut1, cut2):
     if len(cut2) == 0:
         return cut2
     nsamps = max(cut1[-1][1], cut2[-1][1])
-    c1m = cut1.get_mask(nsamps=nsamps)
-    c2m = cut2.get_mask(nsamps=nsamps)
-    cm = np.logical_and(c1m, c2m)
-    common = moby2.tod.CutsVector.from_mask(mask=cm)
+    common = moby2.tod.CutsVector(intersection(cut1, cut2), nsamps)
     return common
 
 
+def union_over_groups(cuts, groups):
+    """Union of the cuts of each group of detectors in one pass
+    @par:
+        cuts: TODCuts
+        groups: (n_groups, k) array of detector indices, padded with -1
+    @ret:
+        list of CutsVector, one per group"""
+    return _combine_over_groups(cuts, groups, "union")
+
+
+def intersection_over_groups(cuts, groups):
+    """Common cuts of each group of detectors in one pass
+    @par:
+        cuts: TODCuts
+        groups: (n_groups, k) array of detector indices, padded with -1
+    @ret:
+        list of CutsVector, one per group"""
+    return _combine_over_groups(cuts, groups, "intersection")
+
+
+def _combine_over_groups(cuts, groups, mode):
+    intervals, offsets = pack(cuts.cuts)
+    results = unpack(*combine_groups(intervals, offsets, groups, mode))
+    return [moby2.tod.CutsVector(r, cuts.nsamps) for r in results]
+
+
 def remove_overlap_vector(original, to_remove, buff=0):
     """remove the to_remove CutVector from original CutVector"""
-    for row in to_remove:
-        original = original[(original[:, 1]<row[0]-buff) | (original[:, 0]>row[1]+buff)]
-    return original
+    if len(original) == 0 or len(to_remove) == 0:
+        return original
+    overlap = overlap_mask(original, [0, len(original)],
+                           to_remove, [0, len(to_remove)], buff)
+    return original[~overlap]
 
 
 def remove_overlap_tod(original, to_remove, buff=0):
     """remove the to_remove TODCuts from original TODCuts"""
+    intervals, offsets = pack(original.cuts)
+    remove_intervals, remove_offsets = pack(to_remove.cuts)
+    overlap = overlap_mask(intervals, offsets, remove_intervals,
+                           remove_offsets, buff)
     ndet = len(original.cuts)
     for i in range(ndet):
-        # loop over detector
-        original.cuts[i] = remove_overlap_vector(original.cuts[i], to_remove.cuts[i], buff)
+        # loop over detector to store the results
+        original.cuts[i] = original.cuts[i][~overlap[offsets[i]:offsets[i+1]]]
     return original
 
 
@@ -70,12 +98,8 @@ def pixels_affected(cs, v):
 
 
 def pixels_affected_in_event(cs, event):
-    pixels_affected_list = []
-    start_time = event[0]
-    end_time = event[1]
-    for t in range(start_time, end_time):
-        pixels_affected_list.extend(pixels_affected(cs,t))
-
-    return list(set(pixels_affected_list))
+    """Return the pixels with cuts containing any sample of the event.
+    To look up many events, build an IntervalIndex once instead"""
+    return IntervalIndex.from_dict(cs).query(event[0], event[1])
 
 
@@ -1,5 +1,7 @@
 import numpy as np
 
+from .intervals import pack
+
 
 def timeseries(tod, pixel_id, s_time, e_time, pr, buffer=10,
                remove_mean=True):
@@ -11,7 +13,9 @@ def timeseries(tod, pixel_id, s_time, e_time, pr, buffer=10,
         pixel_id: pixel to plot
         s_time: start time 
         e_time: end time
-        pr: PixelReader object for the given array and season
+        pr: PixelReader object for the given array and season. The
+            TOD may hold a subset of the detectors and samples (partial
+            loading), the times are samples of the whole TOD
         buffer: buffer to add to the start time and end time
         remove_mean: if we want to remove the mean
 
@@ -23,13 +27,15 @@ def timeseries(tod, pixel_id, s_time, e_time, pr, buffer=10,
         d4: time series from detector 4 (higher freq)
 
     """
-    # define start / end time with buffer
-    start_time = max(s_time - buffer, 0)
-    end_time = min(e_time + buffer, tod.data.shape[1])
+    # define start / end time with buffer, relative to the loaded samples
+    sample_offset = getattr(tod.info, 'sample_index', 0) or 0
+    start_time = max(s_time - buffer - sample_offset, 0)
+    end_time = min(e_time + buffer - sample_offset, tod.data.shape[1])
 
-    # get detectors corresponding to the pixel
-    a1, a2 = pr.get_f1(pixel_id)
-    b1, b2 = pr.get_f2(pixel_id)
+    # get the rows of the detectors corresponding to the pixel
+    rows = dict((d, i) for i, d in enumerate(tod.det_uid))
+    a1, a2 = [rows[d] for d in pr.get_f1(pixel_id)]
+    b1, b2 = [rows[d] for d in pr.get_f2(pixel_id)]
 
     # get the time series associated with the detectors
     d1, d2 = tod.data[a1], tod.data[a2]
@@ -82,15 +88,43 @@ def find_peaks(hist):
     :param hist: histogram of coincident signals
     :return: list of peaks with [start_time, end_time, duration, n_pixels_affected]
     """
-    last = 0
-    peaks = []
-    for i in range(len(hist)):
-        if hist[i] > 0 and last == 0:
-            peak_start = i
-        if hist[i] == 0 and last > 0:
-            peak_end = i
-            peak_amp = max(hist[peak_start:peak_end])
-            duration = peak_end - peak_start
-            peaks.append([peak_start, peak_end, duration, peak_amp])
-        last = hist[i]
-    return peaks
+    hist = np.asarray(hist, dtype=float)
+    if len(hist) == 0:
+        return []
+    # runs of non-zero samples, a run still open at the end is not a peak
+    edges = np.diff(np.concatenate([[0], (hist != 0).astype(np.int8)]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    # each segment [start, next start) holds one run followed by zeros
+    amps = np.maximum.reduceat(hist, starts) if len(starts) else np.zeros(0)
+    starts, amps = starts[:len(ends)], amps[:len(ends)]
+    return [list(peak) for peak in zip(starts.tolist(), ends.tolist(),
+                                       (ends - starts).tolist(), amps.tolist())]
+
+
+def endpoint_histogram(cosig, nsamps):
+    """Histogram of the first and last sample of each coincident signal,
+    each sample counted at most once per pixel. This is what FindEvents
+    has always used to locate events
+    :param cosig: dict of pixel: (n, 2) array of [start, end) cuts, the
+                  cuts of a pixel being disjoint as FindCosigs makes them
+    :param nsamps: number of samples
+    :return: array of nsamps counts"""
+    intervals, _ = pack([cosig[p] for p in cosig])
+    last = intervals[:, 1] - 1
+    # the first and last sample only coincide for one-sample cuts
+    pos = np.concatenate([intervals[:, 0], last[last != intervals[:, 0]]]) % nsamps
+    return np.bincount(pos, minlength=nsamps).astype(float)
+
+
+def coverage_histogram(cosig, nsamps):
+    """Number of pixels with a coincident signal at each sample, built
+    with a difference array
+    :param cosig: dict of pixel: (n, 2) array of [start, end) cuts
+    :param nsamps: number of samples
+    :return: array of nsamps counts"""
+    intervals, _ = pack([cosig[p] for p in cosig])
+    intervals = np.clip(intervals, 0, nsamps)
+    diff = np.bincount(intervals[:, 0], minlength=nsamps + 1) - \
+        np.bincount(intervals[:, 1], minlength=nsamps + 1)
+    return np.cumsum(diff[:nsamps]).astype(float)
@@ -1,19 +1,162 @@
+import copy
+
 import numpy as np
 
+
+def _bin_index(values, edges):
+    """Index of the uniform bin of each value, -1 outside of the range.
+    The rounding is corrected against the edges like np.histogram does,
+    and the last bin includes the upper edge"""
+    nbins = len(edges) - 1
+    low, high = edges[0], edges[-1]
+    values = np.asarray(values, dtype=float).ravel()
+    inside = (values >= low) & (values <= high)
+    index = np.full(len(values), -1, dtype=np.intp)
+    v = values[inside]
+    i = ((v - low) * (nbins / (high - low))).astype(np.intp)
+    i[i == nbins] = nbins - 1
+    i[v < edges[i]] -= 1
+    i[(v >= edges[i + 1]) & (i != nbins - 1)] += 1
+    index[inside] = i
+    return index
+
+
+def _weights(weights, n):
+    if weights is None:
+        return None
+    weights = np.asarray(weights)
+    if weights.ndim == 0:
+        weights = np.full(n, weights)
+    return weights.ravel()
+
+
 class Hist1D(object):
 
     def __init__(self, xlow, xhigh, nbins):
         self.nbins = nbins
         self.xlow  = xlow
         self.xhigh = xhigh
-        self.hist, edges = np.histogram([], bins=nbins, range=(xlow, xhigh))
-        self.bins = (edges[:-1] + edges[1:]) / 2.
+        self.hist, self.edges = np.histogram([], bins=nbins, range=(xlow, xhigh))
+        self.bins = (self.edges[:-1] + self.edges[1:]) / 2.
 
     def fill(self, value, weight=1):
-        hist, edges = np.histogram([value], bins=self.nbins, range=(self.xlow, self.xhigh))
-        self.hist += hist*weight
+        self.fill_many([value], weight)
+
+    def fill_many(self, values, weights=None):
+        """Fill many values at once
+        :param values: array of values, the ones outside of the range are
+                       ignored
+        :param weights: None, a scalar or an array like values"""
+        index = _bin_index(values, self.edges)
+        weights = _weights(weights, len(index))
+        inside = index >= 0
+        counts = np.bincount(index[inside], minlength=self.nbins,
+                             weights=None if weights is None else weights[inside])
+        self._add_counts(counts)
+
+    def _add_counts(self, counts):
+        if counts.dtype.kind == 'f' and self.hist.dtype.kind != 'f':
+            if np.all(counts == np.round(counts)):  # integer weights
+                counts = counts.astype(self.hist.dtype)
+            else:
+                self.hist = self.hist.astype(float)
+        self.hist += counts
+
+    def is_compatible(self, other):
+        return type(self) is type(other) and np.array_equal(self.edges, other.edges)
+
+    def add(self, other):
+        """Add the counts of a histogram with the same binning, e.g. from
+        another rank"""
+        if not self.is_compatible(other):
+            raise ValueError("Cannot add histograms with different binning")
+        self._add_counts(np.asarray(other.hist))
+        return self
+
+    def __iadd__(self, other):
+        return self.add(other)
+
+    def __add__(self, other):
+        return copy.deepcopy(self).add(other)
+
+    def reduce(self, comm=None, root=0):
+        """Sum the histograms of all ranks, typically in finalize.
+        With mpi4py only the counts are sent (with Reduce), other
+        communicators gather the histograms.
+        :return: the summed histogram on the root, None elsewhere, and
+                 the histogram itself without a communicator"""
+        if comm is None:
+            return self
+        if hasattr(comm, 'Reduce'):
+            from mpi4py import MPI
+            # all ranks need the same dtype for the buffer reduction
+            is_float = comm.allreduce(self.hist.dtype.kind == 'f', op=MPI.LOR)
+            hist = np.ascontiguousarray(self.hist, dtype=float if is_float else np.int64)
+            total = np.empty_like(hist) if comm.Get_rank() == root else None
+            comm.Reduce(hist, total, op=MPI.SUM, root=root)
+            if comm.Get_rank() != root:
+                return None
+            result = self.empty_like()
+            result.hist = total
+            return result
+        hists = comm.gather(self, root=root)
+        if hists is None:
+            return None
+        result = self.empty_like()
+        for hist in hists:
+            if hist is not None:  # None from ranks that died
+                result.add(hist)
+        return result
+
+    def empty_like(self):
+        return Hist1D(self.xlow, self.xhigh, self.nbins)
 
     @property
     def data(self):
         return self.bins, self.hist
-        
+
+
+class Hist2D(Hist1D):
+
+    def __init__(self, xlow, xhigh, nxbins, ylow, yhigh, nybins):
+        self.nxbins = nxbins
+        self.nybins = nybins
+        self.xlow = xlow
+        self.xhigh = xhigh
+        self.ylow = ylow
+        self.yhigh = yhigh
+        self.hist, self.xedges, self.yedges = np.histogram2d(
+            [], [], bins=[nxbins, nybins], range=[[xlow, xhigh], [ylow, yhigh]])
+        self.hist = self.hist.astype(np.int64)
+        self.xbins = (self.xedges[:-1] + self.xedges[1:]) / 2.
+        self.ybins = (self.yedges[:-1] + self.yedges[1:]) / 2.
+
+    def fill(self, x, y, weight=1):
+        self.fill_many([x], [y], weight)
+
+    def fill_many(self, x, y, weights=None):
+        """Fill many (x, y) pairs at once
+        :param x, y: arrays of values, the pairs outside of the range are
+                     ignored
+        :param weights: None, a scalar or an array like x"""
+        ix = _bin_index(x, self.xedges)
+        iy = _bin_index(y, self.yedges)
+        weights = _weights(weights, len(ix))
+        inside = (ix >= 0) & (iy >= 0)
+        counts = np.bincount(ix[inside] * self.nybins + iy[inside],
+                             minlength=self.nxbins * self.nybins,
+                             weights=None if weights is None else weights[inside])
+        self._add_counts(counts.reshape(self.nxbins, self.nybins))
+
+    def is_compatible(self, other):
+        return type(self) is type(other) and \
+            np.array_equal(self.xedges, other.xedges) and \
+            np.array_equal(self.yedges, other.yedges)
+
+    def empty_like(self):
+        return Hist2D(self.xlow, self.xhigh, self.nxbins,
+                      self.ylow, self.yhigh, self.nybins)
+
+    @property
+    def data(self):
+        return self.xbins, self.ybins, self.hist
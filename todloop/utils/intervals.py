@@ -0,0 +1,252 @@
+"""Operations on sets of half-open [start, end) sample intervals stored
+as (n, 2) integer arrays, the layout used by moby2 CutsVector. They give
+the same results as going through dense boolean masks, without
+allocating arrays of the length of the TOD"""
+import numpy as np
+
+
+def _normalize(intervals):
+    """Return the intervals as a sorted list of disjoint, non-touching
+    [start, end] pairs, dropping empty ones. This is linear for input
+    that is already sorted, which is the case for cuts vectors"""
+    merged = []
+    for start, end in sorted(intervals):
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _to_array(intervals):
+    return np.array(intervals, dtype=int).reshape(-1, 2)
+
+
+def union(cuts1, cuts2):
+    """Union of two sets of intervals
+    @par:
+        cuts1, cuts2: (n, 2) arrays of [start, end) intervals
+    @ret:
+        (n, 2) array of sorted, disjoint intervals"""
+    a = np.asarray(cuts1).reshape(-1, 2).tolist()
+    b = np.asarray(cuts2).reshape(-1, 2).tolist()
+    # merge the two sorted lists, then merge overlapping intervals
+    return _to_array(_normalize(a + b))
+
+
+def intersection(cuts1, cuts2):
+    """Intersection of two sets of intervals, in O(k1+k2) for sorted
+    input
+    @par:
+        cuts1, cuts2: (n, 2) arrays of [start, end) intervals
+    @ret:
+        (n, 2) array of sorted, disjoint intervals"""
+    a = _normalize(np.asarray(cuts1).reshape(-1, 2).tolist())
+    b = _normalize(np.asarray(cuts2).reshape(-1, 2).tolist())
+    common = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][1], b[j][1])
+        if start < end:
+            if common and start == common[-1][1]:
+                common[-1][1] = end
+            else:
+                common.append([start, end])
+        # move past the interval that ends first
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return _to_array(common)
+
+
+def pack(cuts_list):
+    """Pack a list of (n_i, 2) interval arrays, e.g. the cuts of all
+    detectors of a TODCuts, into a flat array and offsets
+    @par:
+        cuts_list: list of (n_i, 2) arrays
+    @ret:
+        intervals: (N, 2) int array
+        offsets: (len(cuts_list)+1,) int array, the intervals of set i
+                 are intervals[offsets[i]:offsets[i+1]]"""
+    offsets = np.zeros(len(cuts_list) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in cuts_list])
+    if offsets[-1] == 0:
+        return np.zeros((0, 2), dtype=int), offsets
+    intervals = np.concatenate([np.asarray(c, dtype=int).reshape(-1, 2)
+                                for c in cuts_list])
+    return intervals, offsets
+
+
+def unpack(intervals, offsets):
+    """Split packed intervals back into a list of (n_i, 2) arrays"""
+    return [intervals[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+
+
+def combine_groups(intervals, offsets, groups, mode="intersection"):
+    """Union or intersection of the interval sets of each group in one
+    vectorized pass. Each set has to consist of disjoint intervals, as
+    cuts vectors do.
+    @par:
+        intervals, offsets: packed interval sets (see pack)
+        groups: (n_groups, k) int array of set indices, padded with -1
+                for groups with less than k sets
+        mode: "intersection" or "union"
+    @ret:
+        intervals, offsets: packed result of each group"""
+    n_groups = len(groups)
+    if n_groups == 0:
+        return np.zeros((0, 2), dtype=int), np.zeros(1, dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64).reshape(n_groups, -1)
+    valid = groups >= 0
+    n_sets = valid.sum(axis=1)
+
+    # gather the intervals of every (group, set) pair
+    group_of_set = np.repeat(np.arange(n_groups), n_sets)
+    sets = groups[valid]
+    counts = offsets[sets + 1] - offsets[sets]
+    first = np.repeat(offsets[sets] - np.cumsum(counts) + counts, counts)
+    index = first + np.arange(counts.sum())
+    selected = intervals[index]
+    group = np.repeat(group_of_set, counts)
+    keep = selected[:, 0] < selected[:, 1]
+    selected, group = selected[keep], group[keep]
+
+    # sweep over start (+1) and end (-1) events within each group
+    pos = np.concatenate([selected[:, 0], selected[:, 1]])
+    delta = np.concatenate([np.ones(len(selected), dtype=np.int64),
+                            -np.ones(len(selected), dtype=np.int64)])
+    grp = np.concatenate([group, group])
+    order = np.lexsort((pos, grp))
+    pos, delta, grp = pos[order], delta[order], grp[order]
+    if len(pos):
+        new = np.ones(len(pos), dtype=bool)
+        new[1:] = (pos[1:] != pos[:-1]) | (grp[1:] != grp[:-1])
+        starts = np.flatnonzero(new)
+        pos, grp = pos[starts], grp[starts]
+        delta = np.add.reduceat(delta, starts)
+    # number of sets covering [pos[i], pos[i+1]), each group sums to zero
+    coverage = np.cumsum(delta)
+
+    # segments between consecutive events of a group that are selected
+    same_group = grp[1:] == grp[:-1]
+    if mode == "union":
+        sel = same_group & (coverage[:-1] >= 1)
+    elif mode == "intersection":
+        sel = same_group & (coverage[:-1] == n_sets[grp[:-1]])
+    else:
+        raise ValueError("Unknown mode: %s" % mode)
+    # merge runs of adjacent selected segments
+    sel = np.concatenate([[False], sel, [False]]).astype(np.int8)
+    edges = np.diff(sel)
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    result = np.vstack([pos[run_starts], pos[run_ends]]).T.reshape(-1, 2)
+    result_offsets = np.zeros(n_groups + 1, dtype=np.int64)
+    result_offsets[1:] = np.cumsum(np.bincount(grp[run_starts], minlength=n_groups))
+    return result, result_offsets
+
+
+def overlap_mask(intervals, offsets, to_remove, remove_offsets, buff=0):
+    """Find the intervals that overlap any interval to remove of the same
+    set, for all sets at once. Two intervals overlap if they are closer
+    than buff samples, with the same closed comparison as
+    remove_overlap_vector. Each set is done with a sorted sweep (via
+    searchsorted) instead of comparing every pair.
+    @par:
+        intervals, offsets: packed interval sets (see pack)
+        to_remove, remove_offsets: packed interval sets to remove, with
+                                   the same number of sets
+        buff: int - margin around the intervals to remove
+    @ret:
+        bool array, True for the intervals that overlap"""
+    intervals = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+    to_remove = np.asarray(to_remove, dtype=np.int64).reshape(-1, 2)
+    if len(intervals) == 0 or len(to_remove) == 0:
+        return np.zeros(len(intervals), dtype=bool)
+    n_sets = len(offsets) - 1
+    det = np.repeat(np.arange(n_sets), np.diff(offsets))
+    det_remove = np.repeat(np.arange(n_sets), np.diff(remove_offsets))
+
+    # shift each set into its own range so that one sweep does all sets
+    lo = min(intervals.min(), to_remove.min())
+    span = max(intervals.max(), to_remove.max()) - lo
+    shift = span + 2 * abs(buff) + 1
+    rm_start = to_remove[:, 0] - lo + det_remove * shift - buff
+    rm_end = to_remove[:, 1] - lo + det_remove * shift + buff
+    order = np.argsort(rm_start, kind='mergesort')
+    rm_start = rm_start[order]
+    rm_end = np.maximum.accumulate(rm_end[order])
+
+    start = intervals[:, 0] - lo + det * shift
+    end = intervals[:, 1] - lo + det * shift
+    # intervals to remove that start before the end of each interval,
+    # it overlaps if the furthest reaching of them ends after its start
+    idx = np.searchsorted(rm_start, end, side='right')
+    return (idx > 0) & (rm_end[np.maximum(idx - 1, 0)] >= start)
+
+
+class IntervalIndex(object):
+    """An index over labelled closed intervals [start, end], e.g. the
+    coincident signals of all pixels, to find the labels of the
+    intervals that overlap given ranges of samples"""
+    def __init__(self, intervals, labels):
+        """
+        :param intervals: (n, 2) int array of closed [start, end] intervals
+        :param labels: (n,) int array - label of each interval
+        """
+        intervals = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+        order = np.argsort(intervals[:, 0], kind='mergesort')
+        self._starts = intervals[order, 0]
+        self._ends = intervals[order, 1]
+        self._labels = np.asarray(labels, dtype=np.int64)[order]
+
+    @classmethod
+    def from_dict(cls, cuts_dict, half_open=False):
+        """Build from a dict of label: (n, 2) intervals, such as the cosig
+        dict indexed by str(pixel_id)
+        :param half_open: bool - the intervals are [start, end) rather
+                          than closed"""
+        labels = [int(k) for k in cuts_dict]
+        intervals, offsets = pack([cuts_dict[k] for k in cuts_dict])
+        if half_open:
+            intervals[:, 1] -= 1
+        return cls(intervals, np.repeat(labels, np.diff(offsets)).astype(np.int64))
+
+    def query(self, start, end):
+        """Return the sorted labels of the intervals that contain any
+        sample in [start, end)"""
+        if start >= end:
+            return []
+        hi = np.searchsorted(self._starts, end - 1, side='right')
+        hit = self._ends[:hi] >= start
+        return np.unique(self._labels[:hi][hit]).tolist()
+
+    def query_many(self, starts, ends):
+        """Same as query for many ranges at once. Sorted, non-overlapping
+        ranges (like the peaks of a histogram) are done in one batch
+        @ret:
+            list of lists of labels, one per range"""
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        n = len(starts)
+        lasts = ends - 1
+        if n == 0:
+            return []
+        if np.any(lasts < starts) or np.any(starts[1:] <= lasts[:-1]):
+            return [self.query(s, e) for s, e in zip(starts, ends)]
+        # each interval overlaps a contiguous block of ranges
+        lo = np.searchsorted(lasts, self._starts, side='left')
+        hi = np.searchsorted(starts, self._ends, side='right')
+        counts = np.maximum(hi - lo, 0)
+        first = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        event = first + np.arange(counts.sum())
+        label = np.repeat(self._labels, counts)
+        # unique (range, label) pairs, sorted by range then label
+        pairs = np.unique(np.vstack([event, label]).T, axis=0).reshape(-1, 2)
+        bounds = np.searchsorted(pairs[:, 0], np.arange(n + 1))
+        return [pairs[bounds[i]:bounds[i+1], 1].tolist() for i in range(n)]
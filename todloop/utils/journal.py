@@ -0,0 +1,69 @@
+import glob
+import os
+import uuid
+
+DONE = "done"
+ERROR = "error"
+# the outputs of a TOD recorded as done failed to be written afterwards
+WRITE_ERROR = "write_error"
+
+
+class Journal(object):
+    """An append-only log of processed TODs, one file per rank. Each
+    line is written and fsync'd right after a TOD is processed so that
+    the progress survives a killed job. The lines carry an id of the
+    run, so that a write error is matched with the attempt it belongs to"""
+    def __init__(self, output_dir, rank=0):
+        self._filename = os.path.join(output_dir, "journal_%d.txt" % rank)
+        self._file = None
+        self._attempt = uuid.uuid4().hex[:12]
+
+    def open(self):
+        if not self._file:
+            self._file = open(self._filename, "a")
+
+    def record(self, tod_id, tod_name, status):
+        """Append the outcome of a TOD
+        @par:
+            tod_id: int
+            tod_name: string
+            status: DONE, ERROR or WRITE_ERROR"""
+        self.open()
+        self._file.write("%s\t%d\t%s\t%s\n" % (status, tod_id, tod_name, self._attempt))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def load_journal(output_dir):
+    """Load the journals of all ranks in a directory
+    @ret:
+        dict of tod_id: status. A TOD that succeeded on any attempt is
+        considered done, unless its outputs failed to be written later
+        in that same attempt (which counts as an error)"""
+    attempts = {}  # tod_id: {attempt: status}
+    for filename in sorted(glob.glob(os.path.join(output_dir, "journal_*.txt"))):
+        with open(filename, "r") as f:
+            for line in f:
+                if not line.endswith('\n'):  # incomplete line from a killed job
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) not in [3, 4]:
+                    continue
+                tod_id = int(fields[1])
+                # lines without an attempt id are from older journals,
+                # take each file as one attempt
+                attempt = (filename, fields[3] if len(fields) == 4 else None)
+                statuses = attempts.setdefault(tod_id, {})
+                if fields[0] == WRITE_ERROR:
+                    statuses[attempt] = ERROR
+                elif statuses.get(attempt) != ERROR or fields[0] == ERROR:
+                    statuses[attempt] = fields[0]
+    status = {}
+    for tod_id, statuses in attempts.items():
+        status[tod_id] = DONE if DONE in statuses.values() else ERROR
+    return status
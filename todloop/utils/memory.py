@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import fcntl
+import tempfile
+import numpy as np
+
+
+def nbytes(obj, _seen=None):
+    """Estimate the memory held by an object in bytes. numpy arrays
+    are counted by their buffer size and containers and objects are
+    walked recursively, so that e.g. a TOD object is counted with its
+    data arrays. Shared objects are only counted once.
+    @par:
+        obj: any object
+    @ret:
+        int: approximate number of bytes"""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(nbytes(k, _seen) + nbytes(v, _seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sum(nbytes(v, _seen) for v in obj)
+    if hasattr(obj, '__dict__') and not isinstance(obj, type):
+        return sys.getsizeof(obj) + nbytes(vars(obj), _seen)
+    return sys.getsizeof(obj)
+
+
+def get_rss():
+    """Return the current resident set size of this process in bytes,
+    or the peak one where /proc is not available (e.g. mac)"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # bytes on mac
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process to the current
+    one, so that get_peak_rss measures from now on (linux only)
+    @ret:
+        bool: whether the peak was reset"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def get_peak_rss():
+    """Return the peak resident set size of this process in bytes since
+    it started or since reset_peak_rss, or None where /proc is not
+    available"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def node_memory_used():
+    """Return the memory in use on this node in bytes, i.e. the total
+    memory minus the memory available to start new work"""
+    info = {}
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            fields = line.split()
+            info[fields[0].rstrip(':')] = int(fields[1]) * 1024
+    return info['MemTotal'] - info['MemAvailable']
+
+
+class MemoryBudget(object):
+    """A memory budget shared by the processes on a node. Before a
+    process starts a new piece of work, it reserves its estimated
+    size. The reservation is granted if the memory in use on the node
+    plus the recent reservations of other processes stays within the
+    budget. Reservations are kept in a ledger file that is locked
+    while checking, so that processes starting at the same time don't
+    all see the same free memory"""
+    def __init__(self, max_bytes, ledger=None, settle=60.):
+        """
+        :param max_bytes: int - memory budget of the node
+        :param ledger: string - node-local file to keep reservations in
+        :param settle: float - seconds after which a reservation is
+                       assumed to show up in the memory in use
+        """
+        self._max_bytes = max_bytes
+        if ledger is None:
+            ledger = os.path.join(tempfile.gettempdir(),
+                                  "todloop_memory_%d.ledger" % os.getuid())
+        self._ledger = ledger
+        self._settle = settle
+
+    def try_reserve(self, nbytes):
+        """Reserve nbytes if it fits in the budget
+        @ret:
+            bool: whether the reservation was granted"""
+        pid = os.getpid()
+        with open(self._ledger, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                now = time.time()
+                entries = []
+                for line in f:
+                    fields = line.split()
+                    if len(fields) != 3:
+                        continue
+                    if int(fields[0]) != pid and float(fields[1]) > now - self._settle:
+                        entries.append((int(fields[0]), float(fields[1]), int(fields[2])))
+                used = node_memory_used() + sum(e[2] for e in entries)
+                granted = used + nbytes <= self._max_bytes
+                if granted:
+                    entries.append((pid, now, int(nbytes)))
+                f.seek(0)
+                f.truncate()
+                f.write("".join("%d %f %d\n" % e for e in entries))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return granted
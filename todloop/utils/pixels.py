@@ -1,54 +1,236 @@
+import hashlib
+import logging
+import os
 import matplotlib
 import numpy as np
 from matplotlib import pyplot as plt
 import moby2
 
+from .spatial import GridIndex, to_csr_matrix
+from .arraycache import save_arrays, load_arrays, checksum
+
+# squared distance below which two detectors are adjacent
+ADJACENT_DIST2 = 0.6
+# layout version of the on-disk pixel cache
+CACHE_VERSION = 1
+# units of the array positions of the seasons that need rescaling
+SEASON_POSITION_SCALE = {'2017': 10000.0}
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# readers already built in this process, by (season, array, mask)
+_readers = {}
+
+
+def get_pixel_reader(season='2016', array='AR3', mask=None, cache_dir=None):
+    """Return a PixelReader for the season and array, built once per
+    process and shared by all later calls with the same arguments
+    (e.g. by routines running over many TODs). See PixelReader for
+    cache_dir"""
+    mask_key = None
+    if mask is not None:
+        mask = np.asarray(mask)
+        mask_key = hashlib.sha1(mask.tobytes()).hexdigest() + str(mask.dtype)
+    key = (season, array, mask_key)
+    if key not in _readers:
+        _readers[key] = PixelReader(season=season, array=array, mask=mask,
+                                    cache_dir=cache_dir)
+    return _readers[key]
+
 
 class PixelReader:
-    def __init__(self, season='2016', array='AR3', mask=None):
+    def __init__(self, season='2016', array='AR3', mask=None, cache_dir=None):
+        """
+        :param mask: int array - 1 for the detectors to use
+        :param cache_dir: string - directory of a local cache of the array
+                          data, pixels and neighbors, to avoid rebuilding
+                          them on every process. It is built on first use
+                          and rebuilt when the array data or the season
+                          calibration changes.
+        """
         self._array_info = {
             'season': season,
             'array_name': array
         }
         self._array_pos = None
         self._freqs = None
-        self._array_data = moby2.scripting.get_array_data(self._array_info)
-        self._pixel_dict = self.generate_pixel_dict()
         self._mask = mask
-        self.calibrate_array(season=self._array_info['season'])
+        self._adjacency = None
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = os.path.join(cache_dir, "pixels_%s_%s.npz" % (season, array))
+        array_data = moby2.scripting.get_array_data(self._array_info)
+        source = self.source_fingerprint(array_data, season)
+        if not (cache_file and self.load_cache(cache_file, source)):
+            self._array_data = array_data
+            self.build_pixels()
+            self._index = GridIndex(self._array_pos, np.sqrt(ADJACENT_DIST2))
+            self.calibrate_array(season=self._array_info['season'])
+            self.build_adjacency()
+            if cache_file:
+                self.save_cache(cache_file, source)
         self.get_adjacent_detectors = self.adjacent_detector_generator()
 
+    def build_pixels(self):
+        """Find which detectors correspond to which pixel and frequencies.
+        Detectors are grouped by position, a pixel being a physical
+        position with at least one TES, indexed by the smallest det_uid
+        at that position. The detectors of each frequency are stored as
+        padded arrays (-1 for no detector):
+            self._pixels: (n_pixels,) pixel ids
+            self._f1, self._f2: (n_pixels, n) dets in lower / higher freq
+            self._pixel_index: (ndet,) row of each pixel id, -1 otherwise"""
+        ad = self._array_data
+        self._array_pos = np.vstack([ad['array_x'], ad['array_y']]).T
+        self._freqs = np.sort(np.unique(ad['nom_freq']))[1:]  # gather freqs (exclude 0)
+        ndet = len(self._array_pos)
+        dets = np.arange(ndet)
+
+        # group detectors by position
+        _, group = np.unique(self._array_pos, axis=0, return_inverse=True)
+        group = group.ravel()
+        n_groups = group.max() + 1 if ndet else 0
+        pixel_id = np.full(n_groups, ndet, dtype=int)
+        np.minimum.at(pixel_id, group, dets)
+        tes = (np.asarray(ad['det_type']) == 'tes') & \
+            np.any(self._array_pos != 0, axis=1)  # remove non-tes and non-physical
+        first_tes = np.full(n_groups, ndet, dtype=int)
+        np.minimum.at(first_tes, group[tes], dets[tes])
+
+        # pixels in the order of their first TES detector
+        groups = np.argsort(first_tes, kind='mergesort')
+        groups = groups[first_tes[groups] < ndet]
+        row = np.full(n_groups, -1, dtype=int)
+        row[groups] = np.arange(len(groups))
+        self._pixels = pixel_id[groups]
+        self._pixel_index = np.full(ndet, -1, dtype=int)
+        self._pixel_index[self._pixels] = np.arange(len(groups))
+
+        def padded(freq):
+            # detectors of a freq sorted by pixel row and det_uid
+            sel = dets[(np.asarray(ad['nom_freq']) == freq) & (row[group] >= 0)]
+            sel = sel[np.lexsort((sel, row[group[sel]]))]
+            rows = row[group[sel]]
+            counts = np.bincount(rows, minlength=len(groups))
+            table = np.full((len(groups), max(counts.max(initial=0), 1)), -1, dtype=int)
+            rank = np.arange(len(sel)) - np.repeat(np.cumsum(counts) - counts, counts)
+            table[rows, rank] = sel
+            return table
+
+        # f1: lower freq, f2: higher freq
+        self._f1 = padded(self._freqs[0])
+        self._f2 = padded(self._freqs[1])
+
     def generate_pixel_dict(self):
         """ Generate pixel dictionary that tells which detectors correspond
         to which pixel and frequencies """
-        self._array_pos = np.vstack([self._array_data['array_x'], self._array_data['array_y']]).T
-        self._freqs = np.sort(np.unique(self._array_data['nom_freq']))[1:]  # gather freqs (exclude 0)
-        pixel_dict = {}  # initialize empty pixel_dict
-
-        for det_id in self._array_data['det_uid']:
-            if np.all(self._array_pos[det_id, :] == [0, 0]):  # not physical
-                continue
-            if self._array_data['det_type'][det_id] != 'tes':  # remove non-tes
-                continue
-            dets = np.where(np.all(self._array_pos == self._array_pos[det_id, :], axis=1))[0]
-            # make a dictionary of frequencies: f1: lower freq, f2: higher freq
-            pol_dict = {
-                'f1': [i for i in dets if self._array_data['nom_freq'][i] == self._freqs[0] and
-                       self._array_data['det_type'][det_id] == 'tes'],
-                'f2': [i for i in dets if self._array_data['nom_freq'][i] == self._freqs[1] and
-                       self._array_data['det_type'][det_id] == 'tes']
+        pixel_dict = {}
+        for i, pixel_id in enumerate(self._pixels):
+            pixel_dict[str(pixel_id)] = {
+                'f1': [det for det in self._f1[i] if det >= 0],
+                'f2': [det for det in self._f2[i] if det >= 0]
             }
-            pixel_id = dets[0]  # index pixel by the smallest det_uid
-            pixel_dict[str(pixel_id)] = pol_dict
-            
         return pixel_dict
 
+    def get_pixel_table(self):
+        """Return the pixels with their detectors as arrays, with the
+        mask applied
+        :return:
+            pixels: (n_pixels,) pixel ids
+            f1, f2: (n_pixels, n) dets in lower / higher freq, -1 padded"""
+        return self._pixels, self._apply_mask(self._f1), self._apply_mask(self._f2)
+
+    def _apply_mask(self, table):
+        if self._mask is None:
+            return table
+        valid = table >= 0
+        valid[valid] = np.asarray(self._mask)[table[valid]] == 1
+        # move the remaining detectors first, keeping their order
+        order = np.argsort(~valid, axis=1, kind='mergesort')
+        return np.where(np.take_along_axis(valid, order, axis=1),
+                        np.take_along_axis(table, order, axis=1), -1)
+
+    def _get_dets(self, table, pixel):
+        dets = table[self._pixel_index[pixel]]
+        dets = dets[dets >= 0]
+        if self._mask is not None:
+            return [int(det) for det in dets if self._mask[det] == 1]
+        else:
+            return [int(det) for det in dets]
+
+    def is_pixel(self, pixel):
+        """Return whether the det_uid indexes a pixel"""
+        return 0 <= pixel < len(self._pixel_index) and self._pixel_index[pixel] >= 0
+
+    @staticmethod
+    def source_fingerprint(array_data, season):
+        """Return a checksum of the uncalibrated array data and of the
+        calibration of the season, identifying what a cache was built from"""
+        arrays = dict(('array_data.%s' % key, np.asarray(array_data[key]))
+                      for key in array_data.keys())
+        arrays['position_scale'] = np.array(SEASON_POSITION_SCALE.get(season, 1.))
+        return checksum(arrays)
+
+    def save_cache(self, filename, source):
+        """Save the array data, pixels and neighbor index to a .npz file,
+        with the fingerprint of the source they were built from"""
+        arrays = dict(('array_data.%s' % key, np.asarray(self._array_data[key]))
+                      for key in self._array_data.keys())
+        arrays.update(('index.%s' % key, value)
+                      for key, value in self._index.to_arrays().items())
+        arrays.update({
+            'array_pos': self._array_pos,
+            'freqs': self._freqs,
+            'pixels': self._pixels,
+            'f1': self._f1,
+            'f2': self._f2,
+            'pixel_index': self._pixel_index,
+            'adjacent': self._adjacency[0],
+            'adjacent_offsets': self._adjacency[1],
+            'adjacent_dist2': np.array(ADJACENT_DIST2),
+            'source': np.array(source)
+        })
+        save_arrays(filename, arrays, CACHE_VERSION)
+
+    def load_cache(self, filename, source):
+        """Load the array data, pixels and neighbor index saved with
+        save_cache, memory-mapped. Return False if there is no valid cache
+        or if it was built from another source"""
+        if not os.path.exists(filename):
+            return False
+        try:
+            arrays = load_arrays(filename, CACHE_VERSION)
+        except (ValueError, IOError, KeyError) as e:
+            logger.warning("Ignoring pixel cache: %s" % e)
+            return False
+        if float(arrays['adjacent_dist2']) != ADJACENT_DIST2:
+            return False
+        if str(arrays.get('source', '')) != source:
+            logger.info("Rebuilding stale pixel cache %s" % filename)
+            return False
+        self._array_data = dict((key[len('array_data.'):], value)
+                                for key, value in arrays.items()
+                                if key.startswith('array_data.'))
+        self._index = GridIndex.from_arrays(dict(
+            (key[len('index.'):], value) for key, value in arrays.items()
+            if key.startswith('index.')))
+        self._array_pos = arrays['array_pos']
+        self._freqs = arrays['freqs']
+        self._pixels = arrays['pixels']
+        self._f1 = arrays['f1']
+        self._f2 = arrays['f2']
+        self._pixel_index = arrays['pixel_index']
+        self._adjacency = (arrays['adjacent'], arrays['adjacent_offsets'])
+        return True
+
     def calibrate_array(self, season):
         """Calibrate the array_data based on season since different
         seasons have different array_data units"""
-        if season == '2017':
-            self._array_data['array_x'] /= 10000.0
-            self._array_data['array_y'] /= 10000.0
+        if season in SEASON_POSITION_SCALE:
+            self._array_data['array_x'] /= SEASON_POSITION_SCALE[season]
+            self._array_data['array_y'] /= SEASON_POSITION_SCALE[season]
 
         
     def adjacent_detector_generator(self):
@@ -58,53 +240,59 @@ class PixelReader:
 
         return: [int] function(int det)
         """
-        # Find the adjacent detectors
-        adj_dets = [None] * len(self._array_data['array_x'])  # Generate an empty list to store adjacent detector lists
-        ar = self._array_pos
-
-        for i in range(len(self._array_data)):
-            dis = np.dot((ar - ar[i, :])**2, [[1], [1]])
-            _mask = ((dis < 0.6) & (dis > 0)).T & ((ar[:, 0] != 0) | (ar[:, 1] != 0))
-            mask = _mask.flatten()
-            indexes = np.where(mask is True)
-            adj_dets[i] = list(list(indexes)[0])  # Normalize the np array output to list
+        if self._adjacency is None:
+            self.build_adjacency()
 
         # Generate a function to access the data to make sure above procedures run once only
         def get_adjacent_detectors(detector):
-            return adj_dets[detector]
+            indices, offsets = self._adjacency
+            return indices[offsets[detector]:offsets[detector+1]].tolist()
 
         return get_adjacent_detectors
 
+    def build_adjacency(self):
+        # Find the adjacent detectors of all detectors at once: the other
+        # physical detectors closer than the threshold, excluding the ones
+        # at the same position
+        ar = self._array_pos
+        indices, offsets, dist = self._index.query_radius(
+            ar, np.sqrt(ADJACENT_DIST2), return_distance=True)
+        keep = (dist > 0) & np.any(ar[indices] != 0, axis=1)
+        self._adjacency = (indices[keep],
+                           np.concatenate([[0], np.cumsum(keep)])[offsets])
+
     def get_pixels(self):
-        return [int(key) for key in self._pixel_dict]
+        return [int(pixel) for pixel in self._pixels]
 
     def get_f1(self, pixel):
-        if self._mask is not None:
-            return [det for det in self._pixel_dict[str(pixel)]['f1'] if self._mask[det] == 1]
-        else:
-            return self._pixel_dict[str(pixel)]['f1']
+        return self._get_dets(self._f1, pixel)
     
     def get_f2(self, pixel):
-        if self._mask is not None:
-            return [det for det in self._pixel_dict[str(pixel)]['f2'] if self._mask[det] == 1]
-        else:
-            return self._pixel_dict[str(pixel)]['f2']
+        return self._get_dets(self._f2, pixel)
 
     def get_dets(self, pixel):
-        if self._mask is not None:
-            return [det for det in self._pixel_dict[str(pixel)]['f1'] if self._mask[det] == 1]
-        else:
-            return self._pixel_dict[str(pixel)]['f1']
+        return self._get_dets(self._f1, pixel)
 
     def get_adjacent_pixels(self, pixel):
         all_adj_det = self.get_adjacent_detectors(pixel)
-        return [int(det) for det in all_adj_det if str(det) in self._pixel_dict]
+        return [int(det) for det in all_adj_det if self.is_pixel(det)]
 
     
     def get_pixels_within_radius(self, pixel, radius):
-        ar = self._array_pos
-        dist = np.sqrt(np.sum((ar - ar[pixel, :])**2, axis=1))
-        return [det for det in np.arange(1056)[dist < radius] if str(det) in self._pixel_dict]
+        dets, _ = self._index.query_radius(self._array_pos[pixel], radius)
+        return [int(det) for det in dets if self.is_pixel(det)]
+
+    def get_spatial_index(self):
+        """Return the GridIndex over the detector positions, for batched
+        radius and k-nearest queries"""
+        return self._index
+
+    def get_adjacency_matrix(self):
+        """Return the adjacency of all detectors as a (ndet, ndet)
+        scipy.sparse CSR matrix, for graph algorithms such as grouping
+        the pixels of an event into connected components"""
+        indices, offsets = self._adjacency
+        return to_csr_matrix(indices, offsets, len(self._array_pos))
         
     def plot(self, pixels=None):
         plt.plot(self._array_data['array_x'], self._array_data['array_y'], 'r.')
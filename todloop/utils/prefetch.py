@@ -0,0 +1,84 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .memory import nbytes
+
+
+class Prefetcher(object):
+    """Load items ahead of time on a background thread so that reading
+    from disk overlaps with the processing of the current item"""
+    def __init__(self, loader, depth=1, max_bytes=None):
+        """
+        :param loader: function - called with the arguments given in
+                       schedule/get to load an item
+        :param depth: int - maximum number of items loaded ahead
+        :param max_bytes: int - cap on the memory held by items loaded
+                          ahead, None for no limit
+        """
+        self._loader = loader
+        self._depth = depth
+        self._max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = OrderedDict()  # key: future
+        self._size = None  # size of the last item, used as estimate
+        self._pid = os.getpid()
+
+    def get(self, key, *args):
+        """Return the item for a key, waiting for it if it is being
+        prefetched and loading it right away otherwise. Errors from
+        the background load are raised here"""
+        future = self._futures.pop(key, None)
+        if future is None or self._forked():
+            item = self._loader(*args)
+        else:
+            item = future.result()
+        self._size = nbytes(item)
+        return item
+
+    def schedule(self, requests):
+        """Start loading the upcoming items
+        @par:
+            requests: list of (key, args) in the order they will be
+                      needed. Items loaded ahead that are not in the
+                      list anymore (e.g. rejected by a selector) are
+                      dropped"""
+        if self._forked():  # the background thread lives in the parent
+            return
+        keys = [key for key, _ in requests]
+        for key in list(self._futures):
+            if key not in keys:
+                self._futures.pop(key).cancel()
+        for key, args in requests[:self._depth]:
+            if key in self._futures:
+                continue
+            if not self._has_room():
+                break
+            self._futures[key] = self._executor.submit(self._loader, *args)
+
+    def _forked(self):
+        return os.getpid() != self._pid
+
+    def in_flight_bytes(self):
+        """Return the estimated memory held by items loaded ahead"""
+        total = 0
+        for future in self._futures.values():
+            if future.done() and not future.cancelled() and not future.exception():
+                total += nbytes(future.result())
+            elif self._size:
+                total += self._size
+        return total
+
+    def _has_room(self):
+        if self._max_bytes is None or self._size is None:
+            return True
+        return self.in_flight_bytes() + self._size <= self._max_bytes
+
+    def close(self):
+        """Drop the pending items and stop the background thread"""
+        if self._forked():
+            return
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._executor.shutdown(wait=True)
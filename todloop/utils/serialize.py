@@ -0,0 +1,232 @@
+"""A serialization format for routine outputs that keeps large numpy
+arrays out of the pickle stream: the object is pickled with protocol 5
+and the data of its large arrays is stored as separate raw buffers after
+it, each one optionally compressed. Small arrays (e.g. the cuts of one
+detector) stay in the pickle stream, which is compressed as a whole.
+Uncompressed buffers are aligned so that loading from a memory-mapped
+file gives arrays backed by the file.
+
+Dicts with string keys (the usual routine output) can be saved field by
+field instead, as a table of keys followed by one record per value, so
+that a reader can deserialize only the fields it uses (see LazyFields).
+
+Layout of a record:
+    header: magic, version, codec and length of the pickle stream,
+            number of buffers
+    table: codec, offset, stored length, raw length of each buffer
+    pickle stream
+    buffers, each starting on an ALIGN bytes boundary
+"""
+from collections.abc import MutableMapping
+import lzma
+import mmap as mmap_module
+import pickle
+import struct
+import zlib
+
+MAGIC = b"\x93TLPK"
+FIELDS_MAGIC = b"\x93TLPF"
+VERSION = 1
+ALIGN = 64
+_HEADER = struct.Struct("<5sBBQI")
+_ENTRY = struct.Struct("<BQQQ")
+_FIELDS_HEADER = struct.Struct("<5sBQ")
+
+# codecs, the compression can be chosen per array
+NONE, ZLIB, LZMA = 0, 1, 2
+CODECS = {None: NONE, "zlib": ZLIB, "lzma": LZMA}
+# protocol 5 supports out-of-band buffers
+PROTOCOL = 5
+
+
+def _compress(raw, codec, level):
+    if codec == ZLIB:
+        return zlib.compress(raw, 6 if level is None else level)
+    return lzma.compress(raw, preset=6 if level is None else level)
+
+
+def _decompress(stored, codec):
+    if codec == ZLIB:
+        return bytearray(zlib.decompress(stored))
+    return bytearray(lzma.decompress(stored))
+
+
+def _choose_codec(raw, codec, level, min_size, sample=1 << 16, max_ratio=0.9):
+    """Compress a buffer if it is large enough and a sample of it
+    compresses well, which skips e.g. noisy floats
+    @ret:
+        codec, stored bytes"""
+    if codec == NONE or raw.nbytes < min_size:
+        return NONE, raw
+    if raw.nbytes > sample and \
+            len(_compress(raw[:sample], codec, level)) > max_ratio * sample:
+        return NONE, raw
+    stored = _compress(raw, codec, level)
+    if len(stored) > max_ratio * raw.nbytes:
+        return NONE, raw
+    return codec, stored
+
+
+def dumps(obj, compression=None, level=None, min_size=4096, fields=False):
+    """Serialize an object
+    @par:
+        obj: object - any picklable object
+        compression: None, "zlib" or "lzma" - compression of the array
+                     buffers, only applied to arrays that compress well
+        level: int - compression level
+        min_size: int - arrays smaller than this (in bytes) are kept in
+                  the pickle stream
+        fields: bool - save a dict with string keys field by field, so
+                that fields can be loaded lazily
+    @ret:
+        bytes"""
+    if fields and isinstance(obj, dict) and all(isinstance(k, str) for k in obj):
+        return _dumps_fields(obj, compression, level, min_size)
+    codec = CODECS[compression]
+    buffers = []
+
+    def out_of_band(buf):
+        # returning True keeps the buffer in the pickle stream
+        if buf.raw().nbytes < min_size:
+            return True
+        buffers.append(buf)
+        return False
+    stream = pickle.dumps(obj, PROTOCOL, buffer_callback=out_of_band)
+    stream_codec, stream = _choose_codec(memoryview(stream), codec, level, 0)
+    entries, chunks = [], []
+    offset = _HEADER.size + _ENTRY.size * len(buffers) + len(stream)
+    for buf in buffers:
+        raw = buf.raw()
+        c, stored = _choose_codec(raw, codec, level, min_size)
+        pad = -offset % ALIGN
+        chunks.append(b"\0" * pad)
+        chunks.append(stored)
+        entries.append(_ENTRY.pack(c, offset + pad, len(stored), raw.nbytes))
+        offset += pad + len(stored)
+    header = _HEADER.pack(MAGIC, VERSION, stream_codec, len(stream), len(buffers))
+    return b"".join([header] + entries + [stream] + chunks)
+
+
+def _dumps_fields(obj, compression, level, min_size):
+    records = [dumps(value, compression, level, min_size) for value in obj.values()]
+    table, offset = [], 0
+    for key, record in zip(obj, records):
+        offset += -offset % ALIGN
+        table.append((key, offset, len(record)))
+        offset += len(record)
+    table = pickle.dumps(table, PROTOCOL)
+    start = _FIELDS_HEADER.size + len(table)
+    start += -start % ALIGN
+    chunks = [_FIELDS_HEADER.pack(FIELDS_MAGIC, VERSION, len(table)), table]
+    chunks.append(b"\0" * (start - _FIELDS_HEADER.size - len(table)))
+    position = 0
+    for record in records:
+        chunks.append(b"\0" * (-position % ALIGN))
+        position += -position % ALIGN + len(record)
+        chunks.append(record)
+    return b"".join(chunks)
+
+
+class LazyFields(MutableMapping):
+    """A dict saved field by field whose values are deserialized when
+    first accessed"""
+    def __init__(self, view, table):
+        self._view = view
+        self._table = table  # key: (offset, length) of the record
+        self._values = {}
+        self._keys = list(table)
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key not in self._table:
+                raise KeyError(key)
+            offset, length = self._table[key]
+            self._values[key] = loads(self._view[offset:offset + length])
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._table and key not in self._values:
+            self._keys.append(key)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if key not in self._table and key not in self._values:
+            raise KeyError(key)
+        self._table.pop(key, None)
+        self._values.pop(key, None)
+        self._keys.remove(key)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def loaded(self):
+        """Return the keys deserialized so far"""
+        return [key for key in self._keys if key in self._values]
+
+
+def _loads_fields(view, lazy):
+    magic, version, table_len = _FIELDS_HEADER.unpack_from(view)
+    if version != VERSION:
+        raise ValueError("Unsupported serialization version %d" % version)
+    table = pickle.loads(view[_FIELDS_HEADER.size:_FIELDS_HEADER.size + table_len])
+    start = _FIELDS_HEADER.size + table_len
+    start += -start % ALIGN
+    fields = LazyFields(view, dict((key, (start + offset, length))
+                                   for key, offset, length in table))
+    return fields if lazy else dict(fields)
+
+
+def loads(data, lazy=False):
+    """Deserialize an object written by dumps. Data that doesn't start
+    with the magic string is loaded as a plain pickle. Uncompressed arrays
+    share the memory of data, so they are read-only if data is (bytes,
+    read-only mmap)
+    @par:
+        data: bytes, bytearray, memoryview or mmap
+        lazy: bool - return a dict saved field by field as LazyFields"""
+    view = memoryview(data)
+    if bytes(view[:len(FIELDS_MAGIC)]) == FIELDS_MAGIC:
+        return _loads_fields(view, lazy)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        return pickle.loads(view)
+    magic, version, stream_codec, stream_len, n_buffers = _HEADER.unpack_from(view)
+    if version != VERSION:
+        raise ValueError("Unsupported serialization version %d" % version)
+    buffers = []
+    for i in range(n_buffers):
+        codec, offset, stored_len, raw_len = \
+            _ENTRY.unpack_from(view, _HEADER.size + i * _ENTRY.size)
+        stored = view[offset:offset + stored_len]
+        buffers.append(stored if codec == NONE else _decompress(stored, codec))
+    start = _HEADER.size + n_buffers * _ENTRY.size
+    stream = view[start:start + stream_len]
+    if stream_codec != NONE:
+        stream = _decompress(stream, stream_codec)
+    return pickle.loads(stream, buffers=buffers)
+
+
+def dump(obj, filename, **kwargs):
+    """Serialize an object to a file, see dumps for the options"""
+    with open(filename, "wb") as f:
+        f.write(dumps(obj, **kwargs))
+
+
+def load(filename, mmap=True, lazy=False):
+    """Load an object saved with dump (or a plain pickle)
+    @par:
+        filename: string
+        mmap: bool - memory-map the file, so uncompressed arrays are read
+              from disk only when accessed (they are read-only)
+        lazy: bool - see loads"""
+    with open(filename, "rb") as f:
+        if mmap:
+            try:
+                data = mmap_module.mmap(f.fileno(), 0, access=mmap_module.ACCESS_READ)
+            except ValueError:  # empty file
+                data = b""
+        else:
+            data = bytearray(f.read())
+    return loads(data, lazy)
@@ -0,0 +1,175 @@
+"""An append-only container for per-TOD outputs: each rank appends its
+records to one shard file, and an index file next to it gives the
+offset and length of the record of each tod_id, and when it was
+written. This replaces one small file per TOD, whose metadata operations
+dominate on parallel filesystems"""
+import glob
+import mmap
+import os
+import pickle
+import time
+
+from .serialize import loads
+
+MERGED = "merged"
+
+
+def _shard_files(directory, name):
+    return (os.path.join(directory, "shard_%s.dat" % name),
+            os.path.join(directory, "shard_%s.idx" % name))
+
+
+def read_index(index_file, size=None):
+    """Load a shard index
+    @par:
+        index_file: string
+        size: int - size of the shard, to drop records beyond it
+    @ret:
+        dict of tod_id: (offset, length, written), the last record of a
+        tod_id wins. written is the time the record was written, 0 for
+        indexes without it"""
+    index = {}
+    with open(index_file, "r") as f:
+        for line in f:
+            if not line.endswith('\n'):  # incomplete line from a killed job
+                continue
+            fields = line.split('\t')
+            if len(fields) not in [3, 4]:
+                continue
+            tod_id, offset, length = [int(v) for v in fields[:3]]
+            written = float(fields[3]) if len(fields) == 4 else 0.
+            if size is not None and offset + length > size:
+                continue
+            index[tod_id] = (offset, length, written)
+    return index
+
+
+class ShardWriter(object):
+    """Append records to the shard of a rank. The shard is only created
+    when the first record is written"""
+    def __init__(self, output_dir, rank=0):
+        self._data_file, self._index_file = _shard_files(output_dir, rank)
+        self._data = None
+        self._index = None
+
+    def open(self):
+        if not self._data:
+            self._data = open(self._data_file, "ab")
+            self._index = open(self._index_file, "a")
+
+    def write(self, tod_id, data):
+        """Append the pickled data of a TOD"""
+        self.write_bytes(tod_id, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+    def write_bytes(self, tod_id, payload, written=None):
+        """Append an already serialized record
+        @par:
+            written: float - time the record was written, now by default"""
+        if written is None:
+            written = time.time()
+        self.open()
+        offset = self._data.seek(0, os.SEEK_END)
+        self._data.write(payload)
+        self._data.flush()
+        # the index line comes after the data so that it never points to
+        # a partial record
+        self._index.write("%d\t%d\t%d\t%.6f\n" % (tod_id, offset, len(payload), written))
+        self._index.flush()
+
+    def close(self):
+        if self._data:
+            for f in [self._data, self._index]:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+            self._data = None
+            self._index = None
+
+
+class ShardReader(object):
+    """Random access to the records of all shards of a directory"""
+    def __init__(self, input_dir):
+        self._input_dir = input_dir
+        self._index = {}  # tod_id: (data_file, offset, length, written)
+        self._files = {}
+        self.load_index()
+
+    def load_index(self):
+        """Read the index of all shards. When a TOD has records in
+        several shards (e.g. a rerun on another rank) the newest one wins.
+        The merged shard is read first, so that it loses ties"""
+        index_files = glob.glob(os.path.join(self._input_dir, "shard_*.idx"))
+        merged = _shard_files(self._input_dir, MERGED)[1]
+        for index_file in sorted(index_files, key=lambda f: (f != merged, f)):
+            data_file = index_file[:-len(".idx")] + ".dat"
+            if not os.path.isfile(data_file):
+                continue
+            size = os.path.getsize(data_file)
+            for tod_id, (offset, length, written) in read_index(index_file, size).items():
+                if tod_id not in self._index or written >= self._index[tod_id][3]:
+                    self._index[tod_id] = (data_file, offset, length, written)
+
+    def __contains__(self, tod_id):
+        return tod_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return sorted(self._index)
+
+    def written(self, tod_id):
+        """Return the time the record of a TOD was written"""
+        return self._index[tod_id][3]
+
+    def read_bytes(self, tod_id):
+        """Return the serialized record of a TOD, as a view of the
+        memory-mapped shard"""
+        data_file, offset, length, _ = self._index[tod_id]
+        if data_file not in self._files:
+            with open(data_file, "rb") as f:
+                self._files[data_file] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._files[data_file])[offset:offset + length]
+
+    def load(self, tod_id, lazy=False):
+        """Return the data of a TOD, pickled or serialized with
+        utils.serialize (whose uncompressed arrays stay memory-mapped)
+        @par:
+            lazy: bool - see serialize.loads"""
+        return loads(self.read_bytes(tod_id), lazy)
+
+    def close(self):
+        for data in self._files.values():
+            try:
+                data.close()
+            except BufferError:  # still used by loaded arrays, freed with them
+                pass
+        self._files = {}
+
+
+def compact_shards(directory):
+    """Merge the shards of all ranks (and a previous merged shard) into
+    one merged shard, keeping the newest record of each tod_id, then remove
+    the rank shards. Run it when no rank is writing.
+    @ret:
+        number of records in the merged shard"""
+    data_file, index_file = _shard_files(directory, MERGED)
+    tmp_data, tmp_index = _shard_files(directory, MERGED + ".tmp")
+    for filename in [tmp_data, tmp_index]:  # left by an interrupted compaction
+        if os.path.exists(filename):
+            os.remove(filename)
+    sources = glob.glob(os.path.join(directory, "shard_*.dat")) + \
+        glob.glob(os.path.join(directory, "shard_*.idx"))
+    reader = ShardReader(directory)
+    writer = ShardWriter(directory, MERGED + ".tmp")
+    for tod_id in reader.keys():
+        writer.write_bytes(tod_id, reader.read_bytes(tod_id), reader.written(tod_id))
+    writer.close()
+    reader.close()
+    if os.path.exists(tmp_data):
+        os.rename(tmp_data, data_file)
+        os.rename(tmp_index, index_file)
+    for filename in sources:
+        if filename not in (data_file, index_file) and os.path.exists(filename):
+            os.remove(filename)
+    return len(reader)
@@ -0,0 +1,150 @@
+"""A spatial index over detector positions in the focal plane, to find
+the detectors near given positions without comparing every pair. The
+results of batched queries are packed like interval sets (see
+intervals.pack): the neighbors of query i are indices[offsets[i]:offsets[i+1]]"""
+import numpy as np
+
+
+class GridIndex(object):
+    """A grid hash over 2d points: the points are sorted by the square
+    cell of size cell_size they fall in, so that the points of a column
+    of cells form a contiguous block found by binary search"""
+    def __init__(self, points, cell_size):
+        """
+        :param points: (n, 2) float array of positions
+        :param cell_size: float - width of the cells, ideally close to
+                          the radius of the most frequent queries
+        """
+        self._points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self._cell_size = float(cell_size)
+        if len(self._points):
+            self._origin = self._points.min(axis=0)
+        else:
+            self._origin = np.zeros(2)
+        cells = self._get_cells(self._points)
+        self._n_cols = cells[:, 0].max() + 1 if len(cells) else 0
+        self._n_rows = cells[:, 1].max() + 1 if len(cells) else 0
+        keys = cells[:, 0] * self._n_rows + cells[:, 1]
+        self._order = np.argsort(keys, kind='mergesort')
+        self._keys = keys[self._order]
+
+    def to_arrays(self):
+        """Return the state of the index as a dict of arrays, to be saved"""
+        return {
+            'points': self._points,
+            'cell_size': np.array(self._cell_size),
+            'origin': self._origin,
+            'shape': np.array([self._n_cols, self._n_rows]),
+            'order': self._order,
+            'keys': self._keys
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Restore an index from to_arrays without sorting again"""
+        index = cls.__new__(cls)
+        index._points = arrays['points']
+        index._cell_size = float(arrays['cell_size'])
+        index._origin = arrays['origin']
+        index._n_cols, index._n_rows = [int(n) for n in arrays['shape']]
+        index._order = arrays['order']
+        index._keys = arrays['keys']
+        return index
+
+    def __len__(self):
+        return len(self._points)
+
+    def _get_cells(self, points):
+        return np.floor((points - self._origin) / self._cell_size).astype(np.int64)
+
+    def query_radius(self, queries, radius, return_distance=False):
+        """Find the points closer than radius to each query position
+        @par:
+            queries: (m, 2) float array of positions
+            radius: float
+            return_distance: bool - also return the distances
+        @ret:
+            indices: int array of point indices, sorted for each query
+            offsets: (m+1,) int array
+            distances: float array like indices (if return_distance)"""
+        queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+        cells = self._get_cells(queries)
+        reach = int(np.ceil(radius / self._cell_size))
+        # columns and rows of cells within reach of each query, clipped to
+        # the grid (queries may lie outside of it)
+        lo_col = np.clip(cells[:, 0] - reach, 0, max(self._n_cols - 1, 0))
+        hi_col = np.clip(cells[:, 0] + reach, 0, max(self._n_cols - 1, 0))
+        lo_row = np.clip(cells[:, 1] - reach, 0, max(self._n_rows - 1, 0))
+        hi_row = np.clip(cells[:, 1] + reach, 0, max(self._n_rows - 1, 0))
+        in_grid = (cells[:, 0] + reach >= 0) & (cells[:, 0] - reach < self._n_cols) & \
+            (cells[:, 1] + reach >= 0) & (cells[:, 1] - reach < self._n_rows)
+        n_steps = (hi_col - lo_col + 1)[in_grid].max(initial=0)
+        query, found = [], []
+        for dx in range(n_steps):
+            col = lo_col + dx
+            ok = in_grid & (col <= hi_col)
+            lo = np.searchsorted(self._keys, col * self._n_rows + lo_row, side='left')
+            hi = np.searchsorted(self._keys, col * self._n_rows + hi_row, side='right')
+            counts = np.where(ok, hi - lo, 0)
+            first = np.repeat(lo - np.cumsum(counts) + counts, counts)
+            query.append(np.repeat(np.arange(len(queries)), counts))
+            found.append(self._order[first + np.arange(counts.sum())])
+        query = np.concatenate(query) if query else np.zeros(0, dtype=np.int64)
+        found = np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+        # keep the candidates within the radius
+        dist2 = np.sum((self._points[found] - queries[query])**2, axis=1)
+        near = dist2 < radius**2
+        query, found, dist2 = query[near], found[near], dist2[near]
+        order = np.lexsort((found, query))
+        indices = found[order]
+        offsets = np.zeros(len(queries) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(query, minlength=len(queries)))
+        if return_distance:
+            return indices, offsets, np.sqrt(dist2[order])
+        return indices, offsets
+
+    def query_knn(self, queries, k):
+        """Find the k nearest points of each query position, by radius
+        queries that double in size until k points are found
+        @par:
+            queries: (m, 2) float array of positions
+            k: int
+        @ret:
+            distances: (m, k) float array, sorted, inf when there are
+                       less than k points
+            indices: (m, k) int array, -1 when there are less than k points"""
+        queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+        distances = np.full((len(queries), k), np.inf)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        if len(self._points) == 0 or k <= 0:
+            return distances, indices
+        # radius that covers all points for every query
+        extent = np.concatenate([self._points, queries])
+        max_radius = np.hypot(*np.ptp(extent, axis=0))
+        todo = np.arange(len(queries))
+        radius = self._cell_size
+        while len(todo):
+            found, offsets, dist = self.query_radius(queries[todo], radius,
+                                                     return_distance=True)
+            counts = np.diff(offsets)
+            done = (counts >= k) | (radius > max_radius)
+            # k closest of each finished query, ties broken by index
+            query = np.repeat(np.arange(len(todo)), counts)
+            order = np.lexsort((found, dist, query))
+            query, found, dist = query[order], found[order], dist[order]
+            rank = np.arange(len(query)) - offsets[query]
+            sel = done[query] & (rank < k)
+            distances[todo[query[sel]], rank[sel]] = dist[sel]
+            indices[todo[query[sel]], rank[sel]] = found[sel]
+            todo = todo[~done]
+            radius *= 2
+        return distances, indices
+
+
+def to_csr_matrix(indices, offsets, n_cols):
+    """Convert packed neighbor lists into a scipy.sparse adjacency
+    matrix, e.g. for scipy.sparse.csgraph"""
+    from scipy import sparse
+    data = np.ones(len(indices), dtype=bool)
+    return sparse.csr_matrix((data, indices, offsets), shape=(len(offsets) - 1, n_cols))
@@ -0,0 +1,68 @@
+import os
+import queue
+import threading
+import traceback
+
+
+class AsyncWriter(object):
+    """Run output tasks (serialization and writes) on a background thread
+    so that a slow filesystem doesn't stall the processing. The queue is
+    bounded: submitting blocks while max_queue tasks are pending, which
+    also bounds the memory held by outputs not yet written"""
+    def __init__(self, max_queue=8):
+        """
+        :param max_queue: int - maximum number of pending tasks
+        """
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._errors = []  # (tag, traceback) of the failed tasks
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="AsyncWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                tag, func, args = task
+                try:
+                    func(*args)
+                except Exception:
+                    with self._lock:
+                        self._errors.append((tag, traceback.format_exc()))
+            finally:
+                self._queue.task_done()
+
+    def _forked(self):
+        return os.getpid() != self._pid
+
+    def submit(self, tag, func, *args):
+        """Run func(*args) in the background
+        @par:
+            tag: object - identifies the task in pop_errors, e.g. the TOD
+            func: function"""
+        if self._forked() or not self._thread.is_alive():
+            # the background thread lives in the parent process
+            func(*args)
+            return
+        self._queue.put((tag, func, args))
+
+    def flush(self):
+        """Wait until all submitted tasks are done"""
+        if not self._forked():
+            self._queue.join()
+
+    def pop_errors(self):
+        """Return and clear the (tag, traceback) of the failed tasks"""
+        with self._lock:
+            errors, self._errors = self._errors, []
+        return errors
+
+    def close(self):
+        """Finish the pending tasks and stop the thread"""
+        if not self._forked() and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()